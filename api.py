@@ -0,0 +1,353 @@
+"""Headless HTTP API over the streaming engine, no Gradio involved
+
+    POST   /api/v1/sessions                 new session: {"session_id"}
+    GET    /api/v1/sessions/{id}            prompt, thought, result and state
+    POST   /api/v1/sessions/{id}/generate   {"prompt", "thought", "throughput",
+                                            "sync_threshold", "pause_rules"}:
+                                            event stream
+    POST   /api/v1/sessions/{id}/resume     {"thought"}: continue the paused
+                                            thought, or an edited one
+    POST   /api/v1/sessions/{id}/pause      stop streaming, resumable
+    POST   /api/v1/sessions/{id}/cancel     stop streaming and drop read-ahead
+    DELETE /api/v1/sessions/{id}
+
+generate and resume answer with Server-Sent Events, paced at the session's
+sync rate like the UI: "delta" events carry the new "cot" and "result" text,
+a final "done" event the state (completed, paused, cancelled or error).
+Every generate starts a new round; with CONTEXT_TOKENS the earlier rounds
+are sent along. pause_rules replaces PAUSE_RULES for the session, as a list
+of policy.py rules without regex patterns (null goes back to PAUSE_RULES).
+Pause from another request, or with SHARED_SESSIONS from another worker.
+
+    python api.py --port 7861
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import threading
+import time
+
+import engine
+from engine import (
+    AppConfig,
+    ConvoState,
+    DynamicState,
+    StreamState,
+    attach_session,
+    publish_session,
+)
+from health import readiness
+from policy import build_rules
+
+
+class ApiSession:
+    """Engine state of one API client, the counterpart of a UI page"""
+
+    def __init__(self, session_id=None):
+        self.convo_state = ConvoState()
+        self.convo_state.headless = True
+        self.dynamic_state = DynamicState()
+        if session_id is None:
+            session_id = self.convo_state.session_key()
+        else:
+            self.convo_state.adopt_session(session_id)
+        self.session_id = session_id
+        self.cancelled = False
+        self.client_ip = None
+        self.last_used = time.monotonic()
+
+    def attach(self):
+        self.last_used = time.monotonic()
+        attach_session(self.session_id, self.convo_state, self.dynamic_state)
+
+    def publish(self):
+        publish_session(self.session_id, dynamic_state=self.dynamic_state)
+
+    @property
+    def streaming(self):
+        return self.convo_state.streaming
+
+    def state(self):
+        if self.streaming:
+            return "streaming"
+        run = self.convo_state.last_run
+        if run is None:
+            return "idle"
+        if self.cancelled:
+            return "cancelled"
+        if run["outcome"] in ("error", "timeout"):
+            return "error"
+        return "completed" if self.dynamic_state.stream_completed else "paused"
+
+    def snapshot(self):
+        current = self.convo_state.current
+        run = self.convo_state.last_run or {}
+        return {
+            "session_id": self.session_id,
+            "state": self.state(),
+            "prompt": current.user,
+            "thought": current.cot,
+            "result": current.result,
+            "think_complete": current.think_complete,
+            "throughput": self.convo_state.throughput,
+            "sync_threshold": self.convo_state.sync_threshold,
+            "pause_rules": self.convo_state.pause_rules,
+            "error": run.get("error"),
+        }
+
+
+class ApiSessions:
+    """Sessions by id, dropped once unused for HISTORY_TTL
+
+    With SHARED_SESSIONS an unknown id is taken as a session started by
+    another worker and loaded from the session store.
+    """
+
+    def __init__(self):
+        self.sessions = {}
+        self._lock = threading.Lock()
+
+    def create(self):
+        session = ApiSession()
+        with self._lock:
+            self._prune()
+            self.sessions[session.session_id] = session
+        return session
+
+    def get(self, session_id):
+        with self._lock:
+            session = self.sessions.get(session_id)
+            if session is None and engine.config.SHARED_SESSIONS:
+                session = self.sessions[session_id] = ApiSession(session_id)
+        if session is not None:
+            session.attach()
+        return session
+
+    def delete(self, session_id):
+        with self._lock:
+            return self.sessions.pop(session_id, None)
+
+    def _prune(self):
+        cutoff = time.monotonic() - engine.config.HISTORY_TTL
+        for session_id, session in list(self.sessions.items()):
+            if session.last_used < cutoff and not session.streaming:
+                del self.sessions[session_id]
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def stream_events(session, prompt, thought):
+    """Deltas of one generation as SSE, ending with a done event"""
+    convo_state, dynamic_state = session.convo_state, session.dynamic_state
+    # The round starts out as the thought split like StreamState does it
+    start = StreamState(thought)
+    sent_cot, sent_result = len(start.cot), len(start.result)
+    yield sse("start", {"session_id": session.session_id, "prompt": prompt})
+    async for _ in convo_state.agenerate_ai_response(
+        prompt, thought, dynamic_state, session.client_ip
+    ):
+        current = convo_state.current
+        if len(current.cot) > sent_cot or len(current.result) > sent_result:
+            delta = {}
+            if len(current.cot) > sent_cot:
+                delta["cot"] = current.cot[sent_cot:]
+                sent_cot = len(current.cot)
+            if len(current.result) > sent_result:
+                delta["result"] = current.result[sent_result:]
+                sent_result = len(current.result)
+            yield sse("delta", delta)
+    done = session.snapshot()
+    done.pop("thought")
+    done.pop("result")
+    yield sse("done", done)
+
+
+def create_router():
+    from fastapi import APIRouter, HTTPException, Request
+    from fastapi.responses import StreamingResponse
+
+    router = APIRouter()
+    sessions = ApiSessions()
+
+    def find(session_id):
+        session = sessions.get(session_id)
+        if session is None:
+            raise HTTPException(404, "Unknown session")
+        return session
+
+    async def read_body(request):
+        try:
+            body = await request.json() if await request.body() else {}
+        except ValueError:
+            raise HTTPException(400, "Body is not JSON")
+        if not isinstance(body, dict):
+            raise HTTPException(400, "Body must be a JSON object")
+        return body
+
+    async def start(session, request, prompt, thought):
+        if session.streaming or session.dynamic_state.should_stream:
+            raise HTTPException(409, "Session is streaming, pause it first")
+        session.cancelled = False
+        session.client_ip = request.client.host if request.client else None
+        session.dynamic_state.control_button_handler()
+        await asyncio.to_thread(session.publish)
+        return StreamingResponse(
+            stream_events(session, prompt, thought),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    @router.post("/sessions")
+    def create_session():
+        return {"session_id": sessions.create().session_id}
+
+    @router.get("/sessions/{session_id}")
+    def get_session(session_id):
+        return find(session_id).snapshot()
+
+    @router.delete("/sessions/{session_id}")
+    def delete_session(session_id):
+        session = find(session_id)
+        session.dynamic_state.should_stream = False
+        session.convo_state.discard_prefetch()
+        session.convo_state.discard_candidates()
+        sessions.delete(session_id)
+        return {"session_id": session_id, "state": "deleted"}
+
+    @router.post("/sessions/{session_id}/generate")
+    async def generate(session_id, request: Request):
+        # The session store is read and written off the event loop
+        session = await asyncio.to_thread(find, session_id)
+        body = await read_body(request)
+        if session.streaming or session.dynamic_state.should_stream:
+            raise HTTPException(409, "Session is streaming, pause it first")
+        prompt = body.get("prompt")
+        if not isinstance(prompt, str) or not prompt:
+            raise HTTPException(400, "prompt is required")
+        # Validated in full first, a rejected request changes nothing
+        settings = {}
+        for name in ("throughput", "sync_threshold"):
+            if name in body:
+                value = body[name]
+                if value is not None and (
+                    isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0
+                ):
+                    raise HTTPException(400, f"{name} must be a non-negative number or null")
+                if name == "throughput" and value == 0:
+                    # The bucket would never refill, null streams unpaced
+                    raise HTTPException(400, "throughput must be positive, or null for unpaced")
+                settings[name] = value
+        if "pause_rules" in body and body["pause_rules"] is not None:
+            try:
+                build_rules(body["pause_rules"], trusted=False)
+            except ValueError as e:
+                raise HTTPException(400, f"pause_rules: {e}")
+        for name, value in settings.items():
+            setattr(session.convo_state, name, value)
+        if "pause_rules" in body:
+            session.convo_state.pause_rules = body["pause_rules"]
+        if settings:
+            await asyncio.to_thread(publish_session, session.session_id, **settings)
+        # A new question, the previous round stays as context
+        session.convo_state.discard_candidates()
+        await asyncio.to_thread(session.convo_state.next_round)
+        return await start(session, request, prompt, body.get("thought") or "")
+
+    @router.post("/sessions/{session_id}/resume")
+    async def resume(session_id, request: Request):
+        session = await asyncio.to_thread(find, session_id)
+        body = await read_body(request)
+        if session.convo_state.history_pending():
+            await asyncio.to_thread(session.convo_state.load_history)
+        current = session.convo_state.current
+        if not current.user:
+            raise HTTPException(409, "Nothing to resume, generate first")
+        thought = body.get("thought")
+        if thought is None:
+            thought = current.cot
+        return await start(session, request, current.user, thought)
+
+    @router.post("/sessions/{session_id}/pause")
+    def pause(session_id):
+        session = find(session_id)
+        if session.dynamic_state.should_stream:
+            session.dynamic_state.control_button_handler()
+            session.publish()
+        return {"session_id": session_id, "state": "paused"}
+
+    @router.post("/sessions/{session_id}/cancel")
+    def cancel(session_id):
+        session = find(session_id)
+        session.cancelled = True
+        if session.dynamic_state.should_stream:
+            session.dynamic_state.control_button_handler()
+            session.publish()
+        session.convo_state.discard_prefetch()
+        session.convo_state.discard_candidates()
+        return {"session_id": session_id, "state": "cancelled"}
+
+    return router
+
+
+def create_api_server(config=AppConfig):
+    """FastAPI app with the session API under /api/v1, /metrics, /upstreams and probes
+
+    The upstreams are warmed up once the server starts. /healthz answers as
+    long as the process serves requests, /readyz with 503 until the warm-up
+    is done, while no upstream is reachable or while READY_MAX_WAITING
+    requests queue for an upstream slot.
+    """
+    from fastapi import FastAPI
+    from fastapi.responses import JSONResponse, PlainTextResponse
+
+    engine.configure(config)
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        engine.upstream_probe.start()
+        yield
+        await engine.upstream_probe.stop()
+        # Async clients are bound to this loop, atexit only closes the sync ones
+        await engine.api_clients.aclose()
+
+    server = FastAPI(lifespan=lifespan)
+
+    @server.get("/healthz")
+    def healthz():
+        _, report = readiness(
+            engine.upstream_probe, engine.admission, engine.config.READY_MAX_WAITING
+        )
+        return dict(report, status="ok")
+
+    @server.get("/readyz")
+    def readyz():
+        ready, report = readiness(
+            engine.upstream_probe, engine.admission, engine.config.READY_MAX_WAITING
+        )
+        return JSONResponse(report, status_code=200 if ready else 503)
+
+    @server.get("/metrics")
+    def metrics():
+        return PlainTextResponse(
+            engine.stream_metrics.render(), media_type="text/plain; version=0.0.4"
+        )
+
+    @server.get("/upstreams")
+    def upstreams():
+        return engine.api_router.table()
+
+    server.include_router(create_router(), prefix="/api/v1")
+    return server
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    args = parser.parse_args()
+    uvicorn.run(create_api_server(), host=args.host, port=args.port)
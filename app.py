@@ -1,10 +1,18 @@
-from openai import OpenAI
-from dotenv import load_dotenv
 import os
 import sys
-import threading
-import time
-import gradio as gr
+
+import engine
+from engine import (
+    DEFAULT_PERSISTENT,
+    AppConfig,
+    ConvoState,
+    DynamicState,
+    astream_response,
+    attach_session,
+    decode_persistent,
+    publish_session,
+    stream_response,
+)
 from lang import LANGUAGE_CONFIG
 
 # Force Python unbuffering for real-time streaming
@@ -12,581 +20,349 @@ os.environ['PYTHONUNBUFFERED'] = '1'
 sys.stdout = sys.__stdout__
 sys.stderr = sys.__stderr__
 
-# Environment variable validation
-load_dotenv(override=True)
-required_env_vars = ["API_KEY", "API_URL", "API_MODEL"]
-missing_vars = [var for var in required_env_vars if not os.getenv(var)]
-if missing_vars:
-    raise EnvironmentError(
-        f"Missing required environment variables: {', '.join(missing_vars)}"
+# Assets ship next to this file, whatever the working directory
+ASSET_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def create_app(config=AppConfig):
+    """Build the Gradio UI on an engine configured from config
+
+    Gradio is imported here, so importing this module stays cheap.
+    """
+    import gradio as gr
+
+    engine.configure(config)
+    with open(os.path.join(ASSET_DIR, "aei_logo.svg")) as f:
+        logo = f.read()
+
+    theme = gr.themes.Soft(
+        font="Arial, Helvetica, sans-serif",
+        primary_hue=gr.themes.Color(
+            c50="#e6f2ff",
+            c100="#b3d9ff",
+            c200="#80bfff",
+            c300="#4da6ff",
+            c400="#1a8cff",
+            c500="#0066cc",
+            c600="#0052a3",
+            c700="#003d7a",
+            c800="#002952",
+            c900="#001429",
+            c950="#000a14",
+        ),
+        secondary_hue=gr.themes.Color(
+            c50="#ffe6eb",
+            c100="#ffb3c1",
+            c200="#ff8097",
+            c300="#ff4d6d",
+            c400="#ff1a43",
+            c500="#c41e3a",
+            c600="#a01729",
+            c700="#7d1120",
+            c800="#5a0c17",
+            c900="#37070e",
+            c950="#1b0307",
+        )
+    ).set(
+        body_background_fill="white",
+        body_background_fill_dark="white",
+        background_fill_primary="white",
+        background_fill_primary_dark="white",
+        background_fill_secondary="#f8f9fa",
+        background_fill_secondary_dark="#f8f9fa",
+        body_text_color="#1a1a1a",
+        body_text_color_dark="#1a1a1a"
     )
 
+    with gr.Blocks(theme=theme, css_paths=os.path.join(ASSET_DIR, "styles.css"), title="AEI CoT-Lab") as demo:
+        convo_state = gr.State(ConvoState())
+        dynamic_state = gr.State(DynamicState())
+        persistent_state = gr.BrowserState(DEFAULT_PERSISTENT)
 
-class AppConfig:
-    DEFAULT_THROUGHPUT = 10
-    SYNC_THRESHOLD_DEFAULT = 0
-    API_TIMEOUT = int(os.getenv("TIMEOUT_SECONDS", 120))
-    STREAM_OUTPUT = os.getenv("STREAM_OUTPUT", "true").lower() == "true"
-    MAX_TOKENS = int(os.getenv("MAX_TOKENS", 4096))
-    TEMPERATURE = float(os.getenv("TEMPERATURE", 0.6))
+        bot_default = LANGUAGE_CONFIG["en"]["bot_default"] + [
+            {
+                "role": "assistant",
+                "content": f"🔧 System: Running `{config.API_MODEL}` @ {config.API_URL}",
+                "metadata": {"title": f"AEI System Info"},
+            }
+        ]
+        # No secondary API or language switching - English only
+    
+        # Add AEI logo and header
+        with gr.Row(elem_classes="main-header"):
+            with gr.Column(scale=0):
+                gr.HTML(
+                    f'<div class="aei-logo-container" style="width: 300px; padding: 10px;">{logo}</div>'
+                )
+            with gr.Column(scale=1):
+                title_md = gr.Markdown(
+                    f"{LANGUAGE_CONFIG['en']['title']}",
+                    container=False,
+                )
+            # Language selector removed - English only
+
+        with gr.Row(equal_height=True):
+            with gr.Column(scale=1, min_width=400):
+                prompt_input = gr.Textbox(
+                    label=LANGUAGE_CONFIG["en"]["prompt_label"],
+                    lines=2,
+                    placeholder=LANGUAGE_CONFIG["en"]["prompt_placeholder"],
+                    max_lines=2,
+                )
+                thought_editor = gr.Textbox(
+                    label=f"{LANGUAGE_CONFIG['en']['editor_label']} - {LANGUAGE_CONFIG['en']['editor_default']}",
+                    lines=16,
+                    max_lines=16,
+                    placeholder=LANGUAGE_CONFIG["en"]["editor_placeholder"],
+                    autofocus=True,
+                    elem_id="editor",
+                )
+                with gr.Row():
+                    control_button = gr.Button(
+                        value=LANGUAGE_CONFIG["en"]["generate_btn"], variant="primary"
+                    )
+                    next_turn_btn = gr.Button(
+                        value=LANGUAGE_CONFIG["en"]["clear_btn"], interactive=True
+                    )
+
+            with gr.Column(scale=1, min_width=500):
+                chatbot = gr.Chatbot(
+                    type="messages",
+                    height=300,
+                    value=bot_default,
+                    group_consecutive_messages=False,
+                    show_copy_all_button=True,
+                    show_share_button=True,
+                    label=LANGUAGE_CONFIG["en"]["bot_label"],
+                )
+                with gr.Row():
+                    sync_threshold_slider = gr.Slider(
+                        minimum=0,
+                        maximum=20,
+                        value=config.SYNC_THRESHOLD_DEFAULT,
+                        step=1,
+                        label=LANGUAGE_CONFIG["en"]["sync_threshold_label"],
+                        info=LANGUAGE_CONFIG["en"]["sync_threshold_info"],
+                    )
+                    throughput_control = gr.Slider(
+                        minimum=1,
+                        maximum=100,
+                        value=config.DEFAULT_THROUGHPUT,
+                        step=1,
+                        label=LANGUAGE_CONFIG["en"]["throughput_label"],
+                        info=LANGUAGE_CONFIG["en"]["throughput_info"],
+                    )
+                result_editing_toggle = gr.Checkbox(
+                    label=LANGUAGE_CONFIG["en"]["result_editing_toggle"],
+                    interactive=True,
+                    scale=0,
+                    container=False,
+                )
 
+                intro_md = gr.Markdown(LANGUAGE_CONFIG["en"]["introduction"], visible=False)
 
-class DynamicState:
-    """Dynamic UI state"""
+        @demo.load(inputs=[persistent_state], outputs=[prompt_input, thought_editor])
+        def recover_persistent_state(persistant_state):
+            persistant_state = decode_persistent(persistant_state)
+            if persistant_state["prompt_input"] or persistant_state["thought_editor"]:
+                return persistant_state["prompt_input"], persistant_state["thought_editor"]
+            else:
+                return gr.update(), gr.update()
 
-    def __init__(self):
-        self.should_stream = False
-        self.stream_completed = False
-        self.in_cot = True
-        # English-only interface
-        self.waiting_api = False  # Added waiting state flag
-        self.label_passthrough = False
+        # Interaction logic
+        stateful_ui = (control_button, thought_editor, next_turn_btn)
 
-    def control_button_handler(self):
-        original_state = self.should_stream
-        self.should_stream = not self.should_stream
+        def session_hash(request):
+            # Same for every event of a page, whichever worker serves it
+            return request.session_hash if request is not None else None
 
-        # Activate waiting state when switching from pause to generate
-        if not original_state and self.should_stream:
-            self.waiting_api = True
-            self.stream_completed = False
+        def setting_handler(name):
+            def set_value(val, convo_state_obj, request: gr.Request = None):
+                attach_session(session_hash(request), convo_state_obj)
+                setattr(convo_state_obj, name, val)
+                publish_session(session_hash(request), **{name: val})
 
-        return self.ui_state_controller()
+            set_value.__name__ = f"set_{name}"
+            return set_value
 
-    def ui_state_controller(self):
-        """Generate dynamic UI component states"""
-        # [control_button, thought_editor, reset_button]
-        lang_data = LANGUAGE_CONFIG["en"]
-        control_value = (
-            lang_data["pause_btn"] if self.should_stream else lang_data["generate_btn"]
+        throughput_control.change(
+            setting_handler("throughput"),
+            [throughput_control, convo_state],
+            None,
+            concurrency_limit=None,
         )
-        control_variant = "secondary" if self.should_stream else "primary"
-        # Handle waiting state display
-        if self.waiting_api and self.should_stream:
-            status_suffix = lang_data["waiting_api"]
-        elif self.waiting_api and not self.should_stream:
-            status_suffix = lang_data["api_retry"]
-        else:
-            status_suffix = (
-                lang_data["completed"]
-                if self.stream_completed
-                else lang_data["interrupted"]
-            )
-        editor_label = f"{lang_data['editor_label']} - {status_suffix}"
-        output = (
-            gr.update(value=control_value, variant=control_variant),
-            gr.update() if self.label_passthrough else gr.update(label=editor_label),
-            gr.update(interactive=not self.should_stream),
-        )
-        self.label_passthrough = False
-        return output
-
-    def reset_workspace(self):
-        """Reset workspace state"""
-        self.stream_completed = False
-        self.should_stream = False
-        self.in_cot = True
-        self.waiting_api = False
-
-        return self.ui_state_controller() + (
-            "",
-            "",
-            LANGUAGE_CONFIG["en"]["bot_default"],
-            DEFAULT_PERSISTENT,
-        )
-
 
-class CoordinationManager:
-    """Manage human-AI coordination rhythm"""
+        sync_threshold_slider.change(
+            setting_handler("sync_threshold"),
+            [sync_threshold_slider, convo_state],
+            None,
+            concurrency_limit=None,
+        )
 
-    def __init__(self, paragraph_threshold, initial_content):
-        self.paragraph_threshold = paragraph_threshold
-        self.initial_paragraph_count = initial_content.count("\n\n")
-        self.triggered = False
+        def client_ip(request):
+            return request.client.host if request is not None and request.client else None
 
-    def should_pause_for_human(self, current_content):
-        if self.paragraph_threshold <= 0 or self.triggered:
-            return False
+        def wrap_stream_generator(
+            convo_state_obj, dynamic_state_obj, prompt, content, request: gr.Request = None
+        ):
+            yield from stream_response(
+                convo_state_obj,
+                dynamic_state_obj,
+                prompt,
+                content,
+                client_ip(request),
+                session_hash(request),
+            )
 
-        current_paragraphs = current_content.count("\n\n")
-        if (
-            current_paragraphs - self.initial_paragraph_count
-            >= self.paragraph_threshold
+        async def wrap_stream_generator_async(
+            convo_state_obj, dynamic_state_obj, prompt, content, request: gr.Request = None
         ):
-            self.triggered = True
-            return True
-        return False
-
-
-class ConvoState:
-    """State of current ROUND of convo"""
-
-    def __init__(self):
-        self.throughput = AppConfig.DEFAULT_THROUGHPUT
-        self.sync_threshold = AppConfig.SYNC_THRESHOLD_DEFAULT
-        # English-only interface
-        self.convo = []
-        self.initialize_new_round()
-        self.is_error = False
-        self.result_editing_toggle = False
-        self.is_seperate_reasoning = False
-        self.in_seperate_reasoning = False
-
-    def get_api_config(self, language):
-        # Always use primary API since we're English-only now
-        return {
-            "key": os.getenv("API_KEY"),
-            "url": os.getenv("API_URL"),
-            "model": os.getenv("API_MODEL"),
-        }
-
-    def initialize_new_round(self):
-        self.current = {}
-        self.current["user"] = ""
-        self.current["cot"] = ""
-        self.current["result"] = ""
-        self.current["raw"] = ""
-        self.convo.append(self.current)
-
-    def flatten_output(self):
-        output = []
-        for round in self.convo:
-            output.append({"role": "user", "content": round["user"]})
-            if len(round["cot"]) > 0:
-                output.append(
-                    {
-                        "role": "assistant",
-                        "content": round["cot"],
-                        "metadata": {"title": f"Chain of Thought"},
-                    }
-                )
-            if len(round["result"]) > 0:
-                output.append({"role": "assistant", "content": round["result"]})
-        return output
-
-    def generate_ai_response(self, user_prompt, current_content, dynamic_state):
-        lang_data = LANGUAGE_CONFIG["en"]
-        dynamic_state.stream_completed = False
-        full_response = current_content
-        self.current["raw"] = full_response
-        api_config = self.get_api_config("en")
-        api_client = OpenAI(
-            api_key=api_config["key"],
-            base_url=api_config["url"],
-            timeout=AppConfig.API_TIMEOUT,
+            async for update in astream_response(
+                convo_state_obj,
+                dynamic_state_obj,
+                prompt,
+                content,
+                client_ip(request),
+                session_hash(request),
+            ):
+                yield update
+
+        # Async streams wait on the event loop instead of pinning a worker thread,
+        # so every stream event shares one generous concurrency pool
+        stream_handler = (
+            wrap_stream_generator_async
+            if config.ASYNC_STREAMING
+            else wrap_stream_generator
         )
 
-        coordinator = CoordinationManager(self.sync_threshold, current_content)
-
-        editor_output = current_content
-
-        try:
-            # Initial waiting state update - use gr.update to preserve component
-            if dynamic_state.waiting_api:
-                status = lang_data["waiting_api"]
-                editor_label = f"{lang_data['editor_label']} - {status}"
-                yield gr.update(value=full_response, label=editor_label), self.flatten_output()
-
-            coordinator = CoordinationManager(self.sync_threshold, current_content)
-            messages = [
-                {"role": "user", "content": user_prompt},
-                {
-                    "role": "assistant",
-                    "content": f"<think>\n{current_content}",
-                    "prefix": True,
-                },
-            ]
-            self.current["user"] = user_prompt
-            response_stream = api_client.chat.completions.create(
-                model=os.getenv("API_MODEL"),
-                messages=messages,
-                stream=True,
-                timeout=AppConfig.API_TIMEOUT,
-                top_p=0.95,
-                temperature=AppConfig.TEMPERATURE,
-                max_tokens=AppConfig.MAX_TOKENS,
-            )
-            
-            # Buffer for accumulating chunks to reduce update frequency
-            chunk_buffer = ""
-            update_interval = 0.1  # Update every 100ms
-            last_update_time = time.time()
-            
-            for chunk in response_stream:
-                if not dynamic_state.should_stream:
-                    break
-                    
-                chunk_content = ""
-                if hasattr(chunk.choices[0].delta, "reasoning_content") and chunk.choices[0].delta.reasoning_content:
-                    chunk_content = chunk.choices[0].delta.reasoning_content
-                    self.is_seperate_reasoning = True
-                    self.in_seperate_reasoning = True
-                elif chunk.choices[0].delta.content:
-                    chunk_content = chunk.choices[0].delta.content
-                    if self.in_seperate_reasoning:
-                        chunk_content = "</think>" + chunk_content
-                    self.in_seperate_reasoning = False
-
-                if chunk_content:
-                    dynamic_state.waiting_api = False
-                    chunk_buffer += chunk_content.replace("<think>", "")
-                    
-                    # Update UI at intervals or when buffer is large
-                    current_time = time.time()
-                    if (current_time - last_update_time >= update_interval) or len(chunk_buffer) > 100:
-                        full_response += chunk_buffer
-                        self.current["raw"] = full_response
-                        chunk_buffer = ""
-                        last_update_time = current_time
-                        
-                        # Update Convo State
-                        think_complete = "</think>" in full_response
-                        dynamic_state.in_cot = not think_complete
-                        if think_complete:
-                            self.current["cot"], self.current["result"] = full_response.split("</think>")
-                        else:
-                            self.current["cot"], self.current["result"] = full_response, ""
-                        
-                        # Check if should pause
-                        if coordinator.should_pause_for_human(full_response) and dynamic_state.in_cot:
-                            dynamic_state.should_stream = False
-                        
-                        status = (
-                            lang_data["loading_thinking"]
-                            if dynamic_state.in_cot
-                            else lang_data["loading_output"]
-                        )
-                        editor_label = f"{lang_data['editor_label']} - {status}"
-                        
-                        if self.result_editing_toggle:
-                            editor_output = full_response
-                        else:
-                            editor_output = self.current["cot"] + ("</think>" if think_complete else "")
-                        
-                        # Use gr.update to preserve component and update both value and label
-                        yield gr.update(value=editor_output, label=editor_label), self.flatten_output()
-                        
-                        # Apply throughput control if enabled
-                        if self.throughput < 50 and dynamic_state.in_cot:
-                            time.sleep(1.0 / self.throughput)
-            
-            # Final update with any remaining buffer
-            if chunk_buffer and dynamic_state.should_stream:
-                full_response += chunk_buffer
-                self.current["raw"] = full_response
-                
-                think_complete = "</think>" in full_response
-                if think_complete:
-                    self.current["cot"], self.current["result"] = full_response.split("</think>")
-                else:
-                    self.current["cot"], self.current["result"] = full_response, ""
-                
-                if self.result_editing_toggle:
-                    editor_output = full_response
-                else:
-                    editor_output = self.current["cot"] + ("</think>" if think_complete else "")
-                
-                status = lang_data["loading_thinking"] if dynamic_state.in_cot else lang_data["loading_output"]
-                editor_label = f"{lang_data['editor_label']} - {status}"
-                yield gr.update(value=editor_output, label=editor_label), self.flatten_output()
-
-        except Exception as e:
-            if str(e) == "list index out of range":
-                dynamic_state.stream_completed = True
-            else:
-                if str(e) == "The read operation timed out":
-                    error_msg = lang_data["api_interrupted"]
-                else:
-                    error_msg = "❓ " + str(e)
-                editor_label_error = f"{lang_data['editor_label']} - {error_msg}"
-                self.is_error = True
-                dynamic_state.label_passthrough = True
-
-        finally:
-            dynamic_state.should_stream = False
-            if "response_stream" in locals():
-                response_stream.close()
-            final_status = (
-                lang_data["completed"]
-                if dynamic_state.stream_completed
-                else lang_data["interrupted"]
-            )
-            editor_label = f"{lang_data['editor_label']} - {final_status}"
-            if not self.is_error:
-                yield gr.update(value=editor_output, label=editor_label), self.flatten_output()
-            else:
-                yield gr.update(value=editor_output, label=editor_label_error), self.flatten_output() + [
-                    {
-                        "role": "assistant",
-                        "content": error_msg,
-                        "metadata": {"title": f"❌Error"},
-                    }
-                ]
-            self.is_error = False
-
-
-# Language update function removed - English only interface
-
-
-theme = gr.themes.Soft(
-    font="Arial, Helvetica, sans-serif",
-    primary_hue=gr.themes.Color(
-        c50="#e6f2ff",
-        c100="#b3d9ff",
-        c200="#80bfff",
-        c300="#4da6ff",
-        c400="#1a8cff",
-        c500="#0066cc",
-        c600="#0052a3",
-        c700="#003d7a",
-        c800="#002952",
-        c900="#001429",
-        c950="#000a14",
-    ),
-    secondary_hue=gr.themes.Color(
-        c50="#ffe6eb",
-        c100="#ffb3c1",
-        c200="#ff8097",
-        c300="#ff4d6d",
-        c400="#ff1a43",
-        c500="#c41e3a",
-        c600="#a01729",
-        c700="#7d1120",
-        c800="#5a0c17",
-        c900="#37070e",
-        c950="#1b0307",
-    )
-).set(
-    body_background_fill="white",
-    body_background_fill_dark="white",
-    background_fill_primary="white",
-    background_fill_primary_dark="white",
-    background_fill_secondary="#f8f9fa",
-    background_fill_secondary_dark="#f8f9fa",
-    body_text_color="#1a1a1a",
-    body_text_color_dark="#1a1a1a"
-)
-
-with gr.Blocks(theme=theme, css_paths="styles.css", title="AEI CoT-Lab") as demo:
-    DEFAULT_PERSISTENT = {"prompt_input": "", "thought_editor": ""}
-    convo_state = gr.State(ConvoState())
-    dynamic_state = gr.State(DynamicState())
-    persistent_state = gr.BrowserState(DEFAULT_PERSISTENT)
-
-    bot_default = LANGUAGE_CONFIG["en"]["bot_default"] + [
-        {
-            "role": "assistant",
-            "content": f"🔧 System: Running `{os.getenv('API_MODEL')}` @ {os.getenv('API_URL')}",
-            "metadata": {"title": f"AEI System Info"},
-        }
-    ]
-    # No secondary API or language switching - English only
+        def handle_control_button(dynamic_state_obj, request: gr.Request = None):
+            attach_session(session_hash(request), dynamic_state=dynamic_state_obj)
+            output = dynamic_state_obj.control_button_handler()
+            publish_session(session_hash(request), dynamic_state=dynamic_state_obj)
+            return output
     
-    # Add AEI logo and header
-    with gr.Row(elem_classes="main-header"):
-        with gr.Column(scale=0):
-            gr.HTML("""
-                <div class="aei-logo-container" style="width: 300px; padding: 10px;">
-                    <svg viewBox="0 0 560 113" fill="none" xmlns="http://www.w3.org/2000/svg" style="width: 100%; height: auto;">
-                        <path d="M33.035 56h-5.453l-2.788-8.303H8.684L5.833 56H.441l12.95-37.178h6.693L33.035 56Zm-9.852-13.074-6.444-18.9-6.445 18.9h12.889ZM71.292 56h-4.957V26.444l-9.729 19.952H53.26l-9.604-19.953V56h-5.02V18.822h6.445l9.914 20.262 9.976-20.262h6.32V56Zm31.658 0H80.147V18.822h22.803v4.833H85.228v11.34h16.731v4.833h-16.73v11.339h17.721V56Zm36.728 0h-5.514l-8.737-15.49h-8.551V56h-5.081V18.822h17.473c1.426 0 3.037.496 4.152 1.301.868.62 2.788 2.54 3.284 3.284a6.54 6.54 0 0 1 1.053 3.532v5.577c0 1.24-.371 2.416-1.053 3.47-.496.743-2.416 2.664-3.284 3.284-.744.558-1.921 1.053-2.788 1.115L139.678 56Zm-7.002-23.608v-5.329c0-.124 0-.62-.062-.681-.371-.682-2.168-2.665-3.036-2.727h-12.702v12.021h12.331c1.115 0 2.974-1.735 3.407-2.602.062-.124.062-.558.062-.682ZM152.455 56h-5.081V18.822h5.081V56Zm34.926-7.931c-.434 1.115-1.053 2.354-1.735 3.222-1.797 2.23-4.399 5.019-7.622 5.019h-8.179c-1.177 0-2.602-.496-3.594-1.054-1.239-.743-3.717-3.222-4.461-4.337-.682-.991-.929-2.169-.929-3.284V27.187c0-1.115.247-2.23.929-3.222.744-1.053 3.222-3.656 4.461-4.4.992-.557 2.355-1.053 3.532-1.053h8.241c3.223 0 5.887 2.727 7.622 5.02.496.619.991 1.548 1.735 3.16l-4.957 1.424c-.682-1.982-2.665-3.841-4.09-4.709 0 0-.248-.062-.495-.062h-7.746a1.24 1.24 0 0 0-.558.124c-.867.434-2.664 2.107-3.408 3.346-.123.186-.123.496-.123.806v19.952c0 1.053 2.54 3.284 3.531 3.78.124.062.31.124.558.124h7.746c.247 0 .495-.062.619-.124 1.363-.744 3.284-2.665 3.966-4.586l4.957 1.302ZM224.25 56h-5.453l-2.788-8.303h-16.111L197.048 56h-5.391l12.951-37.178h6.692L224.25 56Zm-9.852-13.074-6.444-18.9-6.445 18.9h12.889ZM256.372 56h-5.886l-15.615-28.38V56h-5.019V18.822h6.01l15.491 28.689V18.822h5.019V56Zm46.083 0h-22.802V18.822h22.802v4.833h-17.721v11.34h16.73v4.833h-16.73v11.339h17.721V56Zm34.807-8.613c0 1.115-.185 2.23-.867 3.222-.744 1.115-3.222 3.594-4.461 4.338-.992.557-2.355 1.053-3.532 1.053H311.3V18.822h17.102c1.115 0 2.54.372 3.532.991 1.239.744 3.717 3.408 4.461 4.462.682.991.867 2.107.867 3.222v19.89Zm-5.081-.124V27.621c0-.248 0-.372-.061-.496-.62-1.301-2.665-2.974-3.594-3.408-.124-.062-.186-.062-.434-.062h-11.711v27.512h11.711c.248 0 .372-.062.434-.062.991-.496 3.655-2.788 3.655-3.842Zm39.872.434c0 1.115-.185 2.23-.867 3.222-.744 1.115-3.222 3.594-4.461 4.337-.992.558-2.355 1.054-3.532 1.054h-8.303c-1.178 0-2.603-.496-3.594-1.054-1.24-.743-3.718-3.222-4.462-4.337-.681-.991-.929-2.107-.929-3.222V18.822h5.081v28.751c0 .93 2.788 3.346 3.718 3.78a.96.96 0 0 0 .495.124h7.684c.248 0 .434-.062.558-.124.929-.434 3.531-2.913 3.531-3.78V18.822h5.081v28.875Zm34.62.372c-.434 1.115-1.053 2.354-1.735 3.222-1.797 2.23-4.399 5.019-7.621 5.019h-8.18c-1.177 0-2.602-.496-3.593-1.054-1.24-.743-3.718-3.222-4.462-4.337-.681-.991-.929-2.169-.929-3.284V27.187c0-1.115.248-2.23.929-3.222.744-1.053 3.222-3.656 4.462-4.4.991-.557 2.354-1.053 3.531-1.053h8.242c3.222 0 5.886 2.727 7.621 5.02.496.619.991 1.548 1.735 3.16l-4.957 1.424c-.682-1.982-2.664-3.841-4.09-4.709 0 0-.247-.062-.495-.062h-7.746c-.248 0-.433.062-.557.124-.868.434-2.665 2.107-3.408 3.346-.124.186-.124.496-.124.806v19.952c0 1.053 2.54 3.284 3.532 3.78.124.062.309.124.557.124h7.746c.248 0 .495-.062.619-.124 1.364-.744 3.284-2.665 3.966-4.586l4.957 1.302ZM443.542 56h-5.453l-2.788-8.303h-16.11L416.34 56h-5.391L423.9 18.822h6.692L443.542 56Zm-9.852-13.074-6.444-18.9-6.444 18.9h12.888Zm35.991-19.27h-10.596V56h-5.081V23.655h-10.596v-4.833h26.273v4.833ZM481.696 56h-5.081V18.822h5.081V56Zm36.165-8.365c0 1.115-.248 2.293-.93 3.284-.743 1.115-3.222 3.594-4.461 4.337-.991.558-2.416 1.054-3.594 1.054h-9.79c-1.177 0-2.54-.496-3.532-1.054-1.239-.743-3.78-3.222-4.523-4.337-.682-.991-.868-2.23-.868-3.284V27.249c0-1.053.186-2.293.868-3.284.743-1.115 3.284-3.656 4.523-4.4.992-.557 2.355-1.053 3.532-1.053h9.79c1.178 0 2.603.496 3.594 1.054 1.239.743 3.718 3.346 4.461 4.399.682.991.93 2.169.93 3.284v20.386Zm-5.081-.062v-20.2c0-.248-.062-.434-.124-.558-.682-1.239-2.541-2.912-3.408-3.346a1.24 1.24 0 0 0-.558-.124h-9.294a1.24 1.24 0 0 0-.558.124c-.991.496-3.594 2.85-3.594 3.904v20.2c0 .93 2.665 3.346 3.594 3.78.124.062.31.124.558.124h9.294c.248 0 .434-.062.558-.124.991-.496 3.532-2.727 3.532-3.78ZM552.876 56h-5.886l-15.615-28.38V56h-5.019V18.822h6.011l15.49 28.689V18.822h5.019V56ZM309.56 112h-5.081V74.822h5.081V112Zm35.297 0h-5.886l-15.615-28.38V112h-5.019V74.822h6.01l15.491 28.689V74.822h5.019V112Zm36.267-8.365c0 1.053-.186 2.293-.868 3.284-.743 1.115-3.284 3.594-4.523 4.337-.991.558-2.355 1.054-3.532 1.054h-10.348c-3.284 0-5.948-2.727-7.683-5.019-.496-.682-.93-1.611-1.673-3.222l4.895-1.302.557 1.116c.806 1.425 2.603 2.974 3.532 3.47.248.124.434.124.558.124h9.914c.186 0 .372-.062.496-.124.991-.496 3.594-2.727 3.594-3.78v-3.78c0-.991-.682-1.92-1.425-2.107l-16.854-4.337c-2.851-.743-4.4-3.594-4.4-6.32v-3.78c0-1.053.186-2.293.868-3.284.743-1.115 3.284-3.656 4.523-4.4.991-.557 2.355-1.053 3.532-1.053h9.109c3.222 0 5.886 2.727 7.621 5.02.496.619.991 1.548 1.735 3.16l-4.957 1.425-.62-1.24c-.681-1.363-2.602-2.974-3.532-3.47 0 0-.185-.062-.433-.062h-8.613c-.248 0-.372.062-.558.124-.929.434-3.594 2.85-3.594 3.78v3.532c0 .93.62 1.797 1.363 1.983l16.792 4.461c2.789.744 4.524 3.47 4.524 6.197v4.213Zm32.178-23.98h-10.596V112h-5.081V79.655H387.03v-4.833h26.272v4.833ZM425.317 112h-5.081V74.822h5.081V112Zm33.005-32.345h-10.595V112h-5.081V79.655H432.05v-4.833h26.272v4.833Zm32.835 24.042c0 1.115-.186 2.231-.867 3.222-.744 1.115-3.222 3.594-4.462 4.337-.991.558-2.354 1.054-3.532 1.054h-8.303c-1.177 0-2.602-.496-3.594-1.054-1.239-.743-3.717-3.222-4.461-4.337-.682-.991-.929-2.107-.929-3.222V74.822h5.081v28.751c0 .929 2.788 3.346 3.717 3.78a.96.96 0 0 0 .496.124h7.684c.247 0 .433-.062.557-.124.93-.434 3.532-2.912 3.532-3.78V74.822h5.081v28.875Zm32.699-24.042H513.26V112h-5.081V79.655h-10.596v-4.833h26.273v4.833ZM553.654 112h-22.802V74.822h22.802v4.833h-17.721v11.34h16.73v4.833h-16.73v11.339h17.721V112Z" fill="#070A1D"/>
-                        <path fill="#CC000F" d="M64 76h223v12H64zm-12 0H40v12h12z"/>
-                        <path fill="#1C5F9D" d="M101 100h186v12H101zm-12 0H77v12h12z"/>
-                    </svg>
-                </div>
-            """)
-        with gr.Column(scale=1):
-            title_md = gr.Markdown(
-                f"{LANGUAGE_CONFIG['en']['title']}",
-                container=False,
-            )
-        # Language selector removed - English only
-
-    with gr.Row(equal_height=True):
-        with gr.Column(scale=1, min_width=400):
-            prompt_input = gr.Textbox(
-                label=LANGUAGE_CONFIG["en"]["prompt_label"],
-                lines=2,
-                placeholder=LANGUAGE_CONFIG["en"]["prompt_placeholder"],
-                max_lines=2,
-            )
-            thought_editor = gr.Textbox(
-                label=f"{LANGUAGE_CONFIG['en']['editor_label']} - {LANGUAGE_CONFIG['en']['editor_default']}",
-                lines=16,
-                max_lines=16,
-                placeholder=LANGUAGE_CONFIG["en"]["editor_placeholder"],
-                autofocus=True,
-                elem_id="editor",
-            )
-            with gr.Row():
-                control_button = gr.Button(
-                    value=LANGUAGE_CONFIG["en"]["generate_btn"], variant="primary"
-                )
-                next_turn_btn = gr.Button(
-                    value=LANGUAGE_CONFIG["en"]["clear_btn"], interactive=True
-                )
+        def handle_ui_state(dynamic_state_obj, request: gr.Request = None):
+            attach_session(session_hash(request), dynamic_state=dynamic_state_obj)
+            output = dynamic_state_obj.ui_state_controller()
+            publish_session(session_hash(request), label_passthrough=False)
+            return output
+    
+        # Use streaming with proper configuration
+        control_button.click(
+            handle_control_button,
+            [dynamic_state],
+            stateful_ui,
+            show_progress=False,
+            queue=False,
+        ).then(
+            stream_handler,
+            [convo_state, dynamic_state, prompt_input, thought_editor],
+            [thought_editor, chatbot, persistent_state],
+            show_progress=False,
+            concurrency_limit=config.STREAM_CONCURRENCY,
+            concurrency_id="stream",
+        ).then(
+            handle_ui_state,
+            [dynamic_state],
+            stateful_ui,
+            show_progress=False,
+            queue=False,
+        )
+    
+        # Add submit handlers
+        prompt_input.submit(
+            handle_control_button,
+            [dynamic_state],
+            stateful_ui,
+            show_progress=False,
+            queue=False,
+        ).then(
+            stream_handler,
+            [convo_state, dynamic_state, prompt_input, thought_editor],
+            [thought_editor, chatbot, persistent_state],
+            show_progress=False,
+            concurrency_limit=config.STREAM_CONCURRENCY,
+            concurrency_id="stream",
+        ).then(
+            handle_ui_state,
+            [dynamic_state],
+            stateful_ui,
+            show_progress=False,
+            queue=False,
+        )
+    
+        thought_editor.submit(
+            handle_control_button,
+            [dynamic_state],
+            stateful_ui,
+            show_progress=False,
+            queue=False,
+        ).then(
+            stream_handler,
+            [convo_state, dynamic_state, prompt_input, thought_editor],
+            [thought_editor, chatbot, persistent_state],
+            show_progress=False,
+            concurrency_limit=config.STREAM_CONCURRENCY,
+            concurrency_id="stream",
+        ).then(
+            handle_ui_state,
+            [dynamic_state],
+            stateful_ui,
+            show_progress=False,
+            queue=False,
+        )
 
-        with gr.Column(scale=1, min_width=500):
-            chatbot = gr.Chatbot(
-                type="messages",
-                height=300,
-                value=bot_default,
-                group_consecutive_messages=False,
-                show_copy_all_button=True,
-                show_share_button=True,
-                label=LANGUAGE_CONFIG["en"]["bot_label"],
-            )
-            with gr.Row():
-                sync_threshold_slider = gr.Slider(
-                    minimum=0,
-                    maximum=20,
-                    value=AppConfig.SYNC_THRESHOLD_DEFAULT,
-                    step=1,
-                    label=LANGUAGE_CONFIG["en"]["sync_threshold_label"],
-                    info=LANGUAGE_CONFIG["en"]["sync_threshold_info"],
-                )
-                throughput_control = gr.Slider(
-                    minimum=1,
-                    maximum=100,
-                    value=AppConfig.DEFAULT_THROUGHPUT,
-                    step=1,
-                    label=LANGUAGE_CONFIG["en"]["throughput_label"],
-                    info=LANGUAGE_CONFIG["en"]["throughput_info"],
-                )
-            result_editing_toggle = gr.Checkbox(
-                label=LANGUAGE_CONFIG["en"]["result_editing_toggle"],
-                interactive=True,
-                scale=0,
-                container=False,
-            )
+        def handle_reset(dynamic_state_obj, convo_state_obj, request: gr.Request = None):
+            attach_session(session_hash(request), convo_state_obj, dynamic_state_obj)
+            convo_state_obj.discard_prefetch()
+            convo_state_obj.discard_candidates()
+            convo_state_obj.next_round()
+            output = dynamic_state_obj.reset_workspace()
+            publish_session(session_hash(request), convo_state_obj, dynamic_state_obj)
+            return output
+    
+        next_turn_btn.click(
+            handle_reset,
+            [dynamic_state, convo_state],
+            stateful_ui + (thought_editor, prompt_input, chatbot, persistent_state),
+            concurrency_limit=None,
+            show_progress=False,
+        )
 
-            intro_md = gr.Markdown(LANGUAGE_CONFIG["en"]["introduction"], visible=False)
+        def toggle_editor_result(convo_state, allow, request: gr.Request = None):
+            attach_session(session_hash(request), convo_state)
+            setattr(convo_state, "result_editing_toggle", allow)
+            publish_session(session_hash(request), result_editing_toggle=allow)
+            if allow:
+                return gr.update(value=convo_state.current.raw)
+            else:
+                return gr.update(value=convo_state.current.cot)
 
-    @demo.load(inputs=[persistent_state], outputs=[prompt_input, thought_editor])
-    def recover_persistent_state(persistant_state):
-        if persistant_state["prompt_input"] or persistant_state["thought_editor"]:
-            return persistant_state["prompt_input"], persistant_state["thought_editor"]
-        else:
-            return gr.update(), gr.update()
+        result_editing_toggle.change(
+            toggle_editor_result,
+            inputs=[convo_state, result_editing_toggle],
+            outputs=[thought_editor],
+        )
 
-    # Interaction logic
-    stateful_ui = (control_button, thought_editor, next_turn_btn)
+        # Language selector removed - English only interface
 
-    throughput_control.change(
-        lambda val, s: setattr(s, "throughput", val),
-        [throughput_control, convo_state],
-        None,
-        concurrency_limit=None,
-    )
+    return demo
 
-    sync_threshold_slider.change(
-        lambda val, s: setattr(s, "sync_threshold", val),
-        [sync_threshold_slider, convo_state],
-        None,
-        concurrency_limit=None,
-    )
 
-    def wrap_stream_generator(convo_state_obj, dynamic_state_obj, prompt, content):
-        for thought_editor_update, chatbot_messages in convo_state_obj.generate_ai_response(
-            prompt, content, dynamic_state_obj
-        ):
-            # Yield the gr.update object directly for thought_editor
-            yield thought_editor_update, chatbot_messages, {
-                "prompt_input": convo_state_obj.current["user"],
-                "thought_editor": convo_state_obj.current["cot"],
-            }
+def create_server(demo):
+    """FastAPI app serving the Gradio UI next to the headless API, /metrics and /upstreams"""
+    import gradio as gr
 
-    def handle_control_button(dynamic_state_obj):
-        return dynamic_state_obj.control_button_handler()
-    
-    def handle_ui_state(dynamic_state_obj):
-        return dynamic_state_obj.ui_state_controller()
-    
-    # Use streaming with proper configuration
-    control_button.click(
-        handle_control_button,
-        [dynamic_state],
-        stateful_ui,
-        show_progress=False,
-        queue=False,
-    ).then(
-        wrap_stream_generator,
-        [convo_state, dynamic_state, prompt_input, thought_editor],
-        [thought_editor, chatbot, persistent_state],
-        show_progress=False,
-    ).then(
-        handle_ui_state,
-        [dynamic_state],
-        stateful_ui,
-        show_progress=False,
-        queue=False,
-    )
-    
-    # Add submit handlers
-    prompt_input.submit(
-        handle_control_button,
-        [dynamic_state],
-        stateful_ui,
-        show_progress=False,
-        queue=False,
-    ).then(
-        wrap_stream_generator,
-        [convo_state, dynamic_state, prompt_input, thought_editor],
-        [thought_editor, chatbot, persistent_state],
-        show_progress=False,
-    ).then(
-        handle_ui_state,
-        [dynamic_state],
-        stateful_ui,
-        show_progress=False,
-        queue=False,
-    )
-    
-    thought_editor.submit(
-        handle_control_button,
-        [dynamic_state],
-        stateful_ui,
-        show_progress=False,
-        queue=False,
-    ).then(
-        wrap_stream_generator,
-        [convo_state, dynamic_state, prompt_input, thought_editor],
-        [thought_editor, chatbot, persistent_state],
-        show_progress=False,
-    ).then(
-        handle_ui_state,
-        [dynamic_state],
-        stateful_ui,
-        show_progress=False,
-        queue=False,
-    )
+    from api import create_api_server
 
-    def handle_reset(dynamic_state_obj):
-        return dynamic_state_obj.reset_workspace()
-    
-    next_turn_btn.click(
-        handle_reset,
-        [dynamic_state],
-        stateful_ui + (thought_editor, prompt_input, chatbot, persistent_state),
-        concurrency_limit=None,
-        show_progress=False,
-    )
+    return gr.mount_gradio_app(create_api_server(engine.config), demo, path="/")
 
-    def toggle_editor_result(convo_state, allow):
-        setattr(convo_state, "result_editing_toggle", allow)
-        if allow:
-            return gr.update(value=convo_state.current["raw"])
-        else:
-            return gr.update(value=convo_state.current["cot"])
-
-    result_editing_toggle.change(
-        toggle_editor_result,
-        inputs=[convo_state, result_editing_toggle],
-        outputs=[thought_editor],
-    )
-
-    # Language selector removed - English only interface
 
 if __name__ == "__main__":
+    import uvicorn
+
+    demo = create_app()
     # Enable streaming with queue
-    demo.queue(max_size=50, api_open=False)
-    demo.launch(server_name="127.0.0.1", server_port=7860, share=False)
\ No newline at end of file
+    # Admission and fairness are handled by the scheduler, not by rejections
+    demo.queue(max_size=AppConfig.QUEUE_MAX_SIZE or None, api_open=False)
+    uvicorn.run(create_server(demo), host="127.0.0.1", port=7860)
\ No newline at end of file
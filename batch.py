@@ -0,0 +1,205 @@
+"""Offline batch generation from a JSONL file of prompts
+
+Each input line is a JSON object with a prompt, and optionally an id and a
+thought to continue from:
+
+    {"id": "algebra-1", "prompt": "Solve 2x + 3 = 7", "thought": "Subtract 3"}
+
+Every prompt runs unpaced through the same async streaming pipeline as the
+UI, with upstream retries, failover and admission as configured. One result
+line per prompt is appended to the output as soon as it finishes. Prompts
+whose id already has a successful result line are skipped, so an
+interrupted batch is resumed by running the same command again.
+
+    python batch.py prompts.jsonl results.jsonl --concurrency 16 --rate 5
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import engine
+from engine import AppConfig, ConvoState, DynamicState
+from upstream import RetryPolicy
+
+
+def batch_config(concurrency):
+    """AppConfig for unattended runs with concurrency streams in flight"""
+
+    class BatchConfig(AppConfig):
+        STREAM_OUTPUT = False
+        HISTORY_MAX_ROUNDS = 0
+        SESSION_IDLE_SECONDS = 0
+        SHARED_SESSIONS = False
+        REROLL_CANDIDATES = 0
+        # Nobody resumes a paused item, it would be written out as failed
+        SYNC_THRESHOLD_DEFAULT = 0
+        PAUSE_RULES = ""
+        MAX_UPSTREAM_STREAMS = concurrency
+        POOL_MAX_CONNECTIONS = max(AppConfig.POOL_MAX_CONNECTIONS, concurrency)
+        POOL_MAX_KEEPALIVE = max(AppConfig.POOL_MAX_KEEPALIVE, concurrency)
+
+    return BatchConfig
+
+
+class RateLimiter:
+    """Spaces request starts 1/rate seconds apart, no limit for rate 0"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0.0
+        self.next_start = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+def read_items(path):
+    with open(path, encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            if line.strip():
+                item = json.loads(line)
+                item.setdefault("id", str(line_number))
+                yield item
+
+
+def finished_ids(path):
+    """Ids with a successful result line, skipped when a batch is resumed"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Cut short by an interrupted write
+                continue
+            if record.get("error") is None:
+                done.add(str(record["id"]))
+    return done
+
+
+def open_output(path):
+    """Append handle on path, starting on a fresh line after a torn write"""
+    torn = False
+    if os.path.exists(path) and os.path.getsize(path):
+        with open(path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            torn = f.read(1) != b"\n"
+    output = open(path, "a", encoding="utf-8")
+    if torn:
+        output.write("\n")
+    return output
+
+
+async def generate(prompt, thought=""):
+    """Run one prompt through the streaming pipeline, unpaced"""
+    convo_state, dynamic_state = ConvoState(), DynamicState()
+    convo_state.throughput = None
+    dynamic_state.control_button_handler()
+    started = time.perf_counter()
+    first_token = None
+    async for editor_update, _ in convo_state.agenerate_ai_response(
+        prompt, thought, dynamic_state
+    ):
+        if first_token is None and len(editor_update.get("value") or "") > len(thought):
+            first_token = time.perf_counter()
+    finished = time.perf_counter()
+    current = convo_state.current
+    run = convo_state.last_run
+    return {
+        "prompt": prompt,
+        "thought": thought,
+        "cot": current.cot,
+        "result": current.result,
+        "think_complete": current.think_complete,
+        "error": None if run["outcome"] == "completed" else run["error"] or run["outcome"],
+        "timings": {
+            "ttft_ms": round((first_token - started) * 1000, 1) if first_token else None,
+            "duration_ms": round((finished - started) * 1000, 1),
+        },
+        "usage": run["usage"],
+        "tokens": run["tokens_in"],
+        "source": run["source"],
+        "endpoints": run["endpoints"],
+    }
+
+
+async def generate_item(item, limiter, policy):
+    """generate() with whole-item retries continuing from the partial thought"""
+    thought = item.get("thought", "")
+    attempt = 0
+    while True:
+        await limiter.wait()
+        record = await generate(item["prompt"], thought)
+        if record["error"] is None or attempt >= policy.retries:
+            break
+        if not record["think_complete"]:
+            thought = record["cot"]
+        await asyncio.sleep(policy.delay(attempt))
+        attempt += 1
+    record.update(id=item["id"], thought=item.get("thought", ""), attempts=attempt + 1)
+    return record
+
+
+async def run_batch(items, output, concurrency=8, rate=0.0, retries=1):
+    """Generate items with at most concurrency in flight, appending to output
+
+    Returns counts of completed and failed items.
+    """
+    limiter = RateLimiter(rate)
+    policy = RetryPolicy(retries, engine.config.RETRY_BASE_DELAY, engine.config.RETRY_MAX_DELAY)
+    items = iter(items)
+    stats = {"completed": 0, "failed": 0}
+
+    async def worker():
+        # One shared iterator, so a worker takes the next item once it is free
+        for item in items:
+            record = await generate_item(item, limiter, policy)
+            output.write(json.dumps(record, ensure_ascii=False) + "\n")
+            output.flush()
+            stats["completed" if record["error"] is None else "failed"] += 1
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return stats
+
+
+def main(args):
+    engine.configure(batch_config(args.concurrency))
+    done = finished_ids(args.output)
+    items = (item for item in read_items(args.input) if str(item["id"]) not in done)
+    started = time.perf_counter()
+    with open_output(args.output) as output:
+        try:
+            stats = asyncio.run(
+                run_batch(items, output, args.concurrency, args.rate, args.retries)
+            )
+        except KeyboardInterrupt:
+            print("Interrupted, run the same command again to resume")
+            return
+    elapsed = time.perf_counter() - started
+    total = stats["completed"] + stats["failed"]
+    print(
+        f"{stats['completed']} completed, {stats['failed']} failed, "
+        f"{len(done)} skipped as already done, "
+        f"{elapsed:.1f}s ({total / elapsed if elapsed else 0:.2f} prompts/s)"
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--concurrency", type=int, default=8, help="Prompts generated at once")
+    parser.add_argument("--rate", type=float, default=0.0, help="Request starts per second, 0 for no limit")
+    parser.add_argument(
+        "--retries", type=int, default=1, help="Reruns of a failed prompt after the upstream retries"
+    )
+    main(parser.parse_args())
@@ -0,0 +1,637 @@
+"""End-to-end latency benchmarks for the streaming hot path
+
+Starts mock_server.py on a local port and drives the app against it:
+
+    engine       sync and async wrap_stream_generator, one session at a time:
+                 time-to-first-token, CPU per yield, bytes per update
+    memory       traced memory held per finished session, and the chat
+                 messages one session retains over --history-rounds rounds
+    concurrency  paced sessions at each --sessions level: TTFT and event-loop
+                 lag, reporting the largest level within --max-lag/--max-ttft
+    gradio       sessions through the Gradio queue endpoint: TTFT, SSE bytes,
+                 server CPU per session
+    api          the same sessions through the headless SSE API
+    routing      concurrent sessions over a pool of healthy, slow, dropping
+                 and unreachable endpoints: completion, TTFT, routing table
+    batch        batch.py over --batch-prompts prompts at each
+                 --batch-concurrency level: prompts per second
+    startup      fresh interpreters: engine import, first request, Gradio
+                 import and UI build times
+
+Mock text and timing are deterministic, so runs are comparable; use --json to
+keep results for regression checks.
+
+    python benchmark.py --scenario engine concurrency --sessions 10 100 500
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import tracemalloc
+import uuid
+
+from gradio.utils import diff
+
+from mock_server import add_mock_arguments, free_port
+
+
+def start_mock_server(args, port, **overrides):
+    """Run mock_server.py with the mock arguments, overrides replace some"""
+    options = dict(vars(args), **overrides)
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_server.py"),
+        "--port", str(port),
+        "--reasoning-tokens", str(options["reasoning_tokens"]),
+        "--content-tokens", str(options["content_tokens"]),
+        "--chunk-tokens", str(options["chunk_tokens"]),
+        "--token-delay", str(options["token_delay"]),
+        "--first-token-delay", str(options["first_token_delay"]),
+        "--paragraph-tokens", str(options["paragraph_tokens"]),
+        "--stall-after", str(options["stall_after"]),
+        "--stall-seconds", str(options["stall_seconds"]),
+        "--error-after", str(options["error_after"]),
+        "--error-status", str(options["error_status"]),
+        "--error-every", str(options["error_every"]),
+        "--seed", str(options["seed"]),
+    ]
+    if options["inline_reasoning"]:
+        command.append("--inline-reasoning")
+    process = subprocess.Popen(command)
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("mock server did not start")
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def update_bytes(previous, current):
+    """Size of what Gradio would send for this yield of a streaming event"""
+    payload = current if previous is None else diff(previous, current)
+    return len(json.dumps(payload, default=str).encode("utf-8"))
+
+
+def new_session(engine, throughput):
+    convo_state = engine.ConvoState()
+    convo_state.throughput = throughput
+    dynamic_state = engine.DynamicState()
+    dynamic_state.control_button_handler()
+    return convo_state, dynamic_state
+
+
+def first_text(update):
+    editor_update = update[0]
+    return isinstance(editor_update, dict) and bool(editor_update.get("value"))
+
+
+def editor_has_text(output):
+    """Whether a queue message for the editor carries reasoning text"""
+    if isinstance(output, dict):
+        return bool(output.get("value"))
+    # Later yields arrive as Gradio diff edits: [op, path, value]
+    return any(path == ["value"] and value for _, path, value in output)
+
+
+class SessionStats:
+    def __init__(self):
+        self.ttft = None
+        self.updates = 0
+        self.bytes = 0
+        self.cpu = []
+        self.duration = 0.0
+        self.completed = False
+
+    def record(self, start, previous, update, cpu):
+        self.updates += 1
+        self.bytes += update_bytes(previous, list(update))
+        self.cpu.append(cpu)
+        if self.ttft is None and first_text(update):
+            self.ttft = time.perf_counter() - start
+
+
+def run_sync_session(engine, args, prompt):
+    convo_state, dynamic_state = new_session(engine, args.throughput)
+    stats = SessionStats()
+    start = time.perf_counter()
+    previous = None
+    generator = engine.stream_response(convo_state, dynamic_state, prompt, "")
+    while True:
+        cpu_start = time.thread_time()
+        try:
+            update = next(generator)
+        except StopIteration:
+            break
+        stats.record(start, previous, update, time.thread_time() - cpu_start)
+        previous = list(update)
+    stats.duration = time.perf_counter() - start
+    stats.completed = dynamic_state.stream_completed
+    return stats, convo_state
+
+
+async def run_async_session(engine, args, prompt):
+    convo_state, dynamic_state = new_session(engine, args.throughput)
+    stats = SessionStats()
+    start = time.perf_counter()
+    previous = None
+    generator = engine.astream_response(convo_state, dynamic_state, prompt, "")
+    while True:
+        cpu_start = time.thread_time()
+        try:
+            update = await generator.__anext__()
+        except StopAsyncIteration:
+            break
+        # Includes CPU of other tasks interleaved on the loop, exact when alone
+        stats.record(start, previous, update, time.thread_time() - cpu_start)
+        previous = list(update)
+    stats.duration = time.perf_counter() - start
+    stats.completed = dynamic_state.stream_completed
+    return stats, convo_state
+
+
+def summarize(sessions):
+    cpu = [sample for stats in sessions for sample in stats.cpu]
+    ttft = [stats.ttft for stats in sessions if stats.ttft is not None]
+    updates = sum(stats.updates for stats in sessions)
+    return {
+        "sessions": len(sessions),
+        "completed": sum(stats.completed for stats in sessions),
+        "ttft_p50_ms": percentile(ttft, 0.5) * 1000,
+        "ttft_p95_ms": percentile(ttft, 0.95) * 1000,
+        "cpu_per_yield_us": (sum(cpu) / len(cpu) * 1e6) if cpu else 0.0,
+        "cpu_per_yield_p95_us": percentile(cpu, 0.95) * 1e6,
+        "bytes_per_update": (sum(stats.bytes for stats in sessions) / updates) if updates else 0.0,
+        "updates_per_session": updates / max(1, len(sessions)),
+        "duration_p50_s": percentile([stats.duration for stats in sessions], 0.5),
+    }
+
+
+def bench_engine(engine, args):
+    results = {}
+    sync_runs = [run_sync_session(engine, args, f"engine {i}")[0] for i in range(args.runs)]
+    results["sync"] = summarize(sync_runs)
+
+    async def async_runs():
+        return [
+            (await run_async_session(engine, args, f"engine {i}"))[0]
+            for i in range(args.runs)
+        ]
+
+    results["async"] = summarize(asyncio.run(async_runs()))
+    return results
+
+
+def bench_memory(engine, args):
+    async def run():
+        # Imports the SDK and pools this loop's client, which sessions share
+        await run_async_session(engine, args, "memory warm-up")
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        sessions = await asyncio.gather(
+            *(run_async_session(engine, args, f"memory {i}") for i in range(args.memory_sessions))
+        )
+        # Session states are still referenced here, as gr.State keeps them
+        held, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del sessions
+        return held - baseline, peak - baseline
+
+    held, peak = asyncio.run(run())
+    retained = history_retention(engine, args.history_rounds)
+    # Rounds in memory plus as many spilled ones, of up to three messages each
+    bound = 6 * engine.config.HISTORY_MAX_ROUNDS or None
+    return {
+        "sessions": args.memory_sessions,
+        "bytes_per_session": held / args.memory_sessions,
+        "peak_bytes_per_session": peak / args.memory_sessions,
+        "history_rounds": args.history_rounds,
+        "messages_retained_max": max(retained, default=0),
+        "messages_bound": bound,
+        "history_bounded": bound is None or max(retained, default=0) <= bound,
+    }
+
+
+def history_retention(engine, rounds):
+    """Flattened messages one session holds after each of rounds rounds"""
+    convo_state = engine.ConvoState()
+    retained = []
+    for index in range(rounds):
+        current = convo_state.current
+        current.user = f"history {index}"
+        current.cot = "A thought. " * 20
+        current.result = "An answer."
+        convo_state.flatten_output()
+        retained.append(len(convo_state.flat_history))
+        convo_state.next_round()
+    return retained
+
+
+async def monitor_loop_lag(samples, stop, interval=0.01):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+
+def bench_concurrency(engine, args):
+    async def run_level(sessions):
+        lag = []
+        stop = asyncio.Event()
+        monitor = asyncio.create_task(monitor_loop_lag(lag, stop))
+        start = time.perf_counter()
+        results = await asyncio.gather(
+            *(run_async_session(engine, args, f"load {i}") for i in range(sessions))
+        )
+        wall = time.perf_counter() - start
+        stop.set()
+        await monitor
+        summary = summarize([stats for stats, _ in results])
+        summary["wall_s"] = wall
+        summary["loop_lag_p95_ms"] = percentile(lag, 0.95) * 1000
+        return summary
+
+    async def run_levels():
+        levels = []
+        for sessions in args.sessions:
+            levels.append(await run_level(sessions))
+        return levels
+
+    levels = asyncio.run(run_levels())
+    supported = 0
+    for level in levels:
+        if (
+            level["loop_lag_p95_ms"] <= args.max_lag
+            and level["ttft_p95_ms"] <= args.max_ttft
+            and level["completed"] == level["sessions"]
+        ):
+            supported = level["sessions"]
+    return {"levels": levels, "max_concurrent_sessions": supported}
+
+
+def bench_gradio(engine, args):
+    import httpx
+
+    import app
+
+    port = free_port()
+    # Gradio's queue grabs the current loop, which earlier asyncio.run calls unset
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    demo = app.create_app(engine.config)
+    demo.queue(max_size=max(50, args.gradio_sessions), api_open=False)
+    demo.launch(
+        server_name="127.0.0.1",
+        server_port=port,
+        prevent_thread_lock=True,
+        quiet=True,
+        _frontend=False,
+    )
+    fn_index = {fn.name: index for index, fn in demo.fns.items()}
+    stream_fn = "wrap_stream_generator_async" if engine.config.ASYNC_STREAMING else "wrap_stream_generator"
+    base = f"http://127.0.0.1:{port}/gradio_api"
+
+    async def run_session(client, index):
+        session_hash = uuid.uuid4().hex
+        event = {"event_data": None, "trigger_id": None, "session_hash": session_hash}
+        await client.post(
+            base + "/run/predict",
+            json={"data": [None], "fn_index": fn_index["handle_control_button"], **event},
+        )
+        # Same sync rate as the API scenario, which sends it with generate
+        await client.post(
+            base + "/queue/join",
+            json={"data": [args.throughput, None], "fn_index": fn_index["set_throughput"], **event},
+        )
+        async with client.stream(
+            "GET", base + "/queue/data", params={"session_hash": session_hash}
+        ) as response:
+            async for line in response.aiter_lines():
+                if line.startswith("data:") and json.loads(line[5:]).get("msg") == "process_completed":
+                    break
+        start = time.perf_counter()
+        await client.post(
+            base + "/queue/join",
+            json={"data": [None, None, f"gradio {index}", ""], "fn_index": fn_index[stream_fn], **event},
+        )
+        stats = SessionStats()
+        async with client.stream(
+            "GET", base + "/queue/data", params={"session_hash": session_hash}
+        ) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                stats.bytes += len(line.encode("utf-8"))
+                message = json.loads(line[5:])
+                if message.get("msg") == "process_generating":
+                    stats.updates += 1
+                    if stats.ttft is None and editor_has_text(message["output"]["data"][0]):
+                        stats.ttft = time.perf_counter() - start
+                elif message.get("msg") == "process_completed":
+                    stats.completed = message.get("success", False)
+                    break
+        stats.duration = time.perf_counter() - start
+        return stats
+
+    async def run():
+        limits = httpx.Limits(max_connections=args.gradio_sessions * 2)
+        async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+            return await asyncio.gather(
+                *(run_session(client, i) for i in range(args.gradio_sessions))
+            )
+
+    cpu = time.process_time()
+    try:
+        sessions = asyncio.run(run())
+    finally:
+        cpu = time.process_time() - cpu
+        demo.close()
+    summary = summarize(sessions)
+    summary.pop("cpu_per_yield_us")
+    summary.pop("cpu_per_yield_p95_us")
+    summary["sse_bytes_per_session"] = sum(stats.bytes for stats in sessions) / len(sessions)
+    # Includes this client, which costs about the same for either endpoint
+    summary["cpu_ms_per_session"] = cpu * 1000 / len(sessions)
+    summary["throughput"] = args.throughput
+    return summary
+
+
+def bench_api(engine, args):
+    import threading
+
+    import httpx
+    import uvicorn
+
+    import api
+
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        api.create_api_server(engine.config), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    base = f"http://127.0.0.1:{port}/api/v1"
+
+    async def run_session(client, index):
+        session_id = (await client.post(base + "/sessions")).json()["session_id"]
+        start = time.perf_counter()
+        stats = SessionStats()
+        async with client.stream(
+            "POST",
+            f"{base}/sessions/{session_id}/generate",
+            json={"prompt": f"api {index}", "throughput": args.throughput},
+        ) as response:
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                stats.bytes += len(line.encode("utf-8"))
+                if line.startswith('data: {"cot"') or line.startswith('data: {"result"'):
+                    stats.updates += 1
+                    if stats.ttft is None:
+                        stats.ttft = time.perf_counter() - start
+                elif '"state": "completed"' in line:
+                    stats.completed = True
+        stats.duration = time.perf_counter() - start
+        return stats
+
+    async def run():
+        limits = httpx.Limits(max_connections=args.gradio_sessions * 2)
+        async with httpx.AsyncClient(timeout=600, limits=limits) as client:
+            return await asyncio.gather(
+                *(run_session(client, i) for i in range(args.gradio_sessions))
+            )
+
+    cpu = time.process_time()
+    try:
+        sessions = asyncio.run(run())
+    finally:
+        cpu = time.process_time() - cpu
+        server.should_exit = True
+        thread.join()
+    summary = summarize(sessions)
+    summary.pop("cpu_per_yield_us")
+    summary.pop("cpu_per_yield_p95_us")
+    summary["sse_bytes_per_session"] = sum(stats.bytes for stats in sessions) / len(sessions)
+    summary["cpu_ms_per_session"] = cpu * 1000 / len(sessions)
+    summary["throughput"] = args.throughput
+    return summary
+
+
+def bench_routing(engine, args):
+    from upstream import ClientRegistry, Endpoint, EndpointRouter
+
+    slow_port, dropping_port = free_port(), free_port()
+    servers = [
+        start_mock_server(args, slow_port, first_token_delay=args.first_token_delay * 5),
+        start_mock_server(args, dropping_port, error_after=args.reasoning_tokens // 2),
+    ]
+    healthy = engine.api_router.endpoints[0]
+    router = EndpointRouter([
+        Endpoint("healthy", healthy.url, healthy.key, healthy.model),
+        Endpoint("slow", f"http://127.0.0.1:{slow_port}/v1", healthy.key, healthy.model),
+        Endpoint("dropping", f"http://127.0.0.1:{dropping_port}/v1", healthy.key, healthy.model),
+        # Nothing listens here, every attempt fails before the first chunk
+        Endpoint("down", f"http://127.0.0.1:{free_port()}/v1", healthy.key, healthy.model),
+    ])
+    original = engine.api_router, engine.api_clients
+    engine.api_router = router
+    engine.api_clients = ClientRegistry(
+        max_connections=args.routing_sessions * 2,
+        max_keepalive=args.routing_sessions,
+        keepalive_expiry=120,
+        max_retries=0,
+    )
+
+    async def run():
+        return await asyncio.gather(
+            *(run_async_session(engine, args, f"routing {i}") for i in range(args.routing_sessions))
+        )
+
+    try:
+        sessions = [stats for stats, _ in asyncio.run(run())]
+    finally:
+        engine.api_router, engine.api_clients = original
+        for server in servers:
+            server.terminate()
+            server.wait()
+    summary = summarize(sessions)
+    summary.pop("cpu_per_yield_us")
+    summary.pop("cpu_per_yield_p95_us")
+    return {"sessions": summary, "endpoints": router.table()}
+
+
+# Run in a fresh interpreter so already imported modules hide no cost
+def bench_batch(engine, args):
+    import io
+
+    import batch
+
+    levels = []
+    for concurrency in args.batch_concurrency:
+        # Unique prompts, so neither coalescing nor the cache skips upstream work
+        items = [
+            {"id": str(i), "prompt": f"batch {concurrency} {i}"} for i in range(args.batch_prompts)
+        ]
+        output = io.StringIO()
+        start = time.perf_counter()
+        stats = asyncio.run(batch.run_batch(items, output, concurrency, retries=0))
+        elapsed = time.perf_counter() - start
+        levels.append({
+            "concurrency": concurrency,
+            "completed": stats["completed"],
+            "seconds": elapsed,
+            "prompts_per_s": args.batch_prompts / elapsed,
+        })
+    base = levels[0]["prompts_per_s"] / levels[0]["concurrency"]
+    for level in levels:
+        level["scaling"] = level["prompts_per_s"] / (base * level["concurrency"])
+    return levels
+
+
+STARTUP_PROBE = """
+import json, time
+start = time.perf_counter()
+timings = {}
+def mark(name, since):
+    timings[name] = (time.perf_counter() - since) * 1000
+import engine
+mark("import_engine_ms", start)
+step = time.perf_counter()
+engine.configure()
+convo_state, dynamic_state = engine.ConvoState(), engine.DynamicState()
+convo_state.throughput = 1000
+dynamic_state.control_button_handler()
+for update in engine.stream_response(convo_state, dynamic_state, "startup", ""):
+    if isinstance(update[0], dict) and update[0].get("value"):
+        break
+mark("first_token_ms", step)
+mark("ready_to_first_token_ms", start)
+step = time.perf_counter()
+import app
+mark("import_app_ms", step)
+step = time.perf_counter()
+app.create_app()
+mark("create_app_ms", step)
+print(json.dumps(timings))
+"""
+
+
+def bench_startup(engine, args):
+    runs = []
+    for _ in range(args.runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_PROBE],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        runs.append(json.loads(output.splitlines()[-1]))
+    return {name: percentile([run[name] for run in runs], 0.5) for name in runs[0]}
+
+
+def print_table(title, rows):
+    print(f"\n== {title}")
+    if not rows:
+        return
+    columns = list(rows[0])
+    print(" ".join(f"{column:>22}" for column in columns))
+    for row in rows:
+        print(" ".join(
+            f"{row[column]:>22.2f}" if isinstance(row[column], float) else f"{row[column]!s:>22}"
+            for column in columns
+        ))
+
+
+def main(args):
+    port = free_port()
+    server = start_mock_server(args, port)
+    os.environ.update(
+        API_KEY="benchmark",
+        API_URL=f"http://127.0.0.1:{port}/v1",
+        API_MODEL="mock",
+        RESPONSE_CACHE="off",
+        POOL_MAX_CONNECTIONS=str(max(args.sessions + [args.gradio_sessions, 100])),
+        POOL_MAX_KEEPALIVE=str(max(args.sessions + [args.gradio_sessions, 20])),
+        STREAM_CONCURRENCY=str(max(args.sessions + [args.gradio_sessions, 200])),
+    )
+    import engine
+
+    engine.configure()
+    results = {"args": vars(args)}
+    try:
+        if "engine" in args.scenario:
+            results["engine"] = bench_engine(engine, args)
+            print_table("engine", [dict(mode=mode, **stats) for mode, stats in results["engine"].items()])
+        if "memory" in args.scenario:
+            results["memory"] = bench_memory(engine, args)
+            print_table("memory", [results["memory"]])
+        if "concurrency" in args.scenario:
+            results["concurrency"] = bench_concurrency(engine, args)
+            print_table("concurrency", results["concurrency"]["levels"])
+            print(f"max concurrent sessions: {results['concurrency']['max_concurrent_sessions']}")
+        if "gradio" in args.scenario:
+            results["gradio"] = bench_gradio(engine, args)
+            print_table("gradio", [results["gradio"]])
+        if "api" in args.scenario:
+            results["api"] = bench_api(engine, args)
+            print_table("api", [results["api"]])
+        if "routing" in args.scenario:
+            results["routing"] = bench_routing(engine, args)
+            print_table("routing", [results["routing"]["sessions"]])
+            print_table("routing table", [
+                {key: row[key] for key in ("name", "ttft_ms", "error_rate", "requests", "failures")}
+                for row in results["routing"]["endpoints"]
+            ])
+        if "batch" in args.scenario:
+            results["batch"] = bench_batch(engine, args)
+            print_table("batch", results["batch"])
+        if "startup" in args.scenario:
+            results["startup"] = bench_startup(engine, args)
+            print_table("startup", [results["startup"]])
+    finally:
+        server.terminate()
+        server.wait()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--scenario",
+        nargs="+",
+        choices=["engine", "memory", "concurrency", "gradio", "api", "routing", "batch", "startup"],
+        default=["engine", "memory", "concurrency", "gradio", "api", "routing", "batch", "startup"],
+    )
+    parser.add_argument(
+        "--runs", type=int, default=3, help="Sequential engine sessions per mode, startup probes"
+    )
+    parser.add_argument("--sessions", type=int, nargs="+", default=[10, 100, 500])
+    parser.add_argument("--memory-sessions", type=int, default=50)
+    parser.add_argument("--history-rounds", type=int, default=200, help="Rounds of the retention check")
+    parser.add_argument("--gradio-sessions", type=int, default=10, help="Sessions for gradio and api")
+    parser.add_argument("--routing-sessions", type=int, default=40)
+    parser.add_argument("--batch-prompts", type=int, default=32)
+    parser.add_argument("--batch-concurrency", type=int, nargs="+", default=[1, 4, 16, 32])
+    parser.add_argument("--throughput", type=int, default=50, help="Sync rate per session")
+    parser.add_argument("--max-lag", type=float, default=50.0, help="p95 loop lag limit in ms")
+    parser.add_argument("--max-ttft", type=float, default=1000.0, help="p95 TTFT limit in ms")
+    parser.add_argument("--json", help="Write results to this file")
+    add_mock_arguments(parser)
+    main(parser.parse_args())
@@ -0,0 +1,181 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """LRU + TTL cache of generated continuations
+
+    Entries are keyed by the request (model, prompt and sampling params) plus
+    the reasoning prefix the model continued from. A lookup also matches an
+    entry whose prefix + continuation extends the requested prefix, so an
+    unedited resume replays the rest of an earlier generation.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # (request_key, prefix) -> (continuation, created)
+        self._by_request = {}
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def request_key(model, prompt, temperature, max_tokens, context=()):
+        fields = [model, prompt, temperature, max_tokens]
+        if context:
+            # Earlier rounds sent along, single-turn keys stay as they were
+            fields.append(context)
+        payload = json.dumps(fields)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def entry_size(prefix, continuation):
+        return len(prefix.encode("utf-8")) + len(continuation.encode("utf-8"))
+
+    def lookup(self, request_key, prefix):
+        """Continuation for prefix, or None on a miss"""
+        with self._lock:
+            continuation = self._match(request_key, prefix, time.time())
+            if continuation is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return continuation
+
+    def put(self, request_key, prefix, continuation):
+        if not continuation:
+            return
+        with self._lock:
+            self._put(request_key, prefix, continuation, time.time())
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._usage()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": entries,
+            "bytes": size,
+        }
+
+    @staticmethod
+    def resume_from(entry_prefix, continuation, prefix):
+        """Rest of an entry's text after prefix, None if it does not extend it"""
+        if not prefix.startswith(entry_prefix):
+            return None
+        full_text = entry_prefix + continuation
+        if len(full_text) <= len(prefix) or not full_text.startswith(prefix):
+            return None
+        return full_text[len(prefix):]
+
+    def _match(self, request_key, prefix, now):
+        best = None
+        for entry_prefix in list(self._by_request.get(request_key, ())):
+            key = (request_key, entry_prefix)
+            continuation, created = self._entries[key]
+            if now - created > self.ttl:
+                self._remove(key)
+                continue
+            rest = self.resume_from(entry_prefix, continuation, prefix)
+            if rest is not None and (best is None or len(entry_prefix) > len(best[0])):
+                best = (entry_prefix, rest)
+        if best is None:
+            return None
+        self._entries.move_to_end((request_key, best[0]))
+        return best[1]
+
+    def _put(self, request_key, prefix, continuation, now):
+        key = (request_key, prefix)
+        if key in self._entries:
+            self._remove(key)
+        size = self.entry_size(prefix, continuation)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (continuation, now)
+        self._by_request.setdefault(request_key, set()).add(prefix)
+        self._size += size
+        while self._size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        continuation, _ = self._entries.pop(key)
+        request_key, prefix = key
+        prefixes = self._by_request[request_key]
+        prefixes.discard(prefix)
+        if not prefixes:
+            del self._by_request[request_key]
+        self._size -= self.entry_size(prefix, continuation)
+
+    def _usage(self):
+        return len(self._entries), self._size
+
+
+class SQLiteResponseCache(ResponseCache):
+    """ResponseCache persisted in a SQLite file so it survives restarts"""
+
+    def __init__(self, max_bytes, ttl, path):
+        super().__init__(max_bytes, ttl)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "request_key TEXT, prefix TEXT, continuation TEXT, "
+            "created REAL, accessed REAL, size INTEGER, "
+            "PRIMARY KEY (request_key, prefix))"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        self._db.commit()
+
+    def _match(self, request_key, prefix, now):
+        self._db.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,))
+        rows = self._db.execute(
+            "SELECT prefix, continuation FROM entries WHERE request_key = ?",
+            (request_key,),
+        ).fetchall()
+        best = None
+        for entry_prefix, continuation in rows:
+            rest = self.resume_from(entry_prefix, continuation, prefix)
+            if rest is not None and (best is None or len(entry_prefix) > len(best[0])):
+                best = (entry_prefix, rest)
+        if best is not None:
+            self._db.execute(
+                "UPDATE entries SET accessed = ? WHERE request_key = ? AND prefix = ?",
+                (now, request_key, best[0]),
+            )
+        self._db.commit()
+        return None if best is None else best[1]
+
+    def _put(self, request_key, prefix, continuation, now):
+        size = self.entry_size(prefix, continuation)
+        if size > self.max_bytes:
+            return
+        self._db.execute(
+            "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+            (request_key, prefix, continuation, now, now, size),
+        )
+        total = self._usage()[1]
+        while total > self.max_bytes:
+            rowid, entry_size = self._db.execute(
+                "SELECT rowid, size FROM entries ORDER BY accessed LIMIT 1"
+            ).fetchone()
+            self._db.execute("DELETE FROM entries WHERE rowid = ?", (rowid,))
+            total -= entry_size
+        self._db.commit()
+
+    def _usage(self):
+        entries, size = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries"
+        ).fetchone()
+        return entries, size
+
+    def close(self):
+        with self._lock:
+            self._db.close()
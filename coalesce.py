@@ -0,0 +1,120 @@
+import threading
+
+from upstream import CancelToken
+
+
+class SharedStream:
+    """One upstream generation broadcast to the pacers of every subscriber
+
+    The producer writes to it as if it were a single TokenPacer. Each
+    subscriber keeps its own pacer, so pacing, pauses and read-ahead stay per
+    session. The upstream is only stopped once every subscriber has stopped;
+    from then on the stream is sealed and takes no new subscribers, and
+    cancel_token aborts the read in progress. The read goes on while any
+    subscriber has room, so a paused subscriber whose read-ahead is full
+    stops instead of buffering past its limit.
+    """
+
+    def __init__(self, frame_interval, on_close=None):
+        self.frame_interval = frame_interval
+        self.on_close = on_close
+        self.subscribers = []
+        self.history = []
+        self.producer = None
+        self.cancel_token = CancelToken()
+        self.done = False
+        self.sealed = False
+        self._lock = threading.Lock()
+
+    def subscribe(self, pacer):
+        """Add pacer, replaying the text so far; False once sealed or closed"""
+        with self._lock:
+            if self.done or self.sealed:
+                return False
+            if self.history:
+                pacer.put("".join(self.history))
+            self.subscribers.append(pacer)
+            pacer.shared = self
+        return True
+
+    def _active(self):
+        self.subscribers = [pacer for pacer in self.subscribers if not pacer.stopped]
+        return self.subscribers
+
+    def put(self, text):
+        with self._lock:
+            self.history.append(text)
+            subscribers = self._active()
+            full = [pacer for pacer in subscribers if not pacer.has_room()]
+            if full and len(full) < len(subscribers):
+                for pacer in full:
+                    pacer.stop_if_full()
+                subscribers = self._active()
+        tokens = 0
+        for pacer in subscribers:
+            tokens = pacer.put(text)
+        return tokens
+
+    def close(self, error=None):
+        with self._lock:
+            self.done = True
+            subscribers = self._active()
+        for pacer in subscribers:
+            pacer.close(error)
+        if self.on_close is not None:
+            self.on_close(self)
+
+    @property
+    def stopped(self):
+        with self._lock:
+            if not self._active():
+                self.sealed = True
+            return self.sealed
+
+    def stop(self):
+        with self._lock:
+            self.sealed = True
+            subscribers = self._active()
+        for pacer in subscribers:
+            pacer.stop()
+
+    def has_room(self):
+        with self._lock:
+            return any(pacer.has_room() for pacer in self._active())
+
+    def expired(self):
+        with self._lock:
+            subscribers = self._active()
+            if subscribers and all(pacer.expired() for pacer in subscribers):
+                self.sealed = True
+            return self.sealed
+
+
+class StreamCoalescer:
+    """Single-flight table of in-flight upstream generations by request key"""
+
+    def __init__(self):
+        self._streams = {}
+        self._lock = threading.Lock()
+
+    def join(self, key, pacer):
+        """Subscribe pacer to the stream for key, True if the caller must produce it"""
+        with self._lock:
+            stream = self._streams.get(key)
+            if stream is not None and stream.subscribe(pacer):
+                return stream, False
+            stream = SharedStream(
+                pacer.frame_interval, on_close=lambda closed: self._finish(key, closed)
+            )
+            stream.subscribe(pacer)
+            self._streams[key] = stream
+            return stream, True
+
+    def _finish(self, key, stream):
+        with self._lock:
+            if self._streams.get(key) is stream:
+                del self._streams[key]
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._streams)
@@ -0,0 +1,49 @@
+from pacing import count_tokens
+
+
+def round_tokens(round):
+    """(user, cot, result) token counts of a finished round, counted once"""
+    if round.tokens is None:
+        round.tokens = (
+            count_tokens(round.user),
+            count_tokens(round.cot),
+            count_tokens(round.result),
+        )
+    return round.tokens
+
+
+def assemble_context(rounds, budget):
+    """Messages for earlier rounds within budget tokens, newest kept first
+
+    Rounds keep their prompt and result back from the newest one for as long
+    as they fit. Their thoughts are then added newest first while tokens are
+    left, so old chains of thought are dropped before any result. Rounds
+    without a finished result are left out. Returns (messages, tokens,
+    rounds).
+    """
+    kept = []
+    used = 0
+    for round in reversed(rounds):
+        if not (round.think_complete and round.result):
+            continue
+        user, _, result = round_tokens(round)
+        if used + user + result > budget:
+            break
+        used += user + result
+        kept.append(round)
+    thoughts = 0
+    for round in kept:
+        cot = round_tokens(round)[1]
+        if used + cot > budget:
+            break
+        used += cot
+        thoughts += 1
+    messages = []
+    for index in range(len(kept) - 1, -1, -1):
+        round = kept[index]
+        content = round.result
+        if index < thoughts and round.cot:
+            content = f"<think>\n{round.cot}</think>{round.result}"
+        messages.append({"role": "user", "content": round.user})
+        messages.append({"role": "assistant", "content": content})
+    return messages, used, len(kept)
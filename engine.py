@@ -0,0 +1,1843 @@
+from dotenv import load_dotenv
+import asyncio
+import atexit
+import base64
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+import zlib
+from lang import LANGUAGE_CONFIG
+from cache import ResponseCache, SQLiteResponseCache
+from coalesce import SharedStream, StreamCoalescer
+from context import assemble_context
+from health import UpstreamProbe
+from history import HistoryStore, IdleSweeper, MemoryHistoryStore, RedisHistoryStore
+from metrics import RequestTrace, StreamMetrics, trace_logger
+from pacing import TokenPacer, count_tokens, split_tokens
+from policy import ParagraphRule, PausePolicy, build_rules, parse_rules
+from recorder import StreamRecorder
+from scheduler import AdmissionScheduler
+from upstream import (
+    ClientRegistry,
+    Endpoint,
+    EndpointRouter,
+    RetryPolicy,
+    StallWatchdog,
+    UpstreamStalled,
+    classify_error,
+)
+
+load_dotenv(override=True)
+
+DEFAULT_PERSISTENT = {"prompt_input": "", "thought_editor": ""}
+
+
+def ui_update(**props):
+    """Component update in Gradio's wire format, gr.update() without gradio"""
+    return {"__type__": "update", **props}
+
+
+class AppConfig:
+    DEFAULT_THROUGHPUT = 10
+    SYNC_THRESHOLD_DEFAULT = 0
+    PAUSE_RULES = os.getenv("PAUSE_RULES", "")  # JSON list of policy.py rules, added to the paragraphs
+    API_TIMEOUT = int(os.getenv("TIMEOUT_SECONDS", 120))
+    STALL_TIMEOUT = float(os.getenv("STALL_TIMEOUT", 30))  # 0 waits for TIMEOUT_SECONDS
+    UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", 3))
+    RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", 0.5))
+    RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", 8))
+    STREAM_OUTPUT = os.getenv("STREAM_OUTPUT", "true").lower() == "true"
+    MAX_TOKENS = int(os.getenv("MAX_TOKENS", 4096))
+    CONTEXT_TOKENS = int(os.getenv("CONTEXT_TOKENS", 0))  # earlier rounds sent along, 0 for none
+    TEMPERATURE = float(os.getenv("TEMPERATURE", 0.6))
+    API_KEY = os.getenv("API_KEY")
+    API_URL = os.getenv("API_URL")
+    API_MODEL = os.getenv("API_MODEL")
+    POOL_MAX_CONNECTIONS = int(os.getenv("POOL_MAX_CONNECTIONS", 100))
+    POOL_MAX_KEEPALIVE = int(os.getenv("POOL_MAX_KEEPALIVE", 20))
+    POOL_KEEPALIVE_EXPIRY = float(os.getenv("POOL_KEEPALIVE_EXPIRY", 120))
+    WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", 2))  # per endpoint at startup, 0 skips
+    WARMUP_PROMPT = os.getenv("WARMUP_PROMPT", "")  # one-token request timed at startup, off when empty
+    PROBE_INTERVAL = float(os.getenv("PROBE_INTERVAL", 30))  # 0 probes only at startup
+    PROBE_TIMEOUT = float(os.getenv("PROBE_TIMEOUT", 5))
+    READY_MAX_WAITING = int(os.getenv("READY_MAX_WAITING", 0))  # 0 never reports the queue saturated
+    ASYNC_STREAMING = os.getenv("ASYNC_STREAMING", "true").lower() == "true"
+    STREAM_CONCURRENCY = int(os.getenv("STREAM_CONCURRENCY", 200))
+    STREAM_FPS = float(os.getenv("STREAM_FPS", 10))
+    RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "memory").lower()  # memory, sqlite or off
+    RESPONSE_CACHE_MB = float(os.getenv("RESPONSE_CACHE_MB", 64))
+    RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 86400))
+    RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+    PREFETCH_ON_PAUSE = os.getenv("PREFETCH_ON_PAUSE", "false").lower() == "true"
+    PREFETCH_MAX_TOKENS = int(os.getenv("PREFETCH_MAX_TOKENS", 2048))
+    PREFETCH_IDLE_SECONDS = float(os.getenv("PREFETCH_IDLE_SECONDS", 300))
+    REROLL_CANDIDATES = int(os.getenv("REROLL_CANDIDATES", 0))  # 0 disables speculative rerolls
+    REROLL_MAX_TOKENS = int(os.getenv("REROLL_MAX_TOKENS", 2048))  # 0 for no cap
+    REROLL_SESSION_TOKENS = int(os.getenv("REROLL_SESSION_TOKENS", 16384))  # 0 for no cap
+    TRACE_LOG = os.getenv("TRACE_LOG", "")  # JSON line per request, off when empty
+    HISTORY_MAX_ROUNDS = int(os.getenv("HISTORY_MAX_ROUNDS", 20))  # 0 keeps all in memory
+    SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", 1800))  # 0 never evicts
+    HISTORY_TTL = float(os.getenv("HISTORY_TTL", 86400))
+    HISTORY_PATH = os.getenv("HISTORY_PATH", "history.sqlite3")
+    SESSION_STORE = os.getenv("SESSION_STORE", "sqlite").lower()  # sqlite, memory or redis
+    REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+    SHARED_SESSIONS = os.getenv("SHARED_SESSIONS", "false").lower() == "true"
+    SESSION_POLL_SECONDS = float(os.getenv("SESSION_POLL_SECONDS", 0.5))
+    COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+    QUEUE_MAX_SIZE = int(os.getenv("QUEUE_MAX_SIZE", 1000))
+    MAX_UPSTREAM_STREAMS = int(os.getenv("MAX_UPSTREAM_STREAMS", 100))  # 0 for no cap
+    SESSION_TOKEN_BUDGET = int(os.getenv("SESSION_TOKEN_BUDGET", 0))  # 0 for no budget
+    IP_TOKEN_BUDGET = int(os.getenv("IP_TOKEN_BUDGET", 0))
+    BUDGET_WINDOW_SECONDS = float(os.getenv("BUDGET_WINDOW_SECONDS", 3600))
+    PERSIST_INTERVAL = float(os.getenv("PERSIST_INTERVAL", 2))  # 0 writes every frame
+    PERSIST_MAX_BYTES = int(os.getenv("PERSIST_MAX_BYTES", 65536))
+    RECORD_DIR = os.getenv("RECORD_DIR", "")  # per-session stream recordings, off when empty
+    RECORD_MAX_BYTES = int(os.getenv("RECORD_MAX_BYTES", 1048576))
+    RECORD_BACKUPS = int(os.getenv("RECORD_BACKUPS", 3))
+
+    @classmethod
+    def validate(cls):
+        missing = [name for name in ("API_KEY", "API_URL", "API_MODEL") if not getattr(cls, name)]
+        if missing:
+            raise EnvironmentError(
+                f"Missing required environment variables: {', '.join(missing)}"
+            )
+
+
+def load_endpoints(config):
+    """Primary endpoint plus API_URL_2, API_URL_3... as interchangeable replicas
+
+    A numbered endpoint without its own key or model uses the primary one.
+    """
+    endpoints = [Endpoint("1", config.API_URL, config.API_KEY, config.API_MODEL)]
+    index = 2
+    while os.getenv(f"API_URL_{index}"):
+        endpoints.append(
+            Endpoint(
+                str(index),
+                os.getenv(f"API_URL_{index}"),
+                os.getenv(f"API_KEY_{index}", config.API_KEY),
+                os.getenv(f"API_MODEL_{index}", config.API_MODEL),
+            )
+        )
+        index += 1
+    return endpoints
+
+
+def routed_models():
+    """Model part of response cache keys: every model a request may be routed to
+
+    A single model stays a plain string, so its keys do not change.
+    """
+    models = sorted({endpoint.model for endpoint in api_router.endpoints})
+    return models[0] if len(models) == 1 else models
+
+
+def create_response_cache(config):
+    max_bytes = int(config.RESPONSE_CACHE_MB * 1024 * 1024)
+    if config.RESPONSE_CACHE == "sqlite":
+        return SQLiteResponseCache(
+            max_bytes, config.RESPONSE_CACHE_TTL, config.RESPONSE_CACHE_PATH
+        )
+    if config.RESPONSE_CACHE == "memory":
+        return ResponseCache(max_bytes, config.RESPONSE_CACHE_TTL)
+    return None
+
+
+def create_history_store(config):
+    if config.SESSION_STORE == "redis":
+        return RedisHistoryStore(config.REDIS_URL, config.HISTORY_TTL)
+    if config.SESSION_STORE == "memory":
+        return MemoryHistoryStore(config.HISTORY_TTL)
+    return HistoryStore(config.HISTORY_PATH, config.HISTORY_TTL)
+
+
+# Process-wide services, built by configure() on first use rather than at
+# import so the engine imports cheaply and without a complete environment
+config = AppConfig
+api_router = None
+api_clients = None
+retry_policy = None
+stall_watchdog = None
+response_cache = None
+stream_coalescer = None
+admission = None
+stream_metrics = None
+history_store = None
+session_sweeper = None
+stream_recorder = None
+upstream_probe = None
+pause_rules = []
+live_sessions = weakref.WeakSet()
+live_sessions_lock = threading.Lock()
+
+
+def configure(app_config=AppConfig):
+    """Validate app_config and build the services from it, once per config"""
+    global config, api_router, api_clients, retry_policy, stall_watchdog
+    global response_cache, stream_coalescer, admission, stream_metrics
+    global history_store, session_sweeper, stream_recorder, upstream_probe, pause_rules
+    if app_config is config and api_router is not None:
+        return
+    app_config.validate()
+    pause_rules = parse_rules(app_config.PAUSE_RULES)
+    config = app_config
+
+    api_router = EndpointRouter(load_endpoints(config))
+
+    # Shared by every session so resumes reuse warm keep-alive connections
+    api_clients = ClientRegistry(
+        max_connections=config.POOL_MAX_CONNECTIONS,
+        max_keepalive=config.POOL_MAX_KEEPALIVE,
+        keepalive_expiry=config.POOL_KEEPALIVE_EXPIRY,
+        # Retries are made by GenerationRun, resuming after the text received
+        max_retries=0,
+    )
+    atexit.register(api_clients.close)
+
+    # Warms the pools up and keeps them warm, started by the API server
+    upstream_probe = UpstreamProbe(
+        api_router,
+        api_clients,
+        config.API_TIMEOUT,
+        config.PROBE_TIMEOUT,
+        connections=config.WARMUP_CONNECTIONS,
+        prompt=config.WARMUP_PROMPT,
+        interval=config.PROBE_INTERVAL,
+        use_async=config.ASYNC_STREAMING,
+    )
+
+    retry_policy = RetryPolicy(
+        config.UPSTREAM_RETRIES, config.RETRY_BASE_DELAY, config.RETRY_MAX_DELAY
+    )
+
+    # Aborts sync reads of an upstream that went silent mid-stream
+    stall_watchdog = StallWatchdog(config.STALL_TIMEOUT) if config.STALL_TIMEOUT else None
+
+    response_cache = create_response_cache(config)
+
+    # Identical in-flight requests share one upstream stream
+    stream_coalescer = StreamCoalescer()
+
+    # Fair-share admission of new upstream streams
+    admission = AdmissionScheduler(
+        config.MAX_UPSTREAM_STREAMS,
+        session_budget=config.SESSION_TOKEN_BUDGET,
+        ip_budget=config.IP_TOKEN_BUDGET,
+        budget_window=config.BUDGET_WINDOW_SECONDS,
+    )
+
+    # Rounds spilled out of memory by capped or idle sessions, and with
+    # SHARED_SESSIONS the state every worker process serves sessions from
+    history_store = None
+    if (
+        config.SHARED_SESSIONS
+        or config.HISTORY_MAX_ROUNDS > 0
+        or config.SESSION_IDLE_SECONDS > 0
+    ):
+        history_store = create_history_store(config)
+        atexit.register(history_store.close)
+    session_sweeper = IdleSweeper(
+        min(60, config.SESSION_IDLE_SECONDS / 4), sweep_idle_sessions
+    )
+
+    stream_metrics = create_stream_metrics()
+
+    # What every upstream sent and when, for replay.py
+    stream_recorder = None
+    if config.RECORD_DIR:
+        stream_recorder = StreamRecorder(
+            config.RECORD_DIR, config.RECORD_MAX_BYTES, config.RECORD_BACKUPS
+        )
+
+    if config.TRACE_LOG:
+        trace_handler = logging.FileHandler(config.TRACE_LOG)
+        trace_handler.setFormatter(logging.Formatter("%(message)s"))
+        trace_logger.addHandler(trace_handler)
+        trace_logger.setLevel(logging.INFO)
+        trace_logger.propagate = False
+
+
+def create_stream_metrics():
+    """Hot-path metrics plus gauges read from the services at scrape time"""
+    metrics = StreamMetrics()
+    for stat in ("active", "waiting", "waiting_resumes"):
+        metrics.registry.gauge(
+            f"aei_admission_{stat}",
+            f"Upstream streams {stat.replace('_', ' ')} in the admission scheduler",
+            callback=lambda stat=stat: admission.stats()[stat],
+        )
+    metrics.registry.gauge(
+        "aei_coalesced_streams_in_flight",
+        "Shared upstream streams currently open",
+        callback=lambda: stream_coalescer.in_flight(),
+    )
+    if response_cache is not None:
+        for stat in ("hits", "misses", "entries", "bytes"):
+            metrics.registry.gauge(
+                f"aei_response_cache_{stat}",
+                f"Response cache {stat}",
+                callback=lambda stat=stat: response_cache.stats()[stat],
+            )
+    metrics.registry.gauge(
+        "aei_upstream_reachable",
+        "1 if the last probe of the endpoint reached it, 0 if not",
+        ("endpoint",),
+        callback=lambda: {
+            (name,): int(status["reachable"])
+            for name, status in upstream_probe.status.items()
+            if status["reachable"] is not None
+        },
+    )
+    for stat, field in (
+        ("ttft_seconds", "ttft_ms"),
+        ("error_rate", "error_rate"),
+        ("outstanding", "outstanding"),
+    ):
+        metrics.registry.gauge(
+            f"aei_upstream_{stat}",
+            f"Upstream {stat.replace('_', ' ')} per endpoint",
+            ("endpoint",),
+            callback=lambda field=field: {
+                (row["name"],): (
+                    row[field] / 1000 if field == "ttft_ms" else row[field]
+                )
+                for row in api_router.table()
+                if row[field] is not None
+            },
+        )
+    return metrics
+
+
+class DynamicState:
+    """Dynamic UI state"""
+
+    # Flags another worker needs to serve the next event of the session
+    SHARED_FIELDS = (
+        "should_stream",
+        "stream_completed",
+        "in_cot",
+        "waiting_api",
+        "label_passthrough",
+        "turn",
+    )
+
+    def __init__(self):
+        self.should_stream = False
+        self.stream_completed = False
+        self.in_cot = True
+        # English-only interface
+        self.waiting_api = False  # Added waiting state flag
+        self.label_passthrough = False
+        # Bumped by every Generate, so a superseded stream can tell
+        self.turn = 0
+
+    def control_button_handler(self):
+        original_state = self.should_stream
+        self.should_stream = not self.should_stream
+
+        # Activate waiting state when switching from pause to generate
+        if not original_state and self.should_stream:
+            self.waiting_api = True
+            self.stream_completed = False
+            self.turn += 1
+
+        return self.ui_state_controller()
+
+    def ui_state_controller(self):
+        """Generate dynamic UI component states"""
+        # [control_button, thought_editor, reset_button]
+        lang_data = LANGUAGE_CONFIG["en"]
+        control_value = (
+            lang_data["pause_btn"] if self.should_stream else lang_data["generate_btn"]
+        )
+        control_variant = "secondary" if self.should_stream else "primary"
+        # Handle waiting state display
+        if self.waiting_api and self.should_stream:
+            status_suffix = lang_data["waiting_api"]
+        elif self.waiting_api and not self.should_stream:
+            status_suffix = lang_data["api_retry"]
+        else:
+            status_suffix = (
+                lang_data["completed"]
+                if self.stream_completed
+                else lang_data["interrupted"]
+            )
+        editor_label = f"{lang_data['editor_label']} - {status_suffix}"
+        output = (
+            ui_update(value=control_value, variant=control_variant),
+            ui_update() if self.label_passthrough else ui_update(label=editor_label),
+            ui_update(interactive=not self.should_stream),
+        )
+        self.label_passthrough = False
+        return output
+
+    def reset_workspace(self):
+        """Reset workspace state"""
+        self.stream_completed = False
+        self.should_stream = False
+        self.in_cot = True
+        self.waiting_api = False
+
+        return self.ui_state_controller() + (
+            "",
+            "",
+            LANGUAGE_CONFIG["en"]["bot_default"],
+            DEFAULT_PERSISTENT,
+        )
+
+    def shared_state(self):
+        return {name: getattr(self, name) for name in self.SHARED_FIELDS}
+
+    def sync(self, state):
+        for name in self.SHARED_FIELDS:
+            if name in state:
+                setattr(self, name, state[name])
+
+
+class StreamState:
+    """Incremental parse state of a streamed response
+
+    Every delta is scanned once: the <think>/</think> boundary and the
+    cot/result buffers are kept up to date without rescanning the full
+    response. Tag fragments split across chunks are held back until the
+    next delta resolves them.
+    """
+
+    THINK_OPEN = "<think>"
+    THINK_CLOSE = "</think>"
+
+    def __init__(self, initial_content=""):
+        self.cot = ""
+        self.result = ""
+        self.think_complete = False
+        self.pending = ""
+        self._consume(initial_content)
+
+    @property
+    def raw(self):
+        if self.think_complete:
+            return self.cot + self.THINK_CLOSE + self.result
+        return self.cot
+
+    def editor_text(self, include_result):
+        if include_result:
+            return self.raw
+        return self.cot + (self.THINK_CLOSE if self.think_complete else "")
+
+    def feed(self, delta):
+        """Consume a streamed delta, dropping any <think> opening tags"""
+        text = (self.pending + delta).replace(self.THINK_OPEN, "")
+        self.pending = ""
+        self._consume(text)
+
+    def flush(self):
+        """Commit held-back tag fragments once the stream has ended"""
+        text, self.pending = self.pending, ""
+        self._append(text)
+
+    def _consume(self, text):
+        if not self.think_complete and self.THINK_CLOSE in text:
+            cot, _, text = text.partition(self.THINK_CLOSE)
+            self._append(cot)
+            self.think_complete = True
+        held = self._partial_tag_length(text)
+        if held:
+            text, self.pending = text[:-held], text[-held:]
+        self._append(text)
+
+    def _append(self, text):
+        if not text:
+            return
+        if self.think_complete:
+            self.result += text
+        else:
+            self.cot += text
+
+    def _partial_tag_length(self, text):
+        # Longest suffix of text that may still grow into a tag
+        tags = (self.THINK_OPEN,) if self.think_complete else (
+            self.THINK_OPEN,
+            self.THINK_CLOSE,
+        )
+        for size in range(min(len(text), len(self.THINK_CLOSE) - 1), 0, -1):
+            suffix = text[-size:]
+            if any(len(suffix) < len(tag) and tag.startswith(suffix) for tag in tags):
+                return size
+        return 0
+
+
+class CoordinationManager:
+    """Manage human-AI coordination rhythm
+
+    The pause policy of one round: a pause every paragraph_threshold
+    paragraphs plus the rules given. ConvoState keeps it across the runs of
+    the round, so counts carry over a pause and resume.
+    """
+
+    def __init__(self, paragraph_threshold, rules=()):
+        rules = list(rules)
+        if paragraph_threshold and paragraph_threshold > 0:
+            rules.insert(0, ParagraphRule(paragraph_threshold))
+        self.policy = PausePolicy(rules)
+
+    def should_pause_for_human(self, cot_delta):
+        """Name of the rule pausing after cot_delta, None to keep streaming"""
+        if not cot_delta:
+            return None
+        return self.policy.feed(cot_delta)
+
+
+class ConvoRound:
+    """One prompt and its response, the raw text is rebuilt on demand"""
+
+    __slots__ = ("user", "cot", "result", "think_complete", "tokens")
+
+    def __init__(self, user="", cot="", result="", think_complete=False):
+        self.user = user
+        self.cot = cot
+        self.result = result
+        self.think_complete = think_complete
+        # Token counts, set by context.round_tokens once the round is finished
+        self.tokens = None
+
+    @property
+    def raw(self):
+        if self.think_complete:
+            return self.cot + StreamState.THINK_CLOSE + self.result
+        return self.cot
+
+    def fields(self):
+        return (self.user, self.cot, self.result, self.think_complete)
+
+
+class ConvoState:
+    """State of current ROUND of convo"""
+
+    def __init__(self):
+        self.throughput = config.DEFAULT_THROUGHPUT
+        self.sync_threshold = config.SYNC_THRESHOLD_DEFAULT
+        # English-only interface
+        # In-memory rounds, the oldest `spilled` rounds live in history_store
+        self.convo = []
+        self.spilled = 0
+        self.session_id = None
+        # Rounds last published to or loaded from the shared store
+        self.version = 0
+        self.last_active = 0.0
+        self.streaming = False
+        self.registered = False
+        self._current = None
+        # Flattened messages of the finished rounds shown, never rebuilt once
+        # cached, the message count of each of those rounds, and the index
+        # past the last of them
+        self.flat_history = []
+        self.flat_sizes = []
+        self.flat_rounds = 0
+        # (finished rounds, messages, tokens, rounds) sent as context
+        self.context_cache = None
+        # Rule specs of this session's pause policy, None for PAUSE_RULES
+        self.pause_rules = None
+        # (round, settings, CoordinationManager) of the live round
+        self.coordination = None
+        self.initialize_new_round()
+        self.result_editing_toggle = False
+        self.is_seperate_reasoning = False
+        self.in_seperate_reasoning = False
+        # (paused thought, pacer) read ahead while paused
+        self.prefetch = None
+        # (finished thought, pacer) results read ahead for rerolls
+        self.candidates = []
+        # Tokens those read before a reroll took them, used or not
+        self.speculative_tokens = 0
+        # Outcome, tokens and endpoints of the latest run, as traced
+        self.last_run = None
+        # Served over the HTTP API, no chatbot to stream messages to
+        self.headless = False
+
+    def get_api_config(self, language):
+        # Always use primary API since we're English-only now
+        return {
+            "key": config.API_KEY,
+            "url": config.API_URL,
+            "model": config.API_MODEL,
+        }
+
+    @property
+    def current(self):
+        """Live round, reloaded from the history store after an idle eviction"""
+        self.touch()
+        if self._current is None:
+            self.restore()
+        return self._current
+
+    def touch(self):
+        self.last_active = time.time()
+        if not self.registered and config.SESSION_IDLE_SECONDS > 0:
+            with live_sessions_lock:
+                live_sessions.add(self)
+            self.registered = True
+            session_sweeper.start()
+
+    def session_key(self):
+        # Assigned lazily, gr.State deep-copies the initial ConvoState per session
+        if self.session_id is None:
+            self.session_id = uuid.uuid4().hex
+            if history_store is not None and not config.SHARED_SESSIONS:
+                # Rows left at exit expire with HISTORY_TTL
+                weakref.finalize(self, history_store.delete, self.session_id).atexit = False
+        return self.session_id
+
+    def initialize_new_round(self):
+        self._current = ConvoRound()
+        self.convo.append(self._current)
+        if 0 < config.HISTORY_MAX_ROUNDS < len(self.convo):
+            self.spill(len(self.convo) - config.HISTORY_MAX_ROUNDS)
+
+    def next_round(self):
+        """Keep the round just finished and start the next prompt's round"""
+        if self.current.user:
+            self.initialize_new_round()
+
+    def spill(self, count):
+        """Move the oldest count in-memory rounds to the history store"""
+        history_store.save(
+            self.session_key(),
+            self.spilled,
+            [round.fields() for round in self.convo[:count]],
+        )
+        del self.convo[:count]
+        self.spilled += count
+        self.trim_history()
+
+    def trim_history(self):
+        """Forget the flattened rounds spilled over HISTORY_MAX_ROUNDS rounds ago"""
+        first = self.flat_rounds - len(self.flat_sizes)
+        while self.flat_sizes and first < self.spilled - config.HISTORY_MAX_ROUNDS:
+            del self.flat_history[: self.flat_sizes.pop(0)]
+            first += 1
+
+    def release_history(self):
+        """Drop the flattened rounds, spilled ones are reloaded when next needed"""
+        self.flat_history = []
+        self.flat_sizes = []
+        self.flat_rounds = 0
+
+    def hibernate(self):
+        """Spill every round of a session idle past SESSION_IDLE_SECONDS"""
+        with history_store.lock:
+            if (
+                self._current is None
+                or self.streaming
+                or time.time() - self.last_active < config.SESSION_IDLE_SECONDS
+            ):
+                return False
+            self.spill(len(self.convo))
+            self.release_history()
+            self._current = None
+            self.coordination = None
+        return True
+
+    def restore(self):
+        with history_store.lock:
+            if self._current is not None:
+                return
+            start = max(0, self.spilled - (config.HISTORY_MAX_ROUNDS or self.spilled))
+            self.convo = [
+                ConvoRound(*fields)
+                for fields in history_store.load(self.session_key(), start, self.spilled)
+            ]
+            if not config.SHARED_SESSIONS:
+                # Shared rounds stay in the store for the other workers
+                history_store.delete(self.session_id, start)
+            self.spilled = start
+            if self.convo:
+                self._current = self.convo[-1]
+            else:
+                # Expired from the store, start over
+                history_store.delete(self.session_id)
+                self.spilled = 0
+                self.initialize_new_round()
+
+    def adopt_session(self, session_id):
+        """Key this worker's copy of a shared session by the page's session id"""
+        if self.session_id != session_id:
+            self.session_id = session_id
+            self.version = 0
+
+    def sync(self, state):
+        """Apply settings and newer rounds published by another worker"""
+        for name in ("throughput", "sync_threshold", "result_editing_toggle"):
+            if name in state:
+                setattr(self, name, state[name])
+        with history_store.lock:
+            if state.get("version", 0) <= self.version or self.streaming:
+                return
+            self.version = state["version"]
+            # Everything is in the store, reload the tail as after an eviction
+            self.convo = []
+            self.spilled = state["rounds"]
+            self._current = None
+            self.release_history()
+            self.restore()
+
+    def publish(self):
+        """Write the in-memory rounds through to the shared store"""
+        history_store.save(
+            self.session_key(), self.spilled, [round.fields() for round in self.convo]
+        )
+        self.version += 1
+        return {"version": self.version, "rounds": self.spilled + len(self.convo)}
+
+    def coordinator(self, user_prompt):
+        """Pause policy of the live round, rebuilt for a new prompt or settings"""
+        current = self.current
+        settings = (user_prompt, self.sync_threshold, self.pause_rules)
+        if (
+            self.coordination is None
+            or self.coordination[0] is not current
+            or self.coordination[1] != settings
+        ):
+            rules = build_rules(pause_rules if self.pause_rules is None else self.pause_rules)
+            self.coordination = (
+                current, settings, CoordinationManager(self.sync_threshold, rules)
+            )
+        return self.coordination[2]
+
+    def context_messages(self):
+        """Earlier rounds as messages within CONTEXT_TOKENS
+
+        Reassembled only once another round has finished, from the rounds
+        kept in memory.
+        """
+        if not config.CONTEXT_TOKENS:
+            return [], 0, 0
+        current = self.current
+        finished = self.spilled + len(self.convo) - 1
+        if self.context_cache is None or self.context_cache[0] != finished:
+            rounds = [round for round in self.convo if round is not current]
+            self.context_cache = (finished, *assemble_context(rounds, config.CONTEXT_TOKENS))
+        return self.context_cache[1:]
+
+    def update_round(self, stream):
+        current = self.current
+        current.cot = stream.cot
+        current.result = stream.result
+        current.think_complete = stream.think_complete
+
+    def flatten_round(self, round):
+        output = [{"role": "user", "content": round.user}]
+        if len(round.cot) > 0:
+            output.append(
+                {
+                    "role": "assistant",
+                    "content": round.cot,
+                    "metadata": {"title": f"Chain of Thought"},
+                }
+            )
+        if len(round.result) > 0:
+            output.append({"role": "assistant", "content": round.result})
+        return output
+
+    def history_pending(self):
+        """Whether the next frame would read the history store"""
+        return self._current is None or self.flat_rounds < self.spilled
+
+    def load_history(self):
+        """Restore an evicted session and flatten its latest spilled rounds
+
+        Up to HISTORY_MAX_ROUNDS spilled rounds are shown above the rounds
+        in memory.
+        """
+        if self._current is None:
+            self.restore()
+        if self.flat_rounds < self.spilled:
+            first = max(self.flat_rounds, self.spilled - config.HISTORY_MAX_ROUNDS)
+            fields = history_store.load(self.session_key(), first, self.spilled)
+            self.flat_rounds = first
+            for round_fields in fields:
+                self.cache_round(ConvoRound(*round_fields))
+            self.flat_rounds = self.spilled
+
+    def cache_round(self, round):
+        messages = self.flatten_round(round)
+        self.flat_history.extend(messages)
+        self.flat_sizes.append(len(messages))
+        self.flat_rounds += 1
+
+    def flatten_output(self):
+        # Only the live round is rebuilt; finished rounds come from the cache
+        # as the same objects, so Gradio's stream diff sees an unchanged prefix
+        current = self.current
+        self.load_history()
+        finished = self.spilled + len(self.convo) - 1
+        while self.flat_rounds < finished:
+            self.cache_round(self.convo[self.flat_rounds - self.spilled])
+        return self.flat_history + self.flatten_round(current)
+
+    def keep_prefetch(self, run, pacer):
+        """Keep reading upstream while the student thinks over a paused thought"""
+        if (
+            not config.PREFETCH_ON_PAUSE
+            or pacer.shared is None
+            or run.error_msg is not None
+            or run.stream.think_complete
+            or pacer.drained()
+        ):
+            return False
+        pacer.unread(run.stream.pending)
+        pacer.hold(config.PREFETCH_MAX_TOKENS, config.PREFETCH_IDLE_SECONDS)
+        self.prefetch = (run.stream.cot, pacer)
+        return True
+
+    def take_prefetch(self, current_content, producer_type):
+        """Adopt the read-ahead buffer if the paused thought was not edited"""
+        if self.prefetch is None:
+            return None
+        prefix, pacer = self.prefetch
+        self.prefetch = None
+        if (
+            prefix != current_content
+            or not isinstance(pacer.shared.producer, producer_type)
+            or pacer.stopped
+            or pacer.expired()
+        ):
+            stop_upstream(pacer)
+            return None
+        pacer.resume()
+        return pacer
+
+    def discard_prefetch(self):
+        if self.prefetch is not None:
+            stop_upstream(self.prefetch[1])
+            self.prefetch = None
+
+    def speculate(self, run, producer_type):
+        """Read REROLL_CANDIDATES other results of run's finished thought ahead
+
+        Started once the run passes </think>, so a reroll of the unedited
+        thought can swap in a result that is already streaming.
+        """
+        if run.speculated or not run.stream.think_complete or not config.REROLL_CANDIDATES:
+            return
+        run.speculated = True
+        prefix = run.stream.cot + StreamState.THINK_CLOSE
+        if StreamState.THINK_CLOSE in run.current_content and run.current_content != prefix:
+            # Continuing an edited result, not something a reroll resubmits
+            return
+        if self.candidates and self.candidates[0][0] != prefix:
+            self.discard_candidates()
+        asynchronous = producer_type is asyncio.Task
+        while len(self.candidates) < config.REROLL_CANDIDATES and self.reroll_budget_left():
+            pacer = TokenPacer(
+                config.STREAM_FPS, asyncio.Event() if asynchronous else threading.Event()
+            )
+            pacer.hold(config.REROLL_MAX_TOKENS or None, config.PREFETCH_IDLE_SECONDS)
+            shared = SharedStream(pacer.frame_interval)
+            shared.subscribe(pacer)
+            candidate = CandidateRun(run, prefix, pacer)
+            if asynchronous:
+                shared.producer = asyncio.create_task(candidate.aproduce(shared))
+            else:
+                shared.producer = threading.Thread(
+                    target=candidate.produce, args=(shared,), daemon=True
+                )
+                shared.producer.start()
+            self.candidates.append((prefix, pacer))
+
+    def reroll_budget_left(self):
+        """Whether the session may read more results ahead, see REROLL_SESSION_TOKENS"""
+        return (
+            not config.REROLL_SESSION_TOKENS
+            or self.speculative_tokens < config.REROLL_SESSION_TOKENS
+        )
+
+    def take_candidate(self, current_content, producer_type):
+        """Adopt a speculative result if current_content rerolls its thought
+
+        Any other submission means the session moved on and every candidate
+        is dropped.
+        """
+        if not self.candidates:
+            return None
+        if self.candidates[0][0] != current_content:
+            self.discard_candidates()
+            return None
+        usable = []
+        for prefix, pacer in self.candidates:
+            if (
+                isinstance(pacer.shared.producer, producer_type)
+                and not pacer.expired()
+                and not (pacer.done and pacer.error is not None)
+            ):
+                usable.append((prefix, pacer))
+            else:
+                stop_upstream(pacer)
+                stream_metrics.reroll_candidates.inc(outcome="discarded")
+        # Candidates with text buffered go first
+        usable.sort(key=lambda entry: entry[1].idle())
+        self.candidates = []
+        for index, (_, pacer) in enumerate(usable):
+            pacer.resume()
+            # Unless the cost cap stopped it first, it now streams to the end
+            if not pacer.stopped:
+                self.candidates = usable[index + 1:]
+                stream_metrics.reroll_candidates.inc(outcome="used")
+                return pacer
+            stop_upstream(pacer)
+            stream_metrics.reroll_candidates.inc(outcome="discarded")
+        return None
+
+    def discard_candidates(self):
+        for _, pacer in self.candidates:
+            stop_upstream(pacer)
+            stream_metrics.reroll_candidates.inc(outcome="discarded")
+        self.candidates = []
+
+    def stream_output(self):
+        """Chatbot update for a streaming tick, snapshots are sent separately"""
+        if config.STREAM_OUTPUT and not self.headless:
+            return self.flatten_output()
+        return ui_update()
+
+    def generate_ai_response(self, user_prompt, current_content, dynamic_state, client_ip=None):
+        run = GenerationRun(self, user_prompt, current_content, dynamic_state, client_ip)
+        pacer = (
+            self.take_prefetch(current_content, threading.Thread)
+            or self.take_candidate(current_content, threading.Thread)
+            or TokenPacer(config.STREAM_FPS, threading.Event())
+        )
+        run.attach(pacer)
+
+        try:
+            # Initial waiting state update - use ui_update to preserve component
+            if dynamic_state.waiting_api:
+                yield run.waiting_update()
+
+            if pacer.shared is not None:
+                # Continue instantly from what was read ahead during the pause
+                dynamic_state.waiting_api = False
+            elif not run.replay_cached(pacer):
+                shared, leader = run.join_upstream(pacer, "thread")
+                if leader:
+                    # Upstream is read at full speed, pacing only delays the UI side
+                    shared.producer = threading.Thread(
+                        target=run.produce, args=(shared,), daemon=True
+                    )
+                    shared.producer.start()
+
+            shown = False
+            while dynamic_state.should_stream:
+                frame_start = time.monotonic()
+                text = pacer.release(run.pacing_rate())
+                if text is None:
+                    dynamic_state.stream_completed = pacer.error is None
+                    break
+                if text:
+                    shown = True
+                    with run.trace.phase("flush"):
+                        update = run.emit(text, pacer)
+                    self.speculate(run, threading.Thread)
+                    yield update
+                with run.trace.phase("pacing_sleep"):
+                    if not shown and pacer.idle():
+                        # Only the first text is shown as soon as it arrives
+                        pacer.data_ready.wait(pacer.frame_interval)
+                    else:
+                        # Later chunks coalesce into frames at STREAM_FPS
+                        time.sleep(
+                            max(0.0, frame_start + pacer.frame_interval - time.monotonic())
+                        )
+                pacer.data_ready.clear()
+                run.poll_signals()
+
+            # Final update with any held back tag fragment
+            update = run.final_update()
+            if update:
+                yield update
+
+            if pacer.drained() and pacer.error is not None:
+                raise pacer.error
+
+        except Exception as e:
+            run.handle_error(e)
+
+        finally:
+            dynamic_state.should_stream = False
+            run.finish(pacer)
+            if not self.keep_prefetch(run, pacer):
+                stop_upstream(pacer)
+                # Paused or failed, the read-ahead takes a fragment back instead
+                run.commit_pending()
+            publish_session(self.session_id, self, dynamic_state, run_turn=run.turn)
+            yield run.closing_update()
+
+    async def agenerate_ai_response(
+        self, user_prompt, current_content, dynamic_state, client_ip=None
+    ):
+        """Same pipeline as generate_ai_response without holding a worker thread
+
+        Session store reads and writes run in a worker thread instead.
+        """
+        if self.history_pending():
+            await asyncio.to_thread(self.load_history)
+        run = GenerationRun(self, user_prompt, current_content, dynamic_state, client_ip)
+        pacer = (
+            self.take_prefetch(current_content, asyncio.Task)
+            or self.take_candidate(current_content, asyncio.Task)
+            or TokenPacer(config.STREAM_FPS, asyncio.Event())
+        )
+        run.attach(pacer)
+
+        try:
+            if dynamic_state.waiting_api:
+                yield run.waiting_update()
+
+            if pacer.shared is not None:
+                dynamic_state.waiting_api = False
+            elif not run.replay_cached(pacer):
+                shared, leader = run.join_upstream(pacer, asyncio.get_running_loop())
+                if leader:
+                    shared.producer = asyncio.create_task(run.aproduce(shared))
+
+            shown = False
+            while dynamic_state.should_stream:
+                frame_start = time.monotonic()
+                text = pacer.release(run.pacing_rate())
+                if text is None:
+                    dynamic_state.stream_completed = pacer.error is None
+                    break
+                if text:
+                    shown = True
+                    with run.trace.phase("flush"):
+                        update = run.emit(text, pacer)
+                    self.speculate(run, asyncio.Task)
+                    yield update
+                with run.trace.phase("pacing_sleep"):
+                    if not shown and pacer.idle():
+                        try:
+                            await asyncio.wait_for(
+                                pacer.data_ready.wait(), pacer.frame_interval
+                            )
+                        except asyncio.TimeoutError:
+                            pass
+                    else:
+                        await asyncio.sleep(
+                            max(0.0, frame_start + pacer.frame_interval - time.monotonic())
+                        )
+                pacer.data_ready.clear()
+                await run.apoll_signals()
+
+            update = run.final_update()
+            if update:
+                yield update
+
+            if pacer.drained() and pacer.error is not None:
+                raise pacer.error
+
+        except Exception as e:
+            run.handle_error(e)
+
+        finally:
+            dynamic_state.should_stream = False
+            run.finish(pacer)
+            if not self.keep_prefetch(run, pacer):
+                stop_upstream(pacer)
+                # Paused or failed, the read-ahead takes a fragment back instead
+                run.commit_pending()
+            if config.SHARED_SESSIONS:
+                await asyncio.to_thread(
+                    publish_session, self.session_id, self, dynamic_state, run_turn=run.turn
+                )
+            yield run.closing_update()
+
+
+def stop_upstream(pacer):
+    """Detach pacer from its upstream, which stops once nobody else reads it"""
+    pacer.stop()
+    shared = pacer.shared
+    if shared is not None and shared.stopped:
+        # Abort the read in progress rather than wait for the next chunk
+        if isinstance(shared.producer, asyncio.Task):
+            shared.producer.cancel()
+        else:
+            shared.cancel_token.cancel()
+
+
+def attach_session(session_id, convo_state=None, dynamic_state=None):
+    """Bring this worker's copy of a session up to date from the shared store
+
+    With SHARED_SESSIONS any worker may serve any event of a page, so every
+    handler attaches first; session_id is the page's Gradio session hash.
+    """
+    if not config.SHARED_SESSIONS or session_id is None:
+        return
+    state = history_store.get_state(session_id)
+    if convo_state is not None:
+        convo_state.adopt_session(session_id)
+        convo_state.sync(state)
+    if dynamic_state is not None:
+        dynamic_state.sync(state)
+
+
+def publish_session(session_id, convo_state=None, dynamic_state=None, run_turn=None, **fields):
+    """Write what a handler changed back to the shared store
+
+    A run passes run_turn and publishes nothing once a later Generate has
+    taken over the session, so a stream winding down on one worker cannot
+    overwrite the flags of its successor on another.
+    """
+    if not config.SHARED_SESSIONS or session_id is None:
+        return
+    if run_turn is not None and history_store.get_state(session_id).get("turn", 0) != run_turn:
+        return
+    if convo_state is not None:
+        fields.update(convo_state.publish())
+    if dynamic_state is not None:
+        fields.update(dynamic_state.shared_state())
+    history_store.update_state(session_id, **fields)
+
+
+def sweep_idle_sessions():
+    """Evict idle sessions to the history store, run by session_sweeper"""
+    with live_sessions_lock:
+        sessions = list(live_sessions)
+    for session in sessions:
+        session.hibernate()
+    history_store.purge()
+
+
+class GenerationRun:
+    """Per-request streaming state shared by the sync and async pipelines"""
+
+    def __init__(
+        self, convo_state, user_prompt, current_content, dynamic_state, client_ip=None
+    ):
+        self.convo_state = convo_state
+        self.dynamic_state = dynamic_state
+        self.user_prompt = user_prompt
+        self.current_content = current_content
+        self.lang_data = LANGUAGE_CONFIG["en"]
+        self.api_config = convo_state.get_api_config("en")
+        dynamic_state.stream_completed = False
+        self.stream = StreamState(current_content)
+        convo_state.streaming = True
+        convo_state.update_round(self.stream)
+        self.coordinator = convo_state.coordinator(user_prompt)
+        self.editor_output = current_content
+        self.error_msg = None
+        self.received = []
+        self.trace = RequestTrace(stream_metrics)
+        self.source = "upstream"
+        self.request_started = None
+        self.released_before = 0
+        self.tokens_in = 0
+        self.usage = None  # provider reported token usage, summed over attempts
+        self.endpoints = []  # endpoints of every attempt, in order
+        self.retries = 0
+        self.ticket = None  # admission ticket of the producer
+        self.paused = False
+        self.timed_out = False
+        self.client_ip = client_ip
+        self.turn = dynamic_state.turn
+        self.polled = time.monotonic()
+        self.speculated = False
+        # Continuing the same prompt's thought is admitted ahead of new prompts
+        self.resuming = bool(current_content) and convo_state.current.user == user_prompt
+        convo_state.current.user = user_prompt
+        started = time.perf_counter()
+        self.context, context_tokens, self.context_rounds = convo_state.context_messages()
+        self.trace.record("context", time.perf_counter() - started)
+        self.prompt_tokens = (
+            context_tokens + count_tokens(user_prompt) + count_tokens(current_content)
+        )
+        self.request_key = None
+        # Rerolls resubmit a finished thought and must get a fresh sample
+        if StreamState.THINK_CLOSE not in current_content:
+            self.request_key = ResponseCache.request_key(
+                routed_models(),
+                user_prompt,
+                config.TEMPERATURE,
+                config.MAX_TOKENS,
+                self.context,
+            )
+        self.recording = None
+        if stream_recorder is not None:
+            self.recording = stream_recorder.start(
+                convo_state.session_key(),
+                prompt=user_prompt,
+                prefix=current_content,
+                throughput=convo_state.throughput,
+                sync_threshold=convo_state.sync_threshold,
+                # The rules in effect, so a replay does not depend on PAUSE_RULES
+                pause_rules=(
+                    pause_rules if convo_state.pause_rules is None else convo_state.pause_rules
+                ),
+                resuming=self.resuming,
+                fps=config.STREAM_FPS,
+            )
+
+    def record(self, kind, data=None):
+        if self.recording is not None:
+            self.recording.event(kind, data)
+
+    def attach(self, pacer):
+        """Note where this run's text comes from, before anything is released"""
+        self.released_before = pacer.released_tokens
+        if pacer.shared is not None:
+            # Only a finished thought is rerolled, only an unfinished one prefetched
+            self.source = "reroll" if self.stream.think_complete else "prefetch"
+
+    def join_upstream(self, pacer, channel):
+        """Shared stream feeding pacer, and whether this run must produce it
+
+        channel keeps sync and async pipelines, whose pacers wake differently,
+        from sharing a stream.
+        """
+        if config.COALESCE_REQUESTS and self.request_key is not None:
+            shared, leader = stream_coalescer.join(
+                (self.request_key, self.current_content, channel), pacer
+            )
+            if not leader:
+                self.source = "coalesced"
+                stream_metrics.coalesced.inc()
+            return shared, leader
+        shared = SharedStream(pacer.frame_interval)
+        shared.subscribe(pacer)
+        return shared, True
+
+    def editor_label(self, status):
+        return f"{self.lang_data['editor_label']} - {status}"
+
+    def loading_label(self):
+        return self.editor_label(
+            self.lang_data["loading_thinking"]
+            if self.dynamic_state.in_cot
+            else self.lang_data["loading_output"]
+        )
+
+    def waiting_update(self):
+        label = self.editor_label(self.lang_data["waiting_api"])
+        return (
+            ui_update(value=self.current_content, label=label),
+            self.convo_state.stream_output(),
+        )
+
+    def request_params(self, endpoint):
+        # After a failover the new endpoint continues from what was received
+        prefix = self.current_content + "".join(self.received)
+        stream_metrics.prompt_tokens.observe(self.prompt_tokens + self.tokens_in)
+        messages = self.context + [
+            {"role": "user", "content": self.user_prompt},
+            {
+                "role": "assistant",
+                "content": f"<think>\n{prefix}",
+                "prefix": True,
+            },
+        ]
+        return dict(
+            model=endpoint.model,
+            messages=messages,
+            stream=True,
+            timeout=config.API_TIMEOUT,
+            top_p=0.95,
+            temperature=config.TEMPERATURE,
+            max_tokens=config.MAX_TOKENS,
+        )
+
+    def chunk_text(self, chunk):
+        """Text carried by an upstream chunk, reasoning folded into <think>"""
+        convo_state = self.convo_state
+        chunk_content = ""
+        if not chunk.choices:
+            # Providers end the stream with an empty choices chunk
+            return chunk_content
+        if hasattr(chunk.choices[0].delta, "reasoning_content") and chunk.choices[0].delta.reasoning_content:
+            chunk_content = chunk.choices[0].delta.reasoning_content
+            convo_state.is_seperate_reasoning = True
+            convo_state.in_seperate_reasoning = True
+        elif chunk.choices[0].delta.content:
+            chunk_content = chunk.choices[0].delta.content
+            if convo_state.in_seperate_reasoning:
+                chunk_content = "</think>" + chunk_content
+            convo_state.in_seperate_reasoning = False
+        if chunk_content:
+            self.dynamic_state.waiting_api = False
+        return chunk_content
+
+    def replay_cached(self, pacer):
+        """Feed a cached continuation to the pacer instead of calling the API"""
+        if response_cache is None or self.request_key is None:
+            return False
+        continuation = response_cache.lookup(self.request_key, self.current_content)
+        if continuation is None:
+            return False
+        self.dynamic_state.waiting_api = False
+        self.source = "cache"
+        pacer.put(continuation)
+        pacer.close()
+        return True
+
+    def remember_response(self):
+        if response_cache is not None and self.request_key is not None:
+            response_cache.put(
+                self.request_key, self.current_content, "".join(self.received)
+            )
+
+    def receive(self, chunk, pacer, endpoint):
+        if self.request_started is not None:
+            seconds = time.perf_counter() - self.request_started
+            self.trace.record("first_chunk", seconds)
+            api_router.first_chunk(endpoint, seconds)
+            self.request_started = None
+        if self.recording is not None and chunk.choices:
+            delta = chunk.choices[0].delta
+            reasoning = getattr(delta, "reasoning_content", None)
+            if reasoning:
+                self.recording.event("r", reasoning)
+            elif delta.content:
+                self.recording.event("c", delta.content)
+        usage = getattr(chunk, "usage", None)
+        if usage is not None:
+            if self.usage is None:
+                self.usage = {"prompt_tokens": 0, "completion_tokens": 0}
+            self.usage["prompt_tokens"] += usage.prompt_tokens or 0
+            self.usage["completion_tokens"] += usage.completion_tokens or 0
+        text = self.chunk_text(chunk)
+        if text:
+            self.received.append(text)
+            tokens = pacer.put(text)
+            self.tokens_in += tokens
+            stream_metrics.tokens_in.inc(tokens)
+            # Visible to the budgets while the stream still runs
+            admission.charge(self.ticket, tokens)
+
+    def retry_delay(self, error):
+        """Seconds to back off before retrying after error, None to give up
+
+        Endpoints not yet tried by this request are tried at once. Once all
+        have failed, each retry draws on the UPSTREAM_RETRIES budget.
+        """
+        kind = classify_error(error)
+        if kind == "fatal":
+            return None
+        if len(set(self.endpoints)) < len(api_router.endpoints):
+            delay = 0.0
+        elif self.retries < retry_policy.retries:
+            delay = retry_policy.delay(self.retries, error)
+            self.retries += 1
+        else:
+            return None
+        stream_metrics.retries.inc(reason=kind)
+        self.trace.record("backoff", delay)
+        return delay
+
+    def next_endpoint(self, error):
+        """Endpoint for the next attempt, preferring ones not tried yet"""
+        endpoint = api_router.pick(exclude=self.endpoints)
+        if endpoint is None:
+            endpoint = api_router.pick()
+        if error is not None and endpoint is not self.endpoints[-1]:
+            stream_metrics.failovers.inc()
+        self.endpoints.append(endpoint)
+        return endpoint
+
+    def produce(self, pacer):
+        """Read the upstream into the pacer buffer, run on its own thread
+
+        A dropped or timed out attempt is retried, on another endpoint when
+        one is left, continuing after the text received so far.
+        """
+        error = None
+        ticket = self.ticket = admission.submit(
+            self.convo_state.session_key(), self.client_ip, self.resuming
+        )
+        try:
+            # Waits for a slot, given up once every reader has stopped
+            while not ticket.wait(pacer.frame_interval) and not pacer.stopped:
+                admission.dispatch()
+            if ticket.granted:
+                self.trace.record("queue", ticket.waited)
+            while ticket.granted and not pacer.stopped:
+                if error is not None:
+                    delay = self.retry_delay(error)
+                    if delay is None:
+                        break
+                    deadline = time.monotonic() + delay
+                    while time.monotonic() < deadline and not pacer.stopped:
+                        time.sleep(min(pacer.frame_interval, delay))
+                    if pacer.stopped:
+                        break
+                endpoint = self.next_endpoint(error)
+                try:
+                    if self.read_upstream(endpoint, pacer):
+                        self.remember_response()
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+        finally:
+            admission.release(ticket, self.tokens_in)
+        pacer.close(error)
+        if self.recording is not None:
+            # Read ahead past the end of the run
+            self.recording.flush()
+
+    def read_upstream(self, endpoint, pacer):
+        """Stream one attempt into the pacer, True if the upstream completed"""
+        healthy = None
+        error = None
+        response_stream = None
+        token = pacer.cancel_token
+        try:
+            with self.trace.phase("client"):
+                api_client = api_clients.get(
+                    endpoint.url, endpoint.key, config.API_TIMEOUT
+                )
+            self.record("attempt", endpoint.name)
+            self.request_started = time.perf_counter()
+            with self.trace.phase("send"):
+                response_stream = api_client.chat.completions.create(
+                    **self.request_params(endpoint)
+                )
+            token.bind(response_stream)
+            if stall_watchdog is not None:
+                stall_watchdog.watch(token)
+            for chunk in response_stream:
+                while not pacer.has_room() and not pacer.stopped:
+                    if pacer.expired():
+                        pacer.stop()
+                    # Holding back while paused is not a stall
+                    token.chunk()
+                    time.sleep(pacer.frame_interval)
+                if pacer.stopped or pacer.expired():
+                    return False
+                self.receive(chunk, pacer, endpoint)
+                token.chunk()
+            healthy = True
+        except Exception as e:
+            if pacer.stopped:
+                # Aborted through the cancel token once every reader stopped
+                return False
+            healthy, error = False, token.reason or e
+            if error is e:
+                raise
+            raise error from e
+        finally:
+            if stall_watchdog is not None:
+                stall_watchdog.unwatch(token)
+            token.unbind()
+            api_router.release(endpoint, healthy, error)
+            if response_stream is not None:
+                with self.trace.phase("close"):
+                    response_stream.close()
+        return True
+
+    async def aproduce(self, pacer):
+        error = None
+        ticket = self.ticket = admission.submit(
+            self.convo_state.session_key(),
+            self.client_ip,
+            self.resuming,
+            asyncio.get_running_loop(),
+        )
+        try:
+            while not await ticket.await_grant(pacer.frame_interval) and not pacer.stopped:
+                admission.dispatch()
+            if ticket.granted:
+                self.trace.record("queue", ticket.waited)
+            while ticket.granted and not pacer.stopped:
+                if error is not None:
+                    delay = self.retry_delay(error)
+                    if delay is None:
+                        break
+                    deadline = time.monotonic() + delay
+                    while time.monotonic() < deadline and not pacer.stopped:
+                        await asyncio.sleep(min(pacer.frame_interval, delay))
+                    if pacer.stopped:
+                        break
+                endpoint = self.next_endpoint(error)
+                try:
+                    if await self.aread_upstream(endpoint, pacer):
+                        self.remember_response()
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+        finally:
+            admission.release(ticket, self.tokens_in)
+        pacer.close(error)
+        if self.recording is not None:
+            # Read ahead past the end of the run
+            self.recording.flush()
+
+    async def aread_upstream(self, endpoint, pacer):
+        healthy = None
+        error = None
+        response_stream = None
+        try:
+            with self.trace.phase("client"):
+                api_client = api_clients.get_async(
+                    endpoint.url, endpoint.key, config.API_TIMEOUT
+                )
+            self.record("attempt", endpoint.name)
+            self.request_started = time.perf_counter()
+            with self.trace.phase("send"):
+                response_stream = await api_client.chat.completions.create(
+                    **self.request_params(endpoint)
+                )
+            chunks = response_stream.__aiter__()
+            # The first chunk is bounded by the request timeout alone
+            stall_timeout = None
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), stall_timeout)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise UpstreamStalled(f"No upstream chunk for {stall_timeout:.0f}s")
+                stall_timeout = config.STALL_TIMEOUT or None
+                while not pacer.has_room() and not pacer.stopped:
+                    if pacer.expired():
+                        pacer.stop()
+                    await asyncio.sleep(pacer.frame_interval)
+                if pacer.stopped or pacer.expired():
+                    return False
+                self.receive(chunk, pacer, endpoint)
+            healthy = True
+        except Exception as e:
+            healthy, error = False, e
+            raise
+        finally:
+            api_router.release(endpoint, healthy, error)
+            if response_stream is not None:
+                with self.trace.phase("close"):
+                    await response_stream.close()
+        return True
+
+    def poll_due(self):
+        if not config.SHARED_SESSIONS or self.convo_state.session_id is None:
+            return False
+        now = time.monotonic()
+        if now - self.polled < config.SESSION_POLL_SECONDS:
+            return False
+        self.polled = now
+        return True
+
+    def apply_signals(self, state):
+        if state.get("turn", self.turn) != self.turn or state.get("should_stream") is False:
+            self.dynamic_state.should_stream = False
+
+    def poll_signals(self):
+        """Stop on a pause pressed on another worker, seen through the store"""
+        if self.poll_due():
+            self.apply_signals(history_store.get_state(self.convo_state.session_id))
+
+    async def apoll_signals(self):
+        """poll_signals reading the store off the event loop"""
+        if self.poll_due():
+            self.apply_signals(
+                await asyncio.to_thread(history_store.get_state, self.convo_state.session_id)
+            )
+
+    def pacing_rate(self):
+        """Tokens per second for the next frame, None streams unpaced"""
+        if self.dynamic_state.in_cot:
+            return self.convo_state.throughput
+        return None
+
+    def emit(self, text, pacer):
+        """Apply released text to the round and build the UI update"""
+        convo_state = self.convo_state
+        # Coalesced runs get their text without seeing an upstream chunk
+        self.dynamic_state.waiting_api = False
+        rule = None
+        if self.stream.think_complete:
+            self.stream.feed(text)
+        else:
+            # The policy sees each piece of thought once, token by token so a
+            # frame holding several pause points stops at the first one
+            pieces = split_tokens(text)
+            for index, piece in enumerate(pieces):
+                cot_length = len(self.stream.cot)
+                self.stream.feed(piece)
+                rule = self.coordinator.should_pause_for_human(self.stream.cot[cot_length:])
+                if self.stream.think_complete:
+                    rule = None
+                if rule is not None:
+                    rest = "".join(pieces[index + 1:])
+                    if rest:
+                        pacer.unread(rest)
+                        text = text[: len(text) - len(rest)]
+                    break
+        self.record("f", len(text))
+
+        # Update Convo State
+        convo_state.update_round(self.stream)
+        self.dynamic_state.in_cot = not self.stream.think_complete
+
+        if rule is not None:
+            self.dynamic_state.should_stream = False
+            self.paused = True
+            stream_metrics.coordinator_pauses.inc(rule=rule)
+            self.record("p", rule)
+
+        self.editor_output = self.stream.editor_text(convo_state.result_editing_toggle)
+        # Use ui_update to preserve component and update both value and label
+        return (
+            ui_update(value=self.editor_output, label=self.loading_label()),
+            convo_state.stream_output(),
+        )
+
+    def commit_pending(self):
+        """Keep a tag fragment held back when the stream ended as plain text"""
+        if not self.stream.pending:
+            return False
+        self.stream.flush()
+        self.convo_state.update_round(self.stream)
+        self.editor_output = self.stream.editor_text(
+            self.convo_state.result_editing_toggle
+        )
+        return True
+
+    def final_update(self):
+        if not (self.dynamic_state.should_stream and self.commit_pending()):
+            return None
+        return (
+            ui_update(value=self.editor_output, label=self.loading_label()),
+            self.convo_state.stream_output(),
+        )
+
+    def handle_error(self, e):
+        if classify_error(e) in ("timeout", "stall"):
+            self.error_msg = self.lang_data["api_interrupted"]
+            self.timed_out = True
+            stream_metrics.timeouts.inc()
+        else:
+            self.error_msg = "❓ " + str(e)
+        self.dynamic_state.label_passthrough = True
+
+    def finish(self, pacer):
+        """Record the outcome in the metrics and the per-request trace log"""
+        self.convo_state.streaming = False
+        tokens_out = pacer.released_tokens - self.released_before
+        stream_metrics.tokens_out.inc(tokens_out)
+        if self.error_msg is not None:
+            outcome = "timeout" if self.timed_out else "error"
+        elif self.dynamic_state.stream_completed:
+            outcome = "completed"
+        elif self.paused:
+            outcome = "paused"
+        else:
+            outcome = "cancelled"
+        fields = dict(
+            source=self.source,
+            model=self.api_config["model"],
+            prompt_chars=len(self.user_prompt),
+            prefix_chars=len(self.current_content),
+            tokens_in=self.tokens_in,
+            tokens_out=tokens_out,
+            usage=self.usage,
+            endpoints=[endpoint.name for endpoint in self.endpoints],
+            retries=len(self.endpoints) - 1 if self.endpoints else 0,
+            context_rounds=self.context_rounds,
+            prompt_tokens=self.prompt_tokens,
+        )
+        self.trace.finish(outcome, **fields)
+        if self.recording is not None:
+            self.recording.event(
+                "end",
+                dict(
+                    outcome=outcome,
+                    source=self.source,
+                    tokens_in=self.tokens_in,
+                    tokens_out=tokens_out,
+                ),
+            )
+            self.recording.flush()
+        self.convo_state.last_run = dict(outcome=outcome, error=self.error_msg, **fields)
+
+    def closing_update(self):
+        messages = self.convo_state.flatten_output()
+        if self.error_msg is not None:
+            return ui_update(
+                value=self.editor_output, label=self.editor_label(self.error_msg)
+            ), messages + [
+                {
+                    "role": "assistant",
+                    "content": self.error_msg,
+                    "metadata": {"title": f"❌Error"},
+                }
+            ]
+        final_status = (
+            self.lang_data["completed"]
+            if self.dynamic_state.stream_completed
+            else self.lang_data["interrupted"]
+        )
+        return (
+            ui_update(value=self.editor_output, label=self.editor_label(final_status)),
+            messages,
+        )
+
+
+class CandidateRun(GenerationRun):
+    """Speculative result of a finished thought, held for a reroll
+
+    Reads its upstream like a run's producer but leaves the session's round
+    and flags alone; the text waits in a held pacer until a reroll adopts it.
+    """
+
+    def __init__(self, run, prefix, held):
+        self.held = held
+        self.convo_state = run.convo_state
+        self.user_prompt = run.user_prompt
+        self.context = run.context
+        self.prompt_tokens = run.prompt_tokens
+        self.current_content = prefix
+        self.api_config = run.api_config
+        self.client_ip = run.client_ip
+        self.resuming = False
+        self.request_key = None
+        self.received = []
+        self.trace = RequestTrace(stream_metrics)
+        self.request_started = None
+        self.tokens_in = 0
+        self.usage = None
+        self.endpoints = []
+        self.retries = 0
+        self.ticket = None
+        self.recording = None
+
+    def chunk_text(self, chunk):
+        if not chunk.choices:
+            return ""
+        return chunk.choices[0].delta.content or ""
+
+    def receive(self, chunk, pacer, endpoint):
+        tokens_in = self.tokens_in
+        super().receive(chunk, pacer, endpoint)
+        convo_state = self.convo_state
+        if self.held.hold_deadline is not None:
+            convo_state.speculative_tokens += self.tokens_in - tokens_in
+            if not convo_state.reroll_budget_left():
+                # The session spent its budget, unless a reroll just took it
+                self.held.stop_if_held()
+                return
+        # Unused at the cost cap, a reroll then reads its own result
+        self.held.stop_if_full()
+
+    def produce(self, pacer):
+        try:
+            super().produce(pacer)
+        finally:
+            self.finish_trace()
+
+    async def aproduce(self, pacer):
+        try:
+            await super().aproduce(pacer)
+        finally:
+            # Also when discarded, which cancels the task
+            self.finish_trace()
+
+    def finish_trace(self):
+        self.trace.finish(
+            "speculative",
+            source="candidate",
+            model=self.api_config["model"],
+            prompt_chars=len(self.user_prompt),
+            prefix_chars=len(self.current_content),
+            tokens_in=self.tokens_in,
+            usage=self.usage,
+            endpoints=[endpoint.name for endpoint in self.endpoints],
+        )
+
+
+def encode_persistent(prompt, thought, compress=True):
+    """BrowserState payload for a draft, capped at PERSIST_MAX_BYTES
+
+    Compressed drafts replace the stored value wholesale, so streams keep
+    their intermediate writes plain and Gradio sends them as appends. Past
+    the cap the thought is cut from the end; a shorter prefix still resumes.
+    """
+    while True:
+        state = {"prompt_input": prompt, "thought_editor": thought}
+        size = len(json.dumps(state))
+        if compress and size >= 512:
+            raw = json.dumps(state).encode("utf-8")
+            state = {"z": base64.b64encode(zlib.compress(raw)).decode("ascii")}
+            size = len(state["z"])
+        if size <= config.PERSIST_MAX_BYTES or not thought:
+            return state
+        thought = thought[: len(thought) * 3 // 4]
+
+
+def decode_persistent(state):
+    """Draft from a BrowserState payload, plain or as encode_persistent() packs it"""
+    if not state:
+        return DEFAULT_PERSISTENT
+    if "z" in state:
+        try:
+            state = json.loads(zlib.decompress(base64.b64decode(state["z"])))
+        except (ValueError, zlib.error):
+            return DEFAULT_PERSISTENT
+    return {key: state.get(key) or "" for key in DEFAULT_PERSISTENT}
+
+
+class PersistThrottle:
+    """Decides which frames of a stream write the draft to BrowserState
+
+    The first frame and the last, once the run stopped streaming, always
+    write, the last one compressed; frames between write at most every
+    PERSIST_INTERVAL seconds. Other frames repeat the payload last written,
+    which Gradio sends as an empty diff and the browser does not store again.
+    """
+
+    def __init__(self):
+        self.written_at = None
+        self.written = None
+        self.payload = None
+
+    def update(self, convo_state):
+        current = convo_state.current
+        draft = (current.user, current.cot, convo_state.streaming)
+        now = time.monotonic()
+        if draft == self.written or (
+            convo_state.streaming
+            and self.written_at is not None
+            and now - self.written_at < config.PERSIST_INTERVAL
+        ):
+            return self.payload
+        self.written_at = now
+        self.written = draft
+        self.payload = encode_persistent(
+            current.user, current.cot, compress=not convo_state.streaming
+        )
+        return self.payload
+
+
+def stream_response(
+    convo_state, dynamic_state, prompt, content, client_ip=None, session_id=None
+):
+    """Editor update, chatbot messages and persistent state per UI frame"""
+    attach_session(session_id, convo_state, dynamic_state)
+    persist = PersistThrottle()
+    for editor_update, messages in convo_state.generate_ai_response(
+        prompt, content, dynamic_state, client_ip
+    ):
+        yield editor_update, messages, persist.update(convo_state)
+
+
+async def astream_response(
+    convo_state, dynamic_state, prompt, content, client_ip=None, session_id=None
+):
+    if config.SHARED_SESSIONS:
+        await asyncio.to_thread(attach_session, session_id, convo_state, dynamic_state)
+    persist = PersistThrottle()
+    async for editor_update, messages in convo_state.agenerate_ai_response(
+        prompt, content, dynamic_state, client_ip
+    ):
+        yield editor_update, messages, persist.update(convo_state)
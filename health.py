@@ -0,0 +1,198 @@
+"""Upstream warm-up at startup, background probes and readiness
+
+The probe runs on the server's event loop through the same pooled clients
+generations use, so the connections it opens are the ones the first student
+reuses. At startup it opens `connections` connections to every endpoint and,
+with a warm-up prompt, times a one-token streaming request. Afterwards it
+checks every endpoint again each `interval` seconds, which keeps a
+connection alive and the reachability behind /readyz current.
+"""
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+def reached(error):
+    """Whether an upstream that answered with error can still stream"""
+    status = getattr(error, "status_code", None)
+    # A provider without a models route still answered, a rejected key did not
+    return status is not None and status < 500 and status not in (401, 403)
+
+
+class UpstreamProbe:
+    """Warms up and probes every endpoint, keeping their status for /readyz"""
+
+    def __init__(
+        self,
+        router,
+        clients,
+        timeout,
+        probe_timeout,
+        connections=1,
+        prompt="",
+        interval=0,
+        use_async=True,
+    ):
+        self.router = router
+        self.clients = clients
+        self.timeout = timeout
+        self.probe_timeout = probe_timeout
+        self.connections = connections
+        self.prompt = prompt
+        self.interval = interval
+        self.use_async = use_async
+        self.warmed = False
+        self.status = {
+            endpoint.name: {
+                "reachable": None,
+                "latency_ms": None,
+                "warmup_ttft_ms": None,
+                "checked": None,
+                "error": None,
+            }
+            for endpoint in router.endpoints
+        }
+        self._task = None
+
+    def start(self):
+        """Warm up, then probe in the background of the running event loop"""
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def run(self):
+        started = time.perf_counter()
+        if self.connections > 0 or self.prompt:
+            # The SDK takes most of a second to import, not on the event loop
+            await asyncio.to_thread(__import__, "openai")
+            await asyncio.gather(*(
+                self.check(endpoint, warm_up=True) for endpoint in self.router.endpoints
+            ))
+        self.warmed = True
+        for name, status in self.status.items():
+            logger.info(
+                "Upstream %s %s in %s ms, first token in %s ms",
+                name,
+                "reachable" if status["reachable"] else "unreachable",
+                status["latency_ms"],
+                status["warmup_ttft_ms"],
+            )
+        logger.info("Warm-up done in %.0f ms", (time.perf_counter() - started) * 1000)
+        while self.interval > 0:
+            await asyncio.sleep(self.interval)
+            await asyncio.gather(*(self.check(endpoint) for endpoint in self.router.endpoints))
+
+    async def check(self, endpoint, warm_up=False):
+        status = self.status[endpoint.name]
+        started = time.perf_counter()
+        try:
+            if self.use_async:
+                client = self.clients.get_async(endpoint.url, endpoint.key, self.timeout)
+            else:
+                client = self.clients.get(endpoint.url, endpoint.key, self.timeout)
+            # Concurrent requests each open a connection of their own
+            connections = max(1, self.connections) if warm_up else 1
+            await asyncio.gather(*(self.list_models(client) for _ in range(connections)))
+            status.update(reachable=True, error=None)
+        except Exception as e:
+            status.update(reachable=reached(e), error=str(e) or type(e).__name__)
+        status["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        status["checked"] = time.time()
+        if warm_up and self.prompt and status["reachable"]:
+            try:
+                seconds = await self.first_token(client, endpoint)
+            except Exception as e:
+                status["error"] = str(e) or type(e).__name__
+            else:
+                status["warmup_ttft_ms"] = round(seconds * 1000, 1)
+                # Routing starts from the measured latency instead of a guess
+                self.router.first_chunk(endpoint, seconds)
+
+    async def list_models(self, client):
+        if self.use_async:
+            await client.models.list(timeout=self.probe_timeout)
+        else:
+            await asyncio.to_thread(client.models.list, timeout=self.probe_timeout)
+
+    async def first_token(self, client, endpoint):
+        """Seconds to the first chunk of a one-token streaming request"""
+        params = dict(
+            model=endpoint.model,
+            messages=[{"role": "user", "content": self.prompt}],
+            max_tokens=1,
+            stream=True,
+        )
+        if not self.use_async:
+            return await asyncio.to_thread(self.first_token_sync, client, params)
+        started = time.perf_counter()
+        response_stream = await client.chat.completions.create(**params)
+        try:
+            async for _ in response_stream:
+                break
+            return time.perf_counter() - started
+        finally:
+            await response_stream.close()
+
+    def first_token_sync(self, client, params):
+        started = time.perf_counter()
+        response_stream = client.chat.completions.create(**params)
+        try:
+            for _ in response_stream:
+                break
+            return time.perf_counter() - started
+        finally:
+            response_stream.close()
+
+    def reachable(self):
+        """False once every endpoint failed its last check, unknown counts as up"""
+        return any(status["reachable"] is not False for status in self.status.values())
+
+
+def readiness(probe, admission, max_waiting=0):
+    """(ready, report) from the probe and the admission queue
+
+    Not ready while warming up, with no endpoint reachable, or with
+    max_waiting or more requests queued for an upstream slot (0 never
+    counts the queue as saturated).
+    """
+    stats = admission.stats()
+    capped = admission.max_streams != float("inf")
+    queue = {
+        "active": stats["active"],
+        "waiting": stats["waiting"],
+        "max_streams": admission.max_streams if capped else None,
+        "saturation": round(stats["active"] / admission.max_streams, 3) if capped else 0.0,
+        "saturated": bool(max_waiting) and stats["waiting"] >= max_waiting,
+    }
+    now = time.time()
+    upstreams = {}
+    for name, status in probe.status.items():
+        upstreams[name] = dict(status)
+        checked = upstreams[name].pop("checked")
+        upstreams[name]["seconds_since_check"] = (
+            None if checked is None else round(now - checked, 1)
+        )
+    reasons = []
+    if not probe.warmed:
+        reasons.append("warming up")
+    if not probe.reachable():
+        reasons.append("no upstream reachable")
+    if queue["saturated"]:
+        reasons.append("admission queue saturated")
+    report = {
+        "status": "ready" if not reasons else "not ready",
+        "reasons": reasons,
+        "upstreams": upstreams,
+        "queue": queue,
+    }
+    return not reasons, report
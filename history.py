@@ -0,0 +1,302 @@
+import json
+import logging
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryStore:
+    """SQLite spill store for conversation rounds evicted from memory
+
+    Rows are keyed by (session_id, round index) and hold the round fields as
+    given to save(). Next to the rounds every session has a small state of
+    named JSON values, shared by the worker processes using the same file.
+    Rows not touched for longer than ttl belong to sessions that are gone.
+    """
+
+    def __init__(self, path, ttl):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rounds ("
+            "session_id TEXT, idx INTEGER, user TEXT, cot TEXT, result TEXT, "
+            "think_complete INTEGER, touched REAL, "
+            "PRIMARY KEY (session_id, idx))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS rounds_touched ON rounds (touched)")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "session_id TEXT, name TEXT, value TEXT, touched REAL, "
+            "PRIMARY KEY (session_id, name))"
+        )
+        self._db.commit()
+        self.purge()
+
+    def save(self, session_id, start, rounds):
+        """Store rounds as (user, cot, result, think_complete) from index start"""
+        now = time.time()
+        with self.lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO rounds VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (session_id, start + offset, *fields, now)
+                    for offset, fields in enumerate(rounds)
+                ],
+            )
+            self._db.commit()
+
+    def load(self, session_id, start, stop):
+        with self.lock:
+            self._db.execute(
+                "UPDATE rounds SET touched = ? WHERE session_id = ?",
+                (time.time(), session_id),
+            )
+            rows = self._db.execute(
+                "SELECT user, cot, result, think_complete FROM rounds "
+                "WHERE session_id = ? AND idx >= ? AND idx < ? ORDER BY idx",
+                (session_id, start, stop),
+            ).fetchall()
+            self._db.commit()
+        return [(user, cot, result, bool(think)) for user, cot, result, think in rows]
+
+    def delete(self, session_id, start=0):
+        with self.lock:
+            self._db.execute(
+                "DELETE FROM rounds WHERE session_id = ? AND idx >= ?",
+                (session_id, start),
+            )
+            self._db.commit()
+
+    def get_state(self, session_id):
+        with self.lock:
+            rows = self._db.execute(
+                "SELECT name, value FROM state WHERE session_id = ?", (session_id,)
+            ).fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    def update_state(self, session_id, **fields):
+        now = time.time()
+        with self.lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO state VALUES (?, ?, ?, ?)",
+                [(session_id, name, json.dumps(value), now) for name, value in fields.items()],
+            )
+            self._db.commit()
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            self._db.execute("DELETE FROM rounds WHERE touched < ?", (cutoff,))
+            self._db.execute("DELETE FROM state WHERE touched < ?", (cutoff,))
+            self._db.commit()
+
+    def close(self):
+        with self.lock:
+            self._db.close()
+
+
+class MemoryHistoryStore:
+    """HistoryStore kept in this process, for a single worker"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.RLock()
+        self._rounds = {}  # session_id -> {index: fields}
+        self._states = {}
+        self._touched = {}
+
+    def save(self, session_id, start, rounds):
+        with self.lock:
+            stored = self._rounds.setdefault(session_id, {})
+            for offset, fields in enumerate(rounds):
+                stored[start + offset] = tuple(fields)
+            self._touched[session_id] = time.time()
+
+    def load(self, session_id, start, stop):
+        with self.lock:
+            self._touched[session_id] = time.time()
+            stored = self._rounds.get(session_id, {})
+            return [stored[index] for index in range(start, stop) if index in stored]
+
+    def delete(self, session_id, start=0):
+        with self.lock:
+            stored = self._rounds.get(session_id, {})
+            for index in [index for index in stored if index >= start]:
+                del stored[index]
+
+    def get_state(self, session_id):
+        with self.lock:
+            return dict(self._states.get(session_id, {}))
+
+    def update_state(self, session_id, **fields):
+        with self.lock:
+            self._states.setdefault(session_id, {}).update(fields)
+            self._touched[session_id] = time.time()
+
+    def purge(self):
+        cutoff = time.time() - self.ttl
+        with self.lock:
+            for session_id in [s for s, touched in self._touched.items() if touched < cutoff]:
+                self._rounds.pop(session_id, None)
+                self._states.pop(session_id, None)
+                del self._touched[session_id]
+
+    def close(self):
+        pass
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisHistoryStore:
+    """HistoryStore on a Redis-protocol server, shared by every worker
+
+    A session's rounds live in the hash aei:rounds:<id> keyed by round index
+    and its state in the hash aei:state:<id>; both expire ttl seconds after
+    their last write, so purge() has nothing to do. Speaks RESP directly over
+    one connection, no client library needed.
+    """
+
+    def __init__(self, url, ttl):
+        parts = urlsplit(url)
+        self.address = (parts.hostname or "127.0.0.1", parts.port or 6379)
+        self.database = int(parts.path.lstrip("/") or 0)
+        self.ttl = int(ttl)
+        self.lock = threading.RLock()
+        self._sock = None
+        self._reader = None
+
+    def _connect(self):
+        self._sock = socket.create_connection(self.address, timeout=10)
+        self._reader = self._sock.makefile("rb")
+        if self.database:
+            self._send("SELECT", self.database)
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = self._reader = None
+
+    def _send(self, *args):
+        payload = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            payload.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self._sock.sendall(b"".join(payload))
+        return self._read()
+
+    def _read(self):
+        line = self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, body = line[:1], line[1:-2]
+        if kind == b"+":
+            return body.decode("utf-8")
+        if kind == b"-":
+            raise RedisError(body.decode("utf-8"))
+        if kind == b":":
+            return int(body)
+        if kind == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            return self._reader.read(length + 2)[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(body)
+            return None if length < 0 else [self._read() for _ in range(length)]
+        raise RedisError(f"Unexpected reply {line!r}")
+
+    def command(self, *args):
+        """Run one command, reconnecting once if the connection dropped"""
+        with self.lock:
+            for attempt in (0, 1):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    return self._send(*args)
+                except (ConnectionError, OSError):
+                    self._disconnect()
+                    if attempt:
+                        raise
+
+    def save(self, session_id, start, rounds):
+        if not rounds:
+            return
+        key = f"aei:rounds:{session_id}"
+        values = []
+        for offset, fields in enumerate(rounds):
+            values += [start + offset, json.dumps(list(fields))]
+        with self.lock:
+            self.command("HSET", key, *values)
+            self.command("EXPIRE", key, self.ttl)
+
+    def load(self, session_id, start, stop):
+        if stop <= start:
+            return []
+        key = f"aei:rounds:{session_id}"
+        with self.lock:
+            values = self.command("HMGET", key, *range(start, stop))
+            self.command("EXPIRE", key, self.ttl)
+        return [tuple(json.loads(value)) for value in values if value is not None]
+
+    def delete(self, session_id, start=0):
+        key = f"aei:rounds:{session_id}"
+        with self.lock:
+            if start == 0:
+                self.command("DEL", key)
+                return
+            indexes = [index for index in self.command("HKEYS", key) if int(index) >= start]
+            if indexes:
+                self.command("HDEL", key, *indexes)
+
+    def get_state(self, session_id):
+        values = self.command("HGETALL", f"aei:state:{session_id}") or []
+        return {values[i]: json.loads(values[i + 1]) for i in range(0, len(values), 2)}
+
+    def update_state(self, session_id, **fields):
+        key = f"aei:state:{session_id}"
+        values = []
+        for name, value in fields.items():
+            values += [name, json.dumps(value)]
+        with self.lock:
+            self.command("HSET", key, *values)
+            self.command("EXPIRE", key, self.ttl)
+
+    def purge(self):
+        pass
+
+    def close(self):
+        with self.lock:
+            self._disconnect()
+
+
+class IdleSweeper:
+    """Daemon thread calling sweep() every interval seconds once started"""
+
+    def __init__(self, interval, sweep):
+        self.interval = interval
+        self.sweep = sweep
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception("Session sweep failed")
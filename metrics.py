@@ -0,0 +1,252 @@
+import json
+import logging
+import threading
+import time
+
+trace_logger = logging.getLogger("aei.trace")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self, kind="counter"):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {kind}"]
+        with self._lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_label_text(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge(Counter):
+    """Gauge set directly or read from a callback at scrape time
+
+    A callback returns the value, or a dict of label values tuple -> value.
+    """
+
+    def __init__(self, name, help, labels=(), callback=None):
+        super().__init__(name, help, labels)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            self.values[key] = value
+
+    def render(self, kind="gauge"):
+        if self.callback is not None:
+            values = self.callback()
+            with self._lock:
+                self.values = values if isinstance(values, dict) else {(): values}
+        return super().render(kind)
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # labels -> [bucket counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels[name] for name in self.labels)
+        with self._lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _label_text(self.labels + ("le",), key + (bound,))
+                    lines.append(f"{self.name}_bucket{labels} {cumulative}")
+                labels = _label_text(self.labels + ("le",), key + ("+Inf",))
+                lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _label_text(self.labels, key)
+                lines.append(f"{self.name}_sum{labels} {total}")
+                lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+class MetricsRegistry:
+    """Minimal Prometheus text-format registry, no client library needed"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labels=()):
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, help, labels=(), callback=None):
+        metric = Gauge(name, help, labels, callback)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class StreamMetrics:
+    """Hot-path counters and timings of the streaming pipeline"""
+
+    def __init__(self):
+        self.registry = MetricsRegistry()
+        self.phase_seconds = self.registry.histogram(
+            "aei_phase_seconds",
+            "Time spent per generation phase: context, queue, backoff, client, send, first_chunk, flush, pacing_sleep, close",
+            ("phase",),
+        )
+        self.prompt_tokens = self.registry.histogram(
+            "aei_prompt_tokens",
+            "Approximate prompt tokens per upstream request, earlier rounds included",
+            buckets=(64, 256, 1024, 2048, 4096, 8192, 16384, 32768, 65536),
+        )
+        self.tokens_in = self.registry.counter(
+            "aei_tokens_in_total", "Approximate tokens received from upstream"
+        )
+        self.tokens_out = self.registry.counter(
+            "aei_tokens_out_total", "Approximate tokens released to the UI"
+        )
+        self.coordinator_pauses = self.registry.counter(
+            "aei_coordinator_pauses_total",
+            "Pauses triggered by the pause policy, by rule",
+            ("rule",),
+        )
+        self.timeouts = self.registry.counter(
+            "aei_upstream_timeouts_total", "Upstream read timeouts"
+        )
+        self.retries = self.registry.counter(
+            "aei_upstream_retries_total",
+            "Upstream attempts retried after a failure, by error kind",
+            ("reason",),
+        )
+        self.failovers = self.registry.counter(
+            "aei_upstream_failovers_total", "Attempts retried on another endpoint"
+        )
+        self.coalesced = self.registry.counter(
+            "aei_coalesced_requests_total",
+            "Requests served by joining an identical in-flight upstream stream",
+        )
+        self.streams = self.registry.counter(
+            "aei_streams_total",
+            "Finished generations by outcome: completed, paused, cancelled, timeout, error, speculative",
+            ("outcome",),
+        )
+        self.reroll_candidates = self.registry.counter(
+            "aei_reroll_candidates_total",
+            "Speculative reroll results by fate: used, discarded",
+            ("outcome",),
+        )
+        self.active_streams = self.registry.gauge(
+            "aei_active_streams", "Generations currently streaming"
+        )
+        self._active = 0
+        self._lock = threading.Lock()
+
+    def stream_started(self):
+        with self._lock:
+            self._active += 1
+            self.active_streams.set(self._active)
+
+    def stream_finished(self, outcome):
+        with self._lock:
+            self._active -= 1
+            self.active_streams.set(self._active)
+        self.streams.inc(outcome=outcome)
+
+    def render(self):
+        return self.registry.render()
+
+
+class RequestTrace:
+    """Phase timings of one generation, observed into metrics as they happen
+
+    finish() writes one JSON line to the aei.trace logger, which is only
+    configured when a trace log is enabled.
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        metrics.stream_started()
+        self.started = time.time()
+        self.phases = {}
+        self.fields = {}
+
+    def phase(self, name):
+        return _PhaseTimer(self, name)
+
+    def record(self, name, seconds):
+        self.metrics.phase_seconds.observe(seconds, phase=name)
+        total, count = self.phases.get(name, (0.0, 0))
+        self.phases[name] = (total + seconds, count + 1)
+
+    def finish(self, outcome, **fields):
+        self.metrics.stream_finished(outcome)
+        if not trace_logger.isEnabledFor(logging.INFO):
+            return
+        record = {
+            "ts": round(self.started, 3),
+            "duration_ms": round((time.time() - self.started) * 1000, 1),
+            "outcome": outcome,
+            "phases_ms": {
+                name: round(total * 1000, 2) for name, (total, _) in self.phases.items()
+            },
+            "flushes": self.phases.get("flush", (0.0, 0))[1],
+        }
+        record.update(self.fields)
+        record.update(fields)
+        trace_logger.info(json.dumps(record))
+
+
+class _PhaseTimer:
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.record(self.name, time.perf_counter() - self.start)
+        return False
@@ -0,0 +1,128 @@
+"""Redis-protocol stand-in for the shared session store
+
+Serves the handful of RESP commands RedisHistoryStore uses (hashes, DEL,
+EXPIRE, SELECT, PING) from memory, so SESSION_STORE=redis can be run and
+tested across worker processes without a Redis server.
+
+    python mock_redis.py --port 6379
+"""
+import argparse
+import asyncio
+import time
+
+
+class MockRedis:
+    """Keyspace of hashes with expiry, shared by every connection"""
+
+    def __init__(self):
+        self.hashes = {}
+        self.expires = {}
+
+    def _hash(self, key, create=False):
+        deadline = self.expires.get(key)
+        if deadline is not None and deadline <= time.monotonic():
+            self.hashes.pop(key, None)
+            del self.expires[key]
+        if create:
+            return self.hashes.setdefault(key, {})
+        return self.hashes.get(key, {})
+
+    def execute(self, name, args):
+        if name == "PING":
+            return "PONG"
+        if name == "SELECT":
+            return "OK"
+        if name == "HSET":
+            values = self._hash(args[0], create=True)
+            added = 0
+            for field, value in zip(args[1::2], args[2::2]):
+                added += field not in values
+                values[field] = value
+            return added
+        if name == "HMGET":
+            values = self._hash(args[0])
+            return [values.get(field) for field in args[1:]]
+        if name == "HGETALL":
+            return [item for pair in self._hash(args[0]).items() for item in pair]
+        if name == "HKEYS":
+            return list(self._hash(args[0]))
+        if name == "HDEL":
+            values = self._hash(args[0])
+            return sum(values.pop(field, None) is not None for field in args[1:])
+        if name == "DEL":
+            removed = sum(self._hash(key) != {} for key in args)
+            for key in args:
+                self.hashes.pop(key, None)
+                self.expires.pop(key, None)
+            return removed
+        if name == "EXPIRE":
+            if not self._hash(args[0]):
+                return 0
+            self.expires[args[0]] = time.monotonic() + int(args[1])
+            return 1
+        raise ValueError(f"unknown command '{name}'")
+
+
+def encode(value):
+    if isinstance(value, Exception):
+        return f"-ERR {value}\r\n".encode("utf-8")
+    if value is None:
+        return b"$-1\r\n"
+    if isinstance(value, int):
+        return b":%d\r\n" % value
+    if isinstance(value, list):
+        return b"*%d\r\n" % len(value) + b"".join(encode(item) for item in value)
+    if isinstance(value, bytes):
+        return b"$%d\r\n%s\r\n" % (len(value), value)
+    return f"+{value}\r\n".encode("utf-8")
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        # Inline command, as typed into telnet
+        return line.split()
+    args = []
+    for _ in range(int(line[1:])):
+        length = int((await reader.readline())[1:])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+def create_handler(store):
+    async def handle(reader, writer):
+        try:
+            while True:
+                command = await read_command(reader)
+                if command is None:
+                    break
+                if not command:
+                    continue
+                try:
+                    reply = store.execute(command[0].decode().upper(), command[1:])
+                except Exception as e:
+                    reply = e
+                writer.write(encode(reply))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(create_handler(MockRedis()), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
@@ -0,0 +1,225 @@
+"""OpenAI-compatible mock streaming server for local benchmarks
+
+Streams deterministic reasoning_content/content deltas for
+POST /v1/chat/completions with configurable chunk sizes, inter-token delays,
+stalls and errors, so the streaming hot path can be measured without a live
+provider.
+
+    python mock_server.py --port 8001 --token-delay 0.02 --stall-after 50
+"""
+import argparse
+import asyncio
+import json
+import random
+import socket
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+WORDS = (
+    "the student considers each step of the problem and checks whether the "
+    "reasoning holds before moving on to the next idea so that the final "
+    "answer follows from what was established earlier"
+).split()
+
+
+class MockConfig:
+    """Behaviour of the mock upstream, shared by every request"""
+
+    def __init__(
+        self,
+        reasoning_tokens=200,
+        content_tokens=60,
+        chunk_tokens=1,
+        token_delay=0.01,
+        first_token_delay=0.2,
+        paragraph_tokens=40,
+        stall_after=0,
+        stall_seconds=0.0,
+        error_after=0,
+        error_status=0,
+        error_every=0,
+        separate_reasoning=True,
+        seed=0,
+    ):
+        self.reasoning_tokens = reasoning_tokens
+        self.content_tokens = content_tokens
+        self.chunk_tokens = chunk_tokens
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.paragraph_tokens = paragraph_tokens
+        self.stall_after = stall_after
+        self.stall_seconds = stall_seconds
+        self.error_after = error_after
+        self.error_status = error_status
+        self.error_every = error_every
+        self.separate_reasoning = separate_reasoning
+        self.seed = seed
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(
+            reasoning_tokens=args.reasoning_tokens,
+            content_tokens=args.content_tokens,
+            chunk_tokens=args.chunk_tokens,
+            token_delay=args.token_delay,
+            first_token_delay=args.first_token_delay,
+            paragraph_tokens=args.paragraph_tokens,
+            stall_after=args.stall_after,
+            stall_seconds=args.stall_seconds,
+            error_after=args.error_after,
+            error_status=args.error_status,
+            error_every=args.error_every,
+            separate_reasoning=not args.inline_reasoning,
+            seed=args.seed,
+        )
+
+
+def generate_tokens(rng, count, paragraph_tokens):
+    tokens = []
+    for index in range(count):
+        word = rng.choice(WORDS)
+        if paragraph_tokens and index and index % paragraph_tokens == 0:
+            tokens.append(".\n\n" + word.capitalize())
+        else:
+            tokens.append((" " if index else "") + word)
+    return tokens
+
+
+def chunked(tokens, size):
+    return ["".join(tokens[i : i + size]) for i in range(0, len(tokens), size)]
+
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+
+
+def create_mock_app(config):
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.get("/v1/models")
+    async def models():
+        return {"object": "list", "data": [{"id": "mock", "object": "model"}]}
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests += 1
+        request_index = app.state.requests
+        if config.error_status and (
+            not config.error_every or request_index % config.error_every == 0
+        ):
+            return JSONResponse(
+                {"error": {"message": "mock upstream error", "type": "server_error"}},
+                status_code=config.error_status,
+            )
+
+        # The same prompt always gives the same text; an assistant prefix is
+        # continued from where it ends, like a resumed upstream
+        messages = body.get("messages", [])
+        resumed = 0
+        if messages and messages[-1].get("prefix"):
+            prefix = messages[-1]["content"].removeprefix("<think>\n")
+            resumed = len(prefix.replace("</think>", "") if config.separate_reasoning else prefix)
+            messages = messages[:-1]
+        prompt = json.dumps(messages, sort_keys=True)
+        rng = random.Random(f"{config.seed}:{prompt}")
+        max_tokens = body.get("max_tokens") or 1 << 30
+        reasoning_count = min(config.reasoning_tokens, max_tokens)
+        content_count = min(config.content_tokens, max_tokens - reasoning_count)
+        reasoning = generate_tokens(rng, reasoning_count, config.paragraph_tokens)
+        content = generate_tokens(rng, content_count, 0)
+        if config.separate_reasoning:
+            deltas = [("reasoning_content", text) for text in chunked(reasoning, config.chunk_tokens)]
+        else:
+            reasoning[-1:] = [reasoning[-1] + "</think>"] if reasoning else ["</think>"]
+            deltas = [("content", text) for text in chunked(reasoning, config.chunk_tokens)]
+        deltas += [("content", text) for text in chunked(content, config.chunk_tokens)]
+        while deltas and resumed >= len(deltas[0][1]):
+            resumed -= len(deltas.pop(0)[1])
+        if deltas and resumed:
+            deltas[0] = (deltas[0][0], deltas[0][1][resumed:])
+        model = body.get("model", "mock")
+        created = int(time.time())
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": f"mock-{request_index}",
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+
+        async def stream():
+            await asyncio.sleep(config.first_token_delay)
+            yield sse(chunk({"role": "assistant", "content": ""}))
+            for index, (field, text) in enumerate(deltas, start=1):
+                if config.error_after and index > config.error_after:
+                    raise ConnectionResetError("mock upstream dropped the stream")
+                if config.stall_after and index == config.stall_after:
+                    await asyncio.sleep(config.stall_seconds)
+                yield sse(chunk({field: text}))
+                await asyncio.sleep(config.token_delay)
+            yield sse(chunk({}, finish_reason="stop"))
+            # DeepSeek style usage chunk with empty choices
+            yield sse(
+                {
+                    "id": f"mock-{request_index}",
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": model,
+                    "choices": [],
+                    "usage": {
+                        "prompt_tokens": len(prompt) // 4,
+                        "completion_tokens": reasoning_count + content_count,
+                        "total_tokens": len(prompt) // 4 + reasoning_count + content_count,
+                    },
+                }
+            )
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--reasoning-tokens", type=int, default=200)
+    parser.add_argument("--content-tokens", type=int, default=60)
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="Tokens per delta")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="Seconds between deltas")
+    parser.add_argument("--first-token-delay", type=float, default=0.2)
+    parser.add_argument("--paragraph-tokens", type=int, default=40)
+    parser.add_argument("--stall-after", type=int, default=0, help="Stall before this delta")
+    parser.add_argument("--stall-seconds", type=float, default=0.0)
+    parser.add_argument("--error-after", type=int, default=0, help="Drop the stream after N deltas")
+    parser.add_argument("--error-status", type=int, default=0, help="Reply with this HTTP status")
+    parser.add_argument("--error-every", type=int, default=0, help="Only fail every Nth request")
+    parser.add_argument("--inline-reasoning", action="store_true", help="Send <think> in content")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(
+        create_mock_app(MockConfig.from_args(args)),
+        host=args.host,
+        port=args.port,
+        log_level="warning",
+    )
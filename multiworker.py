@@ -0,0 +1,282 @@
+"""Multi-process harness for shared sessions
+
+Starts mock_server.py, the session store (mock_redis.py for redis, a shared
+file for sqlite) and several app worker processes with SHARED_SESSIONS on,
+then drives one page through Gradio's HTTP API with every event going to
+the next worker in turn, as a load balancer without sticky sessions would:
+
+    Generate on worker 0, the stream on worker 1, Pause on worker 2 while
+    worker 1 streams, Generate again on worker 0 continuing the paused
+    thought on worker 2, and the result toggle read back on worker 1.
+
+Checks that the pause reaches the streaming worker, that the resumed thought
+matches an uninterrupted run and that every worker sees the same rounds.
+
+    python multiworker.py --store sqlite redis --workers 3
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+from gradio_client.utils import apply_diff
+
+from benchmark import start_mock_server
+from mock_server import add_mock_arguments, free_port
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def wait_for_port(port, process, timeout=60):
+    import socket
+
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"process on port {port} exited")
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f"nothing listening on port {port}")
+
+
+def run_worker(port):
+    import app
+
+    demo = app.create_app()
+    demo.queue(api_open=False)
+    demo.launch(server_name="127.0.0.1", server_port=port, quiet=True, _frontend=False)
+
+
+def start_workers(count, env):
+    workers = []
+    for _ in range(count):
+        port = free_port()
+        process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--worker", str(port)],
+            cwd=HERE,
+            env=env,
+        )
+        workers.append((port, process))
+    for port, process in workers:
+        wait_for_port(port, process)
+    return workers
+
+
+class Page:
+    """One browser page whose events are spread over the workers"""
+
+    def __init__(self, client, ports, fn_index):
+        self.client = client
+        self.bases = [f"http://127.0.0.1:{port}/gradio_api" for port in ports]
+        self.fn_index = fn_index
+        self.session_hash = uuid.uuid4().hex
+
+    def payload(self, fn, data):
+        return {
+            "data": data,
+            "fn_index": self.fn_index[fn],
+            "event_data": None,
+            "trigger_id": None,
+            "session_hash": self.session_hash,
+        }
+
+    async def predict(self, worker, fn, data):
+        """Unqueued event, like the Generate/Pause button handler"""
+        response = await self.client.post(
+            self.bases[worker] + "/run/predict", json=self.payload(fn, data)
+        )
+        response.raise_for_status()
+        return response.json()["data"]
+
+    async def queued(self, worker, fn, data, on_output=None):
+        """Queued event, streamed until completion; returns the last output"""
+        base = self.bases[worker]
+        response = await self.client.post(base + "/queue/join", json=self.payload(fn, data))
+        response.raise_for_status()
+        output = None
+        async with self.client.stream(
+            "GET", base + "/queue/data", params={"session_hash": self.session_hash}
+        ) as stream:
+            async for line in stream.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                message = json.loads(line[5:])
+                if message.get("msg") == "process_generating":
+                    output = apply_diffs(output, message["output"]["data"])
+                    if on_output is not None:
+                        await on_output(output)
+                elif message.get("msg") == "process_completed":
+                    if not message.get("success", False):
+                        raise RuntimeError(message.get("output"))
+                    return message["output"].get("data") or output
+        raise RuntimeError("queue stream ended early")
+
+
+def apply_diffs(previous, data):
+    """Streamed outputs arrive as diffs against the previous frame"""
+    if previous is None:
+        return list(data)
+    return [apply_diff(before, after) for before, after in zip(previous, data)]
+
+
+def editor_value(output):
+    return output[0]["value"] if isinstance(output[0], dict) else output[0]
+
+
+async def uninterrupted_thought(page, prompt):
+    await page.predict(0, "handle_control_button", [None])
+    output = await page.queued(0, page.stream_fn, [None, None, prompt, ""])
+    toggled = await page.queued(0, "toggle_editor_result", [None, True])
+    return editor_value(output), editor_value(toggled)
+
+
+async def paused_and_resumed(page, prompt, workers, throughput, pause_chars):
+    worker = iter(range(1 << 30))
+
+    def next_worker():
+        return next(worker) % workers
+
+    await page.queued(next_worker(), "set_throughput", [throughput, None])
+    await page.predict(next_worker(), "handle_control_button", [None])
+    paused = {}
+
+    async def pause_when_long(output):
+        if "at" not in paused and len(editor_value(output) or "") >= pause_chars:
+            paused["at"] = time.perf_counter()
+            paused["worker"] = next_worker()
+            await page.predict(paused["worker"], "handle_control_button", [None])
+
+    stream_worker = next_worker()
+    output = await page.queued(stream_worker, page.stream_fn, [None, None, prompt, ""], pause_when_long)
+    stopped = time.perf_counter()
+    if "at" not in paused:
+        raise RuntimeError("the stream finished before it could be paused")
+    thought = editor_value(output)
+    control = await page.predict(next_worker(), "handle_ui_state", [None])
+
+    await page.predict(next_worker(), "handle_control_button", [None])
+    output = await page.queued(next_worker(), page.stream_fn, [None, None, prompt, thought])
+    resumed = editor_value(output)
+    toggled = await page.queued(next_worker(), "toggle_editor_result", [None, True])
+    return {
+        "stream_worker": stream_worker,
+        "pause_worker": paused["worker"],
+        "pause_latency_ms": (stopped - paused["at"]) * 1000,
+        "paused_chars": len(thought),
+        "paused_button": control[0]["value"],
+        "resumed": resumed,
+        "shared_raw": editor_value(toggled),
+    }
+
+
+def check_store(store, args):
+    import httpx
+
+    import app
+    from lang import LANGUAGE_CONFIG
+
+    env = dict(
+        os.environ,
+        SHARED_SESSIONS="true",
+        SESSION_STORE=store,
+        RESPONSE_CACHE="off",
+        COALESCE_REQUESTS="false",
+    )
+    helpers = []
+    if store == "redis":
+        redis_port = free_port()
+        helpers.append(subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "mock_redis.py"), "--port", str(redis_port)]
+        ))
+        wait_for_port(redis_port, helpers[0])
+        env["REDIS_URL"] = f"redis://127.0.0.1:{redis_port}/0"
+    else:
+        env["HISTORY_PATH"] = os.path.join(tempfile.mkdtemp(), "sessions.sqlite3")
+    workers = start_workers(args.workers, env)
+
+    # Event indexes follow from the UI definition, the same in every worker
+    demo = app.create_app()
+    fn_index = {fn.name: index for index, fn in demo.fns.items()}
+    stream_fn = "wrap_stream_generator_async" if app.AppConfig.ASYNC_STREAMING else "wrap_stream_generator"
+
+    async def run():
+        async with httpx.AsyncClient(timeout=120) as client:
+            ports = [port for port, _ in workers]
+            reference = Page(client, ports[:1], fn_index)
+            reference.stream_fn = stream_fn
+            page = Page(client, ports, fn_index)
+            page.stream_fn = stream_fn
+            prompt = f"multiworker {store}"
+            expected = await uninterrupted_thought(reference, prompt)
+            result = await paused_and_resumed(
+                page, prompt, len(ports), args.throughput, args.pause_chars
+            )
+            return expected, result
+
+    try:
+        (expected_thought, expected_raw), result = asyncio.run(run())
+    finally:
+        for _, process in workers:
+            process.terminate()
+        for process in helpers:
+            process.terminate()
+    generate_label = LANGUAGE_CONFIG["en"]["generate_btn"]
+    return {
+        "store": store,
+        "workers": args.workers,
+        "pause_latency_ms": round(result["pause_latency_ms"], 1),
+        "paused_chars": result["paused_chars"],
+        "pause_seen": result["paused_button"] == generate_label,
+        "resume_matches": result["resumed"] == expected_thought,
+        "rounds_shared": result["shared_raw"] == expected_raw,
+    }
+
+
+def main(args):
+    port = free_port()
+    server = start_mock_server(args, port)
+    os.environ.update(
+        API_KEY="multiworker",
+        API_URL=f"http://127.0.0.1:{port}/v1",
+        API_MODEL="mock",
+        HISTORY_PATH=os.path.join(tempfile.mkdtemp(), "history.sqlite3"),
+    )
+    results = []
+    try:
+        for store in args.store:
+            results.append(check_store(store, args))
+            print(json.dumps(results[-1]))
+    finally:
+        server.terminate()
+        server.wait()
+    failed = [
+        result["store"]
+        for result in results
+        if not (result["pause_seen"] and result["resume_matches"] and result["rounds_shared"])
+    ]
+    if failed:
+        sys.exit(f"shared sessions failed for: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--worker", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--store", nargs="+", choices=["sqlite", "redis"], default=["sqlite", "redis"])
+    parser.add_argument("--workers", type=int, default=3)
+    parser.add_argument("--throughput", type=int, default=40, help="Sync rate while streaming")
+    parser.add_argument("--pause-chars", type=int, default=200, help="Pause once the thought is this long")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.worker)
+    else:
+        main(args)
@@ -0,0 +1,161 @@
+import re
+import threading
+import time
+from collections import deque
+
+# Fast BPE approximation: short ASCII words, digit triples and single other
+# characters (CJK, punctuation) each count as one token, whitespace attaches
+# to the token that follows it
+_TOKEN_RE = re.compile(r"\s*(?:[A-Za-z]{1,10}|\d{1,3}|\S)|\s+")
+
+
+def split_tokens(text):
+    """Split text into approximate tokens that concatenate back to text"""
+    return _TOKEN_RE.findall(text)
+
+
+def count_tokens(text):
+    return len(split_tokens(text))
+
+
+class TokenBucket:
+    """Token-bucket scheduler, capacity is one frame worth of tokens
+
+    The extra token of headroom carries fractional credit between frames so
+    the long-run rate stays exact when rate / fps is not a whole number.
+    """
+
+    def __init__(self, frame_interval):
+        self.frame_interval = frame_interval
+        self.tokens = 0.0
+        self.last_refill = None
+
+    def take(self, rate, available, now=None):
+        """Number of whole tokens that may be released now"""
+        now = time.monotonic() if now is None else now
+        if self.last_refill is not None:
+            capacity = rate * self.frame_interval + 1.0
+            self.tokens = min(
+                capacity, self.tokens + (now - self.last_refill) * rate
+            )
+        else:
+            self.tokens = 1.0
+        self.last_refill = now
+        granted = min(int(self.tokens), available)
+        self.tokens -= granted
+        return granted
+
+
+class TokenPacer:
+    """Upstream text buffer released at a token rate, one frame at a time
+
+    A producer puts upstream text at full speed, the consumer calls release()
+    once per frame. data_ready is a threading.Event or asyncio.Event used to
+    wake an idle consumer when the first text arrives.
+    """
+
+    def __init__(self, fps, data_ready):
+        self.frame_interval = 1.0 / fps
+        self.data_ready = data_ready
+        self.bucket = TokenBucket(self.frame_interval)
+        self.pieces = deque()
+        self.done = False
+        self.stopped = False
+        self.error = None
+        # Read-ahead limits while the student is paused
+        self.max_buffered = None
+        self.hold_deadline = None
+        self.released_tokens = 0
+        # SharedStream feeding this pacer, None for cached replays
+        self.shared = None
+        self._tail = ""
+        self._lock = threading.Lock()
+
+    def put(self, text):
+        """Buffer upstream text, returns the number of tokens added"""
+        with self._lock:
+            pieces = split_tokens(self._tail + text)
+            # A trailing word or whitespace may join the next chunk's token
+            if pieces and (pieces[-1][-1].isalnum() or pieces[-1].isspace()):
+                self._tail = pieces.pop()
+            else:
+                self._tail = ""
+            self.pieces.extend(pieces)
+        self.data_ready.set()
+        return len(pieces)
+
+    def close(self, error=None):
+        """Mark the upstream finished, error is re-raised once drained"""
+        with self._lock:
+            if self._tail:
+                self.pieces.append(self._tail)
+                self._tail = ""
+            self.error = error
+            self.done = True
+        self.data_ready.set()
+
+    def stop(self):
+        """Ask the producer to stop reading upstream"""
+        self.stopped = True
+
+    def hold(self, max_tokens, idle_seconds):
+        """Keep reading ahead while paused, bounded in tokens and idle time"""
+        self.max_buffered = max_tokens
+        self.hold_deadline = time.monotonic() + idle_seconds
+
+    def resume(self):
+        with self._lock:
+            self.max_buffered = None
+            self.hold_deadline = None
+
+    def stop_if_full(self):
+        """Stop once max_tokens are held, atomic with resume(); True if stopped"""
+        with self._lock:
+            if not self.has_room():
+                self.stopped = True
+            return self.stopped
+
+    def stop_if_held(self):
+        """Stop unless resume() came first, atomic with it; True if stopped"""
+        with self._lock:
+            if self.hold_deadline is not None:
+                self.stopped = True
+            return self.stopped
+
+    def has_room(self):
+        return self.max_buffered is None or len(self.pieces) < self.max_buffered
+
+    def expired(self):
+        return self.hold_deadline is not None and time.monotonic() > self.hold_deadline
+
+    def unread(self, text):
+        """Put text back in front of the buffer, to be released again"""
+        pieces = split_tokens(text)
+        with self._lock:
+            self.pieces.extendleft(reversed(pieces))
+            self.released_tokens -= len(pieces)
+
+    def drained(self):
+        return self.done and not self.pieces
+
+    def idle(self):
+        return not self.pieces and not self.done
+
+    def buffered_tokens(self):
+        return len(self.pieces)
+
+    def release(self, rate, now=None):
+        """Text due this frame, None once the upstream ended and is drained
+
+        rate is in tokens per second, None releases everything buffered.
+        """
+        with self._lock:
+            available = len(self.pieces)
+            if not available:
+                return None if self.done else ""
+            if rate is None:
+                count = available
+            else:
+                count = self.bucket.take(rate, available, now)
+            self.released_tokens += count
+            return "".join(self.pieces.popleft() for _ in range(count))
@@ -0,0 +1,269 @@
+"""Pause rules deciding when the thought stops for the student's turn
+
+A rule counts units of the thought as it streams, seeing each new piece of
+text once and carrying partial units over to the next, and is due once
+`every` units have streamed since the last pause (only the first time with
+once=True). AnyOf and AllOf combine rules; PausePolicy pauses as soon as one
+of its rules is due and starts every count over from there.
+
+    policy = PausePolicy([ParagraphRule(2), AllOf([SentenceRule(3), ReadingTimeRule(20)])])
+    policy.feed("First idea.\\n\\nSecond")  # None, or the name of the rule due
+
+Policies are also built from JSON, as PAUSE_RULES and the HTTP API take them:
+
+    [{"rule": "sentences", "every": 5},
+     {"all": [{"rule": "paragraphs", "every": 1}, {"rule": "reading", "every": 30}]},
+     {"rule": "regex", "pattern": "^Therefore", "every": 1, "once": true}]
+"""
+import json
+import re
+
+from pacing import count_tokens
+
+
+def positive(rule, option, value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not value > 0:
+        raise ValueError(f"{rule}: {option} must be a positive number")
+    return value
+
+
+class PauseRule:
+    name = "rule"
+
+    def __init__(self, every, once=False):
+        self.every = positive(self.name, "every", every)
+        self.once = once
+        self.since = 0
+        self.pauses = 0
+
+    def count(self, text):
+        """Units completed by text, partial ones are kept for the next call"""
+        raise NotImplementedError
+
+    def feed(self, text):
+        self.since += self.count(text)
+
+    def due(self):
+        if self.once and self.pauses:
+            return False
+        return self.since >= self.every
+
+    def reset(self):
+        """Count over after a pause, which this rule made if it is due"""
+        if self.due():
+            self.pauses += 1
+        self.since = 0
+
+
+class ParagraphRule(PauseRule):
+    """Blank lines, counted like str.count("\\n\\n") over the whole thought"""
+
+    name = "paragraphs"
+
+    def __init__(self, every, once=False):
+        super().__init__(every, once)
+        self._open_newline = False
+
+    def count(self, text):
+        count = 0
+        if self._open_newline and text.startswith("\n"):
+            count += 1
+            text = text[1:]
+        count += text.count("\n\n")
+        trailing = len(text) - len(text.rstrip("\n"))
+        self._open_newline = trailing % 2 == 1
+        return count
+
+
+class SentenceRule(PauseRule):
+    """Runs of . ! or ? followed by whitespace"""
+
+    name = "sentences"
+    _END = re.compile(r"[.!?]+(?=\s)")
+    _TRAILING = re.compile(r"[.!?]+\Z")
+
+    def __init__(self, every, once=False):
+        super().__init__(every, once)
+        self._held = ""
+
+    def count(self, text):
+        text = self._held + text
+        # A trailing terminator ends a sentence only if whitespace follows
+        trailing = self._TRAILING.search(text)
+        self._held = trailing.group() if trailing else ""
+        if trailing:
+            text = text[: trailing.start()]
+        return len(self._END.findall(text))
+
+
+class TokenRule(PauseRule):
+    name = "tokens"
+
+    def count(self, text):
+        return count_tokens(text)
+
+
+class ReadingTimeRule(PauseRule):
+    """Seconds a student needs to read the text at wpm words per minute"""
+
+    name = "reading"
+
+    def __init__(self, every, once=False, wpm=200):
+        super().__init__(every, once)
+        self.seconds_per_word = 60 / positive(self.name, "wpm", wpm)
+        self._in_word = False
+
+    def count(self, text):
+        if not text:
+            return 0
+        words = len(re.findall(r"(?<!\S)\S", text))
+        if self._in_word and not text[0].isspace():
+            # Continues the word the previous text ended in
+            words -= 1
+        self._in_word = not text[-1].isspace()
+        return words * self.seconds_per_word
+
+
+class RegexRule(PauseRule):
+    """Matches of pattern within each line, counted once the line is complete"""
+
+    name = "regex"
+    MAX_PATTERN = 200
+
+    def __init__(self, pattern, every=1, once=False, ignore_case=False):
+        super().__init__(every, once)
+        if not isinstance(pattern, str) or len(pattern) > self.MAX_PATTERN:
+            raise ValueError(
+                f"{self.name}: pattern must be a string of at most {self.MAX_PATTERN} characters"
+            )
+        try:
+            self.regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+        except re.error as e:
+            raise ValueError(f"{self.name}: {e}")
+        self._line = []
+
+    def count(self, text):
+        if "\n" not in text:
+            self._line.append(text)
+            return 0
+        lines = text.split("\n")
+        lines[0] = "".join(self._line) + lines[0]
+        self._line = [lines.pop()]
+        return sum(self.count_line(line) for line in lines)
+
+    def count_line(self, line):
+        return len(self.regex.findall(line))
+
+
+class HeadingRule(RegexRule):
+    """Sections ended by the next markdown heading or "Step N" marker"""
+
+    name = "headings"
+    MARKER = r"^\s{0,3}(?:#{1,6}\s|\**step\s*\d+)"
+
+    def __init__(self, every=1, once=False, pattern=MARKER):
+        super().__init__(pattern, every, once, ignore_case=True)
+        self._content = False
+
+    def count_line(self, line):
+        if self.regex.search(line):
+            # The first marker only opens a section
+            ended, self._content = self._content, False
+            return int(ended)
+        if line.strip():
+            self._content = True
+        return 0
+
+
+class AllOf:
+    """Due once every rule is due, e.g. a paragraph and 30s of reading"""
+
+    name = "all"
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def feed(self, text):
+        for rule in self.rules:
+            rule.feed(text)
+
+    def due(self):
+        return all(rule.due() for rule in self.rules)
+
+    def reset(self):
+        for rule in self.rules:
+            rule.reset()
+
+
+class AnyOf(AllOf):
+    name = "any"
+
+    def due(self):
+        return any(rule.due() for rule in self.rules)
+
+
+class PausePolicy:
+    """Top-level rules, any of which pauses the stream"""
+
+    def __init__(self, rules):
+        self.rules = rules
+
+    def feed(self, text):
+        """Count new thought text, returns the name of the rule due or None"""
+        if not self.rules:
+            return None
+        for rule in self.rules:
+            rule.feed(text)
+        fired = next((rule for rule in self.rules if rule.due()), None)
+        if fired is None:
+            return None
+        for rule in self.rules:
+            rule.reset()
+        return fired.name
+
+
+RULES = {
+    rule.name: rule
+    for rule in (ParagraphRule, SentenceRule, TokenRule, ReadingTimeRule, RegexRule, HeadingRule)
+}
+
+
+def build_rule(spec, trusted=True):
+    if not isinstance(spec, dict):
+        raise ValueError("A pause rule must be a JSON object")
+    for name, combinator in (("all", AllOf), ("any", AnyOf)):
+        if name in spec:
+            if not isinstance(spec[name], list):
+                raise ValueError(f"{name} takes a list of rules")
+            return combinator([build_rule(child, trusted) for child in spec[name]])
+    options = dict(spec)
+    name = options.pop("rule", None)
+    if name not in RULES:
+        raise ValueError(f"Unknown pause rule {name!r}, one of {', '.join(RULES)}")
+    if not trusted and (name == "regex" or "pattern" in options):
+        # Matched on the event loop, a backtracking pattern would stall every session
+        raise ValueError(f"{name}: patterns are only accepted in PAUSE_RULES")
+    try:
+        return RULES[name](**options)
+    except TypeError as e:
+        raise ValueError(f"{name}: {e}")
+
+
+def build_rules(specs, trusted=True):
+    """Fresh rules for a list of JSON rule specs, ValueError if invalid
+
+    Untrusted specs, from clients rather than the operator, may not carry
+    regular expressions.
+    """
+    if not isinstance(specs, list):
+        raise ValueError("Pause rules must be a JSON list")
+    return [build_rule(spec, trusted) for spec in specs]
+
+
+def parse_rules(text):
+    """Rule specs from a JSON string, validated; empty for no rules"""
+    if not text.strip():
+        return []
+    specs = json.loads(text)
+    build_rules(specs)
+    return specs
@@ -0,0 +1,129 @@
+"""Compact per-session recordings of upstream streams, for offline replay
+
+Every session appends to <directory>/<session_id>.jsonl, one JSON array per
+line: [run, ms, kind, data], with ms counted from the start of the run.
+
+    start    {"ts", "prompt", "prefix", "throughput", "sync_threshold",
+              "pause_rules", "resuming", "fps"}
+    attempt  endpoint name, as every upstream request is sent
+    r, c     reasoning_content or content delta text, as it arrived
+    f        characters released to the UI in one frame
+    p        pause policy rule that paused the stream
+    end      {"outcome", "source", "tokens_in", "tokens_out"}
+
+A file past max_bytes is gzipped to <session_id>.1.jsonl.gz, pushing older
+ones up to <session_id>.<backups>.jsonl.gz, and the oldest is dropped.
+"""
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+
+class StreamRecorder:
+    """Appends run recordings to size-capped, rotated per-session files"""
+
+    def __init__(self, directory, max_bytes, backups):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, session_id, **fields):
+        """Recording of a new run, opened with its start event"""
+        recording = Recording(self, session_id, uuid.uuid4().hex[:8])
+        recording.event("start", dict(ts=round(time.time(), 3), **fields))
+        return recording
+
+    def path(self, session_id, index=0):
+        if index:
+            return os.path.join(self.directory, f"{session_id}.{index}.jsonl.gz")
+        return os.path.join(self.directory, f"{session_id}.jsonl")
+
+    def append(self, session_id, lines):
+        data = "".join(lines).encode("utf-8")
+        with self._lock:
+            with open(self.path(session_id), "ab") as f:
+                f.write(data)
+                size = f.tell()
+            if size >= self.max_bytes:
+                self._rotate(session_id)
+
+    def _rotate(self, session_id):
+        current = self.path(session_id)
+        if not self.backups:
+            os.remove(current)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            if os.path.exists(self.path(session_id, index)):
+                os.replace(self.path(session_id, index), self.path(session_id, index + 1))
+        with open(current, "rb") as src, gzip.open(self.path(session_id, 1), "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(current)
+
+
+class Recording:
+    """Events of one run, appended to its session's file in batches
+
+    The producer and the UI side of a run both record, so events are
+    buffered under a lock and written FLUSH_LINES at a time, and on flush().
+    """
+
+    FLUSH_LINES = 64
+
+    def __init__(self, recorder, session_id, run_id):
+        self.recorder = recorder
+        self.session_id = session_id
+        self.run_id = run_id
+        self.started = time.perf_counter()
+        self.lines = []
+        self._lock = threading.Lock()
+
+    def event(self, kind, data=None):
+        ms = round((time.perf_counter() - self.started) * 1000, 1)
+        line = json.dumps(
+            [self.run_id, ms, kind, data], ensure_ascii=False, separators=(",", ":")
+        )
+        with self._lock:
+            self.lines.append(line + "\n")
+            if len(self.lines) >= self.FLUSH_LINES:
+                self._write()
+
+    def flush(self):
+        with self._lock:
+            self._write()
+
+    def _write(self):
+        if self.lines:
+            self.recorder.append(self.session_id, self.lines)
+            self.lines = []
+
+
+def read_recording(path):
+    """Events of a session file and its rotated backups, oldest first
+
+    path is the session's .jsonl file. A line torn by a crash is skipped.
+    """
+    base = path[: -len(".jsonl")] if path.endswith(".jsonl") else path
+    files = []
+    index = 1
+    while os.path.exists(f"{base}.{index}.jsonl.gz"):
+        files.append(f"{base}.{index}.jsonl.gz")
+        index += 1
+    files.reverse()
+    if os.path.exists(f"{base}.jsonl"):
+        files.append(f"{base}.jsonl")
+    events = []
+    for name in files:
+        opener = gzip.open if name.endswith(".gz") else open
+        with opener(name, "rt", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue
+    return events
@@ -0,0 +1,246 @@
+"""Replay a recorded session through the streaming pipeline
+
+Reads a session recorded with RECORD_DIR and serves every recorded upstream
+attempt from an OpenAI-compatible endpoint, sending its deltas with the
+recorded gaps divided by --speed. Each recorded run is then generated again
+through the async pipeline against it: same prompt, thought and pause
+threshold, sync and frame rate times --speed, and the student's pauses at
+the recorded times. The replay is recorded too, and one JSON line per run puts
+recorded and replayed timings side by side, recorded ones divided by --speed.
+
+    python replay.py recordings/<session_id>.jsonl --speed 4
+
+Runs served from the cache, a coalesced stream or a read-ahead have no
+attempts of their own and are skipped.
+"""
+import argparse
+import asyncio
+import json
+import statistics
+import tempfile
+import threading
+import time
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+import engine
+from engine import AppConfig, ConvoState, DynamicState
+from mock_server import free_port
+from recorder import read_recording
+
+
+def parse_runs(events):
+    """Runs of a recording in start order, events grouped per run"""
+    runs = {}
+    for run_id, ms, kind, data in events:
+        run = runs.setdefault(run_id, {
+            "id": run_id,
+            "start": None,
+            "attempts": [],
+            "flushes": [],
+            "flushed_chars": 0,
+            "pauses": [],
+            "end": None,
+        })
+        if kind == "start":
+            run["start"] = data
+        elif kind == "attempt":
+            run["attempts"].append({"ms": ms, "endpoint": data, "deltas": []})
+        elif kind in ("r", "c") and run["attempts"]:
+            run["attempts"][-1]["deltas"].append((ms, kind, data))
+        elif kind == "f":
+            run["flushes"].append(ms)
+            run["flushed_chars"] += data
+        elif kind == "p":
+            run["pauses"].append(ms)
+        elif kind == "end":
+            run["end"] = dict(data, ms=ms)
+    return [run for run in runs.values() if run["start"] is not None]
+
+
+def replayable(run):
+    return run["end"] is not None and bool(run["attempts"])
+
+
+def summarize(run, speed=1.0):
+    """Upstream and UI timings of a parsed run, in ms divided by speed"""
+    deltas = [delta for attempt in run["attempts"] for delta in attempt["deltas"]]
+    flushes = run["flushes"]
+    gaps = [after - before for before, after in zip(flushes, flushes[1:])]
+
+    def scaled(ms):
+        return None if ms is None else round(ms / speed, 1)
+
+    return {
+        "outcome": run["end"]["outcome"],
+        "attempts": len(run["attempts"]),
+        "deltas": len(deltas),
+        "first_delta_ms": scaled(deltas[0][0] if deltas else None),
+        "first_flush_ms": scaled(flushes[0] if flushes else None),
+        "flushes": len(flushes),
+        "frame_ms": scaled(statistics.mean(gaps) if gaps else None),
+        "max_frame_gap_ms": scaled(max(gaps) if gaps else None),
+        "flushed_chars": run["flushed_chars"],
+        "coordinator_pauses": len(run["pauses"]),
+        "duration_ms": scaled(run["end"]["ms"]),
+    }
+
+
+def sse(payload):
+    return f"data: {json.dumps(payload)}\n\n".encode("utf-8")
+
+
+def create_replay_app(runs, speed):
+    """OpenAI-compatible upstream serving the recorded attempts
+
+    A request gets the first attempt not served yet of the run with its
+    prompt and the longest thought its own thought starts with, so a run
+    stopped before it reached the upstream does not shift the others.
+    """
+    app = FastAPI()
+    attempts = [
+        (run["start"]["prompt"], run["start"]["prefix"], attempt)
+        for run in runs
+        for attempt in run["attempts"]
+    ]
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        messages = body.get("messages", [])
+        prompt = next((m["content"] for m in messages if m.get("role") == "user"), "")
+        thought = ""
+        if messages and messages[-1].get("prefix"):
+            thought = messages[-1]["content"].removeprefix("<think>\n")
+        matches = [
+            entry for entry in attempts if entry[0] == prompt and thought.startswith(entry[1])
+        ]
+        if not matches:
+            return JSONResponse(
+                {"error": {"message": "no recorded attempt left", "type": "not_found"}},
+                status_code=404,
+            )
+        entry = max(matches, key=lambda entry: len(entry[1]))
+        attempts.remove(entry)
+        attempt = entry[2]
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": "replay",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "replay"),
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        async def stream():
+            previous = attempt["ms"]
+            for ms, kind, text in attempt["deltas"]:
+                await asyncio.sleep(max(0.0, ms - previous) / 1000 / speed)
+                previous = ms
+                field = "reasoning_content" if kind == "r" else "content"
+                yield sse(chunk({field: text}))
+            yield sse(chunk({}, finish_reason="stop"))
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    return app
+
+
+def replay_config(url, record_dir, fps):
+    """AppConfig sending every request to the replay upstream, once"""
+
+    class ReplayConfig(AppConfig):
+        API_KEY = "replay"
+        API_URL = url
+        API_MODEL = "replay"
+        UPSTREAM_RETRIES = 0
+        RESPONSE_CACHE = "off"
+        COALESCE_REQUESTS = False
+        PREFETCH_ON_PAUSE = False
+        REROLL_CANDIDATES = 0
+        # Every run gets the pause settings it was recorded with
+        SYNC_THRESHOLD_DEFAULT = 0
+        PAUSE_RULES = ""
+        SHARED_SESSIONS = False
+        HISTORY_MAX_ROUNDS = 0
+        SESSION_IDLE_SECONDS = 0
+        RECORD_DIR = record_dir
+        STREAM_FPS = fps
+
+    return ReplayConfig
+
+
+async def replay_run(run, speed):
+    """Generate run again, returns the replay's own recording"""
+    start = run["start"]
+    convo_state, dynamic_state = ConvoState(), DynamicState()
+    if start["throughput"] is not None:
+        convo_state.throughput = start["throughput"] * speed
+    else:
+        convo_state.throughput = None
+    convo_state.sync_threshold = start["sync_threshold"]
+    convo_state.pause_rules = start.get("pause_rules") or []
+    if start["resuming"]:
+        convo_state.current.user = start["prompt"]
+    dynamic_state.control_button_handler()
+    pause = None
+    if run["end"]["outcome"] == "cancelled":
+        # Stopped by the student, at the same point of the stream
+        pause = asyncio.get_running_loop().call_later(
+            run["end"]["ms"] / 1000 / speed,
+            lambda: setattr(dynamic_state, "should_stream", False),
+        )
+    async for _ in convo_state.agenerate_ai_response(
+        start["prompt"], start["prefix"], dynamic_state
+    ):
+        pass
+    if pause is not None:
+        pause.cancel()
+    path = engine.stream_recorder.path(convo_state.session_id)
+    return parse_runs(read_recording(path))[-1]
+
+
+def replay(path, speed=1.0):
+    """Replay every replayable run of the recording at path, in order"""
+    runs = [run for run in parse_runs(read_recording(path)) if replayable(run)]
+    port = free_port()
+    server = uvicorn.Server(uvicorn.Config(
+        create_replay_app(runs, speed), host="127.0.0.1", port=port, log_level="warning"
+    ))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    fps = runs[0]["start"]["fps"] if runs else AppConfig.STREAM_FPS
+    url = f"http://127.0.0.1:{port}/v1"
+    engine.configure(replay_config(url, tempfile.mkdtemp(), fps * speed))
+
+    async def run_all():
+        # Import the client up front, the recorded first run did not pay for it
+        engine.api_clients.get_async(url, "replay", engine.config.API_TIMEOUT)
+        results = []
+        for run in runs:
+            replayed = await replay_run(run, speed)
+            results.append({
+                "run": run["id"],
+                "recorded": summarize(run, speed),
+                "replayed": summarize(replayed),
+            })
+        return results
+
+    try:
+        return asyncio.run(run_all())
+    finally:
+        server.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("path", help="Session recording, <RECORD_DIR>/<session_id>.jsonl")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster")
+    args = parser.parse_args()
+    for result in replay(args.path, args.speed):
+        print(json.dumps(result))
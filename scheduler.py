@@ -0,0 +1,160 @@
+import asyncio
+import threading
+import time
+
+
+class Ticket:
+    """A request waiting for, then holding, an upstream stream slot"""
+
+    def __init__(self, session, client_ip, resume, loop=None):
+        self.budget_keys = (("session", session), ("ip", client_ip))
+        self.session = session
+        self.resume = resume
+        self.tag = 0.0
+        self.submitted = time.monotonic()
+        self.waited = 0.0
+        self.granted = False
+        self.released = False
+        self.charged = 0
+        # Async waiters are woken on their event loop, sync ones directly
+        self.loop = loop
+        self._event = asyncio.Event() if loop is not None else threading.Event()
+
+    def _grant(self, now):
+        self.granted = True
+        self.waited = now - self.submitted
+        if self.loop is None:
+            self._event.set()
+        else:
+            self.loop.call_soon_threadsafe(self._event.set)
+
+    def wait(self, timeout):
+        """Block up to timeout seconds, True once granted"""
+        return self._event.wait(timeout)
+
+    async def await_grant(self, timeout):
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.granted
+
+
+class AdmissionScheduler:
+    """Fair admission of upstream streams
+
+    At most max_streams streams run at once (0 for no cap). Waiting requests
+    that resume a paused thought go first, the rest in start-time fair
+    queueing order: every request of a session advances that session's
+    virtual finish tag by the same weight, so a session that keeps
+    resubmitting queues behind sessions that asked less. A session or client
+    IP past its token budget waits until the budget refills over
+    budget_window seconds. Running streams charge their tokens as they read
+    them, so requests of the same session or IP see that spend at once.
+    """
+
+    def __init__(self, max_streams, session_budget=0, ip_budget=0, budget_window=3600.0):
+        self.max_streams = max_streams or float("inf")
+        self.limits = {"session": session_budget, "ip": ip_budget}
+        self.budget_window = budget_window
+        self.active = 0
+        self.waiting = []
+        self.virtual_time = 0.0
+        self.finish_tags = {}
+        self.budgets = {}  # (kind, key) -> [tokens left, last refill]
+        self.admitted = 0
+        self.wait_total = 0.0
+        self._lock = threading.Lock()
+
+    def submit(self, session, client_ip, resume, loop=None):
+        ticket = Ticket(session, client_ip, resume, loop)
+        with self._lock:
+            start = max(self.virtual_time, self.finish_tags.get(session, 0.0))
+            ticket.tag = start + 1.0
+            self.finish_tags[session] = ticket.tag
+            self.waiting.append(ticket)
+            self._dispatch()
+        return ticket
+
+    def charge(self, ticket, tokens):
+        """Charge tokens a running stream just read to its budgets"""
+        if not tokens or not any(self.limits.values()):
+            return
+        with self._lock:
+            self._charge(ticket, tokens, time.monotonic())
+
+    def release(self, ticket, tokens=0):
+        """Give back the slot, or leave the queue, charging the tokens read
+        in all that charge() has not
+        """
+        with self._lock:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.granted:
+                self.active -= 1
+                self._charge(ticket, max(0, tokens - ticket.charged), time.monotonic())
+            else:
+                self.waiting.remove(ticket)
+            self._dispatch()
+
+    def dispatch(self):
+        """Admit waiters whose budget has refilled since the last release"""
+        with self._lock:
+            self._dispatch()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "active": self.active,
+                "waiting": len(self.waiting),
+                "waiting_resumes": sum(ticket.resume for ticket in self.waiting),
+                "admitted": self.admitted,
+                "wait_avg_ms": self.wait_total / self.admitted * 1000 if self.admitted else 0.0,
+            }
+
+    def _charge(self, ticket, tokens, now):
+        ticket.charged += tokens
+        for key in ticket.budget_keys:
+            if self.limits[key[0]] and key[1] is not None:
+                self._refill(key, now)[0] -= tokens
+
+    def _refill(self, key, now):
+        limit = self.limits[key[0]]
+        budget = self.budgets.setdefault(key, [limit, now])
+        budget[0] = min(limit, budget[0] + (now - budget[1]) * limit / self.budget_window)
+        budget[1] = now
+        return budget
+
+    def _within_budget(self, ticket, now):
+        return all(
+            not self.limits[key[0]] or key[1] is None or self._refill(key, now)[0] > 0
+            for key in ticket.budget_keys
+        )
+
+    def _dispatch(self):
+        while self.active < self.max_streams and self.waiting:
+            now = time.monotonic()
+            eligible = [ticket for ticket in self.waiting if self._within_budget(ticket, now)]
+            if not eligible:
+                break
+            ticket = min(eligible, key=lambda ticket: (not ticket.resume, ticket.tag))
+            self.waiting.remove(ticket)
+            self.active += 1
+            self.virtual_time = max(self.virtual_time, ticket.tag - 1.0)
+            self.admitted += 1
+            ticket._grant(now)
+            self.wait_total += ticket.waited
+        if len(self.finish_tags) > 1024:
+            self._prune(time.monotonic())
+
+    def _prune(self, now):
+        # Tags behind the virtual clock and refilled budgets carry no state
+        self.finish_tags = {
+            session: tag
+            for session, tag in self.finish_tags.items()
+            if tag > self.virtual_time
+        }
+        for key in list(self.budgets):
+            if self._refill(key, now)[0] >= self.limits[key[0]]:
+                del self.budgets[key]
@@ -0,0 +1,357 @@
+import asyncio
+import logging
+import random
+import socket
+import threading
+import time
+import weakref
+
+logger = logging.getLogger(__name__)
+
+
+class ClientRegistry:
+    """Process-wide OpenAI clients sharing tuned keep-alive connection pools
+
+    openai and httpx are imported with the first client, not with this module.
+    """
+
+    def __init__(
+        self,
+        max_connections,
+        max_keepalive,
+        keepalive_expiry,
+        max_retries=2,  # the SDK default
+    ):
+        self.max_retries = max_retries
+        self.max_connections = max_connections
+        self.max_keepalive = max_keepalive
+        self.keepalive_expiry = keepalive_expiry
+        self._clients = {}
+        # Async connections belong to the event loop that opened them
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def limits(self):
+        import httpx
+
+        return httpx.Limits(
+            max_connections=self.max_connections,
+            max_keepalive_connections=self.max_keepalive,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def get(self, url, key, timeout):
+        """Return the shared client for (url, key, timeout), creating it once"""
+        cache_key = (url, key, timeout)
+        client = self._clients.get(cache_key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(cache_key)
+                if client is None:
+                    from openai import DefaultHttpxClient, OpenAI
+
+                    client = OpenAI(
+                        api_key=key,
+                        base_url=url,
+                        timeout=timeout,
+                        max_retries=self.max_retries,
+                        http_client=DefaultHttpxClient(
+                            limits=self.limits(), timeout=timeout
+                        ),
+                    )
+                    self._clients[cache_key] = client
+        return client
+
+    def get_async(self, url, key, timeout):
+        """Return the shared AsyncOpenAI client of the running event loop"""
+        loop = asyncio.get_running_loop()
+        cache_key = (url, key, timeout)
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(cache_key)
+            if client is None:
+                from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+                client = AsyncOpenAI(
+                    api_key=key,
+                    base_url=url,
+                    timeout=timeout,
+                    max_retries=self.max_retries,
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=self.limits(), timeout=timeout
+                    ),
+                )
+                clients[cache_key] = client
+        return client
+
+    async def aclose(self):
+        """Close the async clients owned by the running event loop"""
+        with self._lock:
+            clients = self._async_clients.pop(asyncio.get_running_loop(), {})
+        for client in clients.values():
+            await client.close()
+
+    def close(self):
+        """Close every pooled connection, safe to call more than once"""
+        with self._lock:
+            clients, self._clients = self._clients, {}
+        for client in clients.values():
+            client.close()
+
+
+class UpstreamStalled(Exception):
+    """No chunk arrived from a streaming upstream within the stall timeout"""
+
+
+def classify_error(error):
+    """Kind of upstream failure: timeout, stall, connection, overloaded, server or fatal
+
+    Only fatal errors, such as a rejected request, would fail again on retry.
+    """
+    import httpx
+    import openai
+
+    if isinstance(error, UpstreamStalled):
+        return "stall"
+    if isinstance(error, (openai.APITimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return "connection"
+    if isinstance(error, openai.APIStatusError):
+        if error.status_code == 408:
+            return "timeout"
+        if error.status_code in (409, 429):
+            return "overloaded"
+        if error.status_code >= 500:
+            return "server"
+    return "fatal"
+
+
+class RetryPolicy:
+    """Per-request retry budget with full-jitter exponential backoff"""
+
+    def __init__(self, retries, base_delay, max_delay):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt, error=None):
+        """Seconds to wait before retry number attempt, counted from 0"""
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+        # An overloaded upstream may say how long to back off
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                delay = max(delay, float(response.headers.get("retry-after", 0)))
+            except ValueError:
+                pass
+        return min(delay, self.max_delay)
+
+
+def abort_response(response_stream):
+    """Fail a blocking read on a streaming response from another thread
+
+    Closing the response does not wake a thread blocked in recv(), shutting
+    the socket down does. The reading thread still closes the response.
+    """
+    network_stream = response_stream.response.extensions.get("network_stream")
+    sock = network_stream.get_extra_info("socket") if network_stream else None
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class CancelToken:
+    """Out-of-band abort of a generation's in-flight upstream read
+
+    The reader binds each response it opens and calls chunk() per chunk.
+    cancel() aborts the bound response at once, from any thread, instead of
+    waiting for the next chunk or the read timeout. A stall only fails the
+    current attempt: its reason is cleared when the retry binds.
+    """
+
+    def __init__(self):
+        self.cancelled = False
+        self.reason = None
+        self.last_chunk = None
+        self._response = None
+        self._lock = threading.Lock()
+
+    def bind(self, response_stream):
+        with self._lock:
+            self._response = response_stream
+            self.reason = None
+            self.last_chunk = None
+            cancelled = self.cancelled
+        if cancelled:
+            abort_response(response_stream)
+
+    def unbind(self):
+        with self._lock:
+            self._response = None
+
+    def chunk(self):
+        self.last_chunk = time.monotonic()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            response = self._response
+        if response is not None:
+            abort_response(response)
+
+    def check_stall(self, timeout, now):
+        """Abort the bound response if no chunk came for timeout seconds"""
+        with self._lock:
+            response = self._response
+            if response is None or self.last_chunk is None:
+                return
+            if now - self.last_chunk <= timeout:
+                return
+            self.reason = UpstreamStalled(
+                f"No upstream chunk for {now - self.last_chunk:.0f}s"
+            )
+        abort_response(response)
+
+
+class StallWatchdog:
+    """Daemon thread aborting watched reads once they stall
+
+    The time to the first chunk is left to the request timeout, a stall is a
+    gap of more than timeout seconds between chunks.
+    """
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.interval = min(1.0, timeout / 4)
+        self._tokens = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def watch(self, token):
+        with self._lock:
+            self._tokens.add(token)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+    def unwatch(self, token):
+        with self._lock:
+            self._tokens.discard(token)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                tokens = list(self._tokens)
+            now = time.monotonic()
+            for token in tokens:
+                try:
+                    token.check_stall(self.timeout, now)
+                except Exception:
+                    logger.exception("Stall check failed")
+
+
+class Endpoint:
+    """One configured upstream and its health stats"""
+
+    def __init__(self, name, url, key, model):
+        self.name = name
+        self.url = url
+        self.key = key
+        self.model = model
+        self.outstanding = 0
+        self.ttft = None  # EWMA seconds to first chunk
+        self.error_rate = 0.0  # EWMA of failed attempts
+        self.error_updated = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.last_error = None
+
+
+class EndpointRouter:
+    """Latency-aware selection over a pool of interchangeable endpoints
+
+    An endpoint's cost is its EWMA time to first chunk times the requests it
+    already has outstanding, inflated by its recent error rate. The error
+    rate halves every error_half_life seconds without failures, so a broken
+    endpoint is probed again once it had time to recover.
+    """
+
+    BASE_LATENCY = 0.05
+
+    def __init__(self, endpoints, alpha=0.3, error_half_life=30.0):
+        self.endpoints = list(endpoints)
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self._lock = threading.Lock()
+
+    def current_error_rate(self, endpoint, now):
+        elapsed = now - endpoint.error_updated
+        return endpoint.error_rate * 0.5 ** (elapsed / self.error_half_life)
+
+    def cost(self, endpoint, now, default_ttft):
+        ttft = default_ttft if endpoint.ttft is None else endpoint.ttft
+        healthy = max(0.05, 1.0 - self.current_error_rate(endpoint, now))
+        return (ttft + self.BASE_LATENCY) * (endpoint.outstanding + 1) / healthy
+
+    def pick(self, exclude=()):
+        """Cheapest endpoint not in exclude, counted as outstanding until release()"""
+        now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self.endpoints if e not in exclude]
+            if not candidates:
+                return None
+            measured = [e.ttft for e in self.endpoints if e.ttft is not None]
+            # Untried endpoints are assumed average so they get probed
+            default_ttft = sum(measured) / len(measured) if measured else 0.0
+            endpoint = min(candidates, key=lambda e: self.cost(e, now, default_ttft))
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        return endpoint
+
+    def first_chunk(self, endpoint, seconds):
+        with self._lock:
+            if endpoint.ttft is None:
+                endpoint.ttft = seconds
+            else:
+                endpoint.ttft += self.alpha * (seconds - endpoint.ttft)
+
+    def release(self, endpoint, healthy, error=None):
+        """End an attempt, healthy is None when it was stopped by the client"""
+        now = time.monotonic()
+        with self._lock:
+            endpoint.outstanding -= 1
+            if healthy is None:
+                return
+            rate = self.current_error_rate(endpoint, now)
+            endpoint.error_rate = rate + self.alpha * ((0.0 if healthy else 1.0) - rate)
+            endpoint.error_updated = now
+            if not healthy:
+                endpoint.failures += 1
+                endpoint.last_error = str(error)
+
+    def table(self):
+        """Routing table with health stats, cheapest endpoint first"""
+        now = time.monotonic()
+        with self._lock:
+            measured = [e.ttft for e in self.endpoints if e.ttft is not None]
+            default_ttft = sum(measured) / len(measured) if measured else 0.0
+            rows = [
+                {
+                    "name": e.name,
+                    "url": e.url,
+                    "model": e.model,
+                    "cost": self.cost(e, now, default_ttft),
+                    "ttft_ms": None if e.ttft is None else e.ttft * 1000,
+                    "error_rate": self.current_error_rate(e, now),
+                    "outstanding": e.outstanding,
+                    "requests": e.requests,
+                    "failures": e.failures,
+                    "last_error": e.last_error,
+                }
+                for e in self.endpoints
+            ]
+        return sorted(rows, key=lambda row: row["cost"])